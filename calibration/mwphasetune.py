@@ -50,6 +50,8 @@ def sequence_MWPhaseTune(
 
 
 class MWPhaseTune(Measurement):
+    resources = ("pg", "dig", "laser", "vdi", "mwsyn", "mwmod")
+
     def __init__(self, name="default"):
         __paraset = dict(
             mw_phasevolt_start=0,  # Volts
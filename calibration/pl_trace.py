@@ -21,6 +21,8 @@ TERMIN_INPUT_1MOHM = 0
 
 
 class PL_trace(Measurement):
+    resources = ("pg", "dig", "laser")
+
     def __init__(self, name="default"):
         __paraset = dict(
             laser_current=20.0,
@@ -15,6 +15,8 @@ DEFAULT_PWRAVG = 8  # descriptive constant for averaging
 
 
 class RFPhaseTune(Measurement):
+    resources = ("pg", "pwr", "windfreak")
+
     def __init__(self, name="default"):
         __paraset = dict(
             freq_mhz=600.0,
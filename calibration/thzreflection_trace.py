@@ -213,6 +213,8 @@ class THzReflectionTrace(Measurement):
     Measurement class for THz reflection trace measurement
     """
 
+    resources = ("pg", "mwsyn")
+
     def __init__(self, name="default"):
         # !!< has to be specific by users>
         __paraset = dict(
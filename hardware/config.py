@@ -110,6 +110,7 @@ VDISYN_VIDPID = "0403:6001"  # the USB VID:PID
 VDISYN_BAUD = 921600  # USB baud rate between PC and VDI sythesizer
 VDISYN_timebase = int(4)  # ns
 VDISYN_multiplier = 24.0  # multiplication factor of the amplifier-multiplier chain
+VDISYN_trigch = "mwswitch"  # Pulse Streamer channel to the synthesizer trigger in
 
 
 # # ------------------------------------------------------------------------------------------------
@@ -143,3 +144,9 @@ TP_UBLK_PRERF_MIN = 1000  #  [ns], it's recommended to unblank 1us before the RF
 WAGO_IP = "192.168.1.3"
 WAGO_MAC = "00:30:DE:5F:31:43"
 WAGO_N = "750-891"
+
+# ------------------------------------------------------------------------------------------------
+# Instrument shadow state -------------------------------------------------------------------------
+# skip setter calls that repeat the last applied value, see hardware/shadow.py
+# off by default: a change on the front panel or from another program goes unnoticed
+SHADOW_STATE = False
@@ -18,6 +18,8 @@ import numpy as np
 import spcm
 from spcm import units
 
+from hardware.daq.stats import StreamStats
+
 logger = logging.getLogger(__name__)
 
 TERMINATE50OHM = 1
@@ -41,6 +43,8 @@ ACCOUPLE = 1
 TERMIN_INPUT_50OHM = 1
 TERMIN_INPUT_1MOHM = 0
 CONTINUOUS_STREAMING = 0
+# register with the number of triggers since the card start, missing in older spcm versions
+TRIGGERCOUNTER = getattr(spcm, "SPC_TRIGGERCOUNTER", None)
 
 
 MEMSIZE_MAX = 2 * units.GiS  # read from manual of M4i.4450-x8, 2 GiS = 1073741824
@@ -74,6 +78,7 @@ DEFAULT_CONFIG = dict(
     runs=None,
     notify_size=None,
     # ------------------------------------
+    zero_copy=False,  # stream_raw() hands out views of the DMA buffer
     # ------------------------------------
 )
 
@@ -86,6 +91,8 @@ class FIFO_DataAcquisition(object):
         self.__init_config = DEFAULT_CONFIG
         # assign the configuration to self
         self.reset_param()  # MUST BE CALLED in __init__ to set the default values
+        self._pending = False  # a zero-copy block is waiting for release()
+        self.stats = StreamStats()
 
         # # open the connection with the digitizer
         self.connect()
@@ -121,6 +128,7 @@ class FIFO_DataAcquisition(object):
 
     def stop_card(self):
         self.card.stop(spcm.M2CMD_DATA_STOPDMA)
+        self._pending = False
         print("Card stopped")
 
     def reset(self):
@@ -264,6 +272,13 @@ class FIFO_DataAcquisition(object):
             )  # number of samples to transfer
 
         self.multiple_recording.notify_samples(self.notify_size)
+        # in zero-copy mode the DMA region is handed back in release(), not on the next read
+        self.multiple_recording.auto_avail_card_len(not self.zero_copy)
+        self._pending = False
+        # segment_size and notify_size may carry pint units
+        self.stats.segment_per_notify = getattr(
+            self.notify_size, "magnitude", self.notify_size
+        ) / getattr(self.segment_size, "magnitude", self.segment_size)
 
         self.max_value = self.card.max_sample_value()
 
@@ -275,7 +290,18 @@ class FIFO_DataAcquisition(object):
         if self.card._closed:
             logger.info("Digitizer is not connected")
 
-    def start_buffer(self):
+    def start_buffer(self, reset_stats=True):
+        """
+        Starts the DMA transfer and enables the trigger.
+
+        Parameters:
+            reset_stats (bool): start new telemetry counters, False to carry them
+                on, e.g. when a run switches between configurations.
+        """
+        if reset_stats:
+            self.stats.reset()
+        else:
+            self.stats.restart()
         try:
             self.multiple_recording.start_buffer_transfer(spcm.M2CMD_DATA_STARTDMA)
             self.card.start(spcm.M2CMD_CARD_ENABLETRIGGER)
@@ -306,16 +332,94 @@ class FIFO_DataAcquisition(object):
         # TODO: check the conversion factor
         return (self.raw_data) * ((self.amp_input) / np.abs(self.max_value)) / 1000
 
+    @property
+    def volt_per_code(self):
+        """Voltage of one ADC code in [V] for the configured input range."""
+        return (self.amp_input / self.max_value) / 1000
+
     def stream(self):
         # for continuous streaming, please stop the card manually after acquisition---------
+        data_raw = self.stream_raw()
+        if data_raw is None:
+            return None
+        self.raw_data, scale = data_raw
+        data_block = self.raw_data * scale
+        self.release()
+        return data_block
+
+    def stream_raw(self):
+        """
+        Reads the next notify block without converting it to voltage.
+
+        Returns:
+            tuple[np.ndarray, float] | None: the raw int16 ADC codes with shape
+            (num_segment, segment_size, num_channel) and the volts per ADC code,
+            or None if nothing could be read.
+
+        With `zero_copy` the block is a read-only view into the DMA buffer. The
+        card cannot overwrite that region until release() or the next read, so
+        the caller should fold the block in and release it promptly.
+        Without `zero_copy` the block is a private copy and release() is a no-op.
+        """
+        self.release()
+        stats = self.stats
+        stats.num_read += 1
+        time_start = time.perf_counter()
         try:
             data_block = next(self.multiple_recording)
-            self.raw_data = np.copy(data_block)
-            # print(np.shape(data_block))
-            # self.raw_data = self.channels[0].convert_data(self.raw_data, units.mV)
-            return (self.raw_data) * ((self.amp_input) / self.max_value) / 1000
-            # return np.copy(data_block)
+        except StopIteration:
+            # spcm gives up after repeated card timeouts
+            stats.num_timeout += 1
+            stats.last_error = "timeout"
+            logger.warning(f"Digitizer read timed out ({stats.num_timeout} so far)")
+            return None
         except Exception as e:
-            print(e)
-        # return self.raw_data
-        return None
+            stats.num_error += 1
+            stats.last_error = str(e)
+            logger.warning(f"Digitizer read failed: {e}")
+            return None
+        finally:
+            stats.time_read = time.perf_counter() - time_start
+        self._update_stats(data_block)
+        scale = self.volt_per_code
+        if not self.zero_copy:
+            return np.copy(data_block), scale
+        self._pending = True
+        data_view = data_block.view()
+        data_view.flags.writeable = False
+        return data_view, scale
+
+    def _trigger_count(self):
+        # triggers since the card start, None if the card cannot tell
+        if TRIGGERCOUNTER is None:
+            return None
+        try:
+            return self.card.get_i(TRIGGERCOUNTER)
+        except Exception:
+            return None
+
+    def _update_stats(self, data_block):
+        stats = self.stats
+        stats.segment_received += data_block.shape[0]
+        stats.fill_promille = self.multiple_recording.fill_size_promille()
+        stats.fill_promille_max = max(stats.fill_promille_max, stats.fill_promille)
+        stats.avail_bytes = self.multiple_recording.avail_user_len(in_bytes=True)
+        overrun = self.card.status() & spcm.M2STAT_DATA_OVERRUN
+        num_trigger = self._trigger_count()
+        if num_trigger is not None:
+            # segments still in the card buffer are not dropped yet
+            stats.set_acquired(num_trigger - stats.avail_bytes // data_block[0].nbytes)
+        else:
+            # without the counter, count the block read and a lost block per overrun
+            stats.segment_expected += stats.segment_per_notify * (2 if overrun else 1)
+        if overrun:
+            stats.num_overrun += 1
+            logger.warning(
+                f"Digitizer buffer overrun, fill level {stats.fill_promille / 10:.1f}%"
+            )
+
+    def release(self):
+        """Hands the DMA region of the last zero-copy block back to the card."""
+        if self._pending:
+            self.multiple_recording.flush()
+            self._pending = False
@@ -0,0 +1,366 @@
+"""
+Simulated stand-in for the Spectrum digitizer in FIFO multi-recording mode
+
+SimulatedDataAcquisition has the interface of FIFO_DataAcquisition that the
+measurements use (assign_param, set_config, start_buffer, stream_raw, release,
+stop_card, volt_per_code, stats) and needs neither the card nor spcm. Every
+segment is the PL response of one readout: the double_exponential pulse shape
+of calibration/setting.py scaled by the brightness of its sequence position,
+plus shot noise and readout noise, as raw int16 codes.
+
+Blocks of notify_size samples are handed out at the trigger rate of the pulse
+sequence, taken from the (emulated) pulse generator's trigger channel or set
+by hand. With speedup > 1 the blocks come faster than real time, with
+speedup=np.inf as fast as they can be assembled, so the accumulation and
+_organize_data can be benchmarked above the hardware rate. A consumer that
+falls behind shows up in the fill level and overrun counters like on the card.
+
+Author: ChunTung Cheung
+Email: ctcheung1123@gmail.com
+Created:  2026-10-18
+"""
+
+import logging
+import time
+
+import numpy as np
+
+import hardware.config as hcf
+from calibration.setting import PLINT_WEIGTHT_FITPARA, double_exponential
+from hardware.daq.stats import StreamStats
+
+logger = logging.getLogger(__name__)
+
+MAX_VALUE = 2**15 - 1  # ADC code of the full input range
+EXTEND_AUTOMEM = 16  # card buffer in units of num_segment segments, as in sidig.py
+
+DEFAULT_CONFIG = dict(
+    amp_input=5000,  # [mV]
+    card_timeout=5.0,  # [s]
+    segment_size=None,
+    pretrig_size=None,
+    posttrig_size=None,
+    num_segment=1,
+    mem_size="auto",
+    readout_ch=None,
+    sampling_frequency=hcf.SIDIG_maxsr,  # [Hz]
+    notify_size=None,
+    zero_copy=False,
+)
+
+
+class SimulatedDataAcquisition(object):
+    """
+    Digitizer that streams simulated PL segments.
+
+    Parameters:
+        sn_address (str): only kept for the log.
+        pulser: pulse generator whose trigger channel paces the segments,
+            None to use `trigger_rate`.
+        trigger_ch (str): channel name of the digitizer trigger in the pulser's map.
+        levels (array_like): relative PL of the consecutive sequence positions,
+            repeated over the sequence, e.g. (dark, bright).
+        pl_amplitude (float): peak PL voltage of a level-1 segment [V].
+        baseline (float): APD offset [V].
+        photons (float): detected photons in a level-1 segment, sets the shot noise.
+        read_noise (float): rms noise of every sample [V].
+        trigger_rate (float | None): segments per second if there is no pulser.
+        speedup (float): pace relative to real time, np.inf for no pacing.
+        num_pool (int): noise realizations per level that segments are drawn from.
+        seed (int | None): seed of the random generator.
+
+    Attributes:
+        stats (StreamStats): telemetry of the streaming, as on the card.
+    """
+
+    def __init__(
+        self,
+        sn_address="simulated",
+        pulser=None,
+        trigger_ch="sdtrig",
+        levels=(0.8, 1.0),
+        pl_amplitude=0.05,
+        baseline=0.01,
+        photons=50.0,
+        read_noise=2e-3,
+        trigger_rate=None,
+        speedup=1.0,
+        num_pool=256,
+        seed=None,
+    ):
+        self.sn_address = sn_address
+        self.pulser = pulser
+        self.trigger_ch = trigger_ch
+        self.levels = np.asarray(levels, dtype=np.float64)
+        self.pl_amplitude = pl_amplitude
+        self.baseline = baseline
+        self.photons = photons
+        self.read_noise = read_noise
+        self.trigger_rate = trigger_rate
+        self.speedup = speedup
+        self.num_pool = int(num_pool)
+        self.rng = np.random.default_rng(seed)
+        self.max_value = MAX_VALUE
+        self.reset_param()
+        self._pending = False
+        self._running = False
+        self._rate_cache = (None, 0.0)  # (sequence, trigger rate)
+        self.stats = StreamStats()
+        logger.info(f"Simulated digitizer '{sn_address}' in place of the card")
+
+    # configuration -------------------------------------------------------------
+    def set_ext_clock(self):
+        pass
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        self.reset_param()
+
+    def close(self):
+        self.disconnect()
+
+    def reset(self):
+        self.stop_card()
+
+    def assign_param(self, settings_dict):
+        for key, value in settings_dict.items():
+            if hasattr(self, key):
+                setattr(self, key, value)
+
+    def reset_param(self):
+        for key, value in DEFAULT_CONFIG.items():
+            setattr(self, key, value)
+
+    def set_response(self, levels=None, **kwargs):
+        """
+        Changes the PL response, e.g. set_response(levels=(0.7, 1.0), photons=200).
+        Takes effect at the next set_config().
+        """
+        if levels is not None:
+            self.levels = np.asarray(levels, dtype=np.float64)
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise AttributeError(f"Unknown response parameter '{key}'")
+            setattr(self, key, value)
+
+    @property
+    def volt_per_code(self):
+        """Voltage of one ADC code in [V] for the configured input range."""
+        return (self.amp_input / self.max_value) / 1000
+
+    def config(self):
+        if self.segment_size is None:
+            self.segment_size = self.pretrig_size + self.posttrig_size
+        elif self.pretrig_size is None:
+            self.pretrig_size = self.segment_size - self.posttrig_size
+        if self.mem_size == "auto" or self.mem_size is None:
+            self.mem_size = self.num_segment * self.segment_size * EXTEND_AUTOMEM
+        if self.notify_size is None:
+            self.notify_size = self.num_segment * self.segment_size // 8 // 32 * 32
+        self._seg_per_notify = max(self.notify_size // self.segment_size, 1)
+        self._seg_in_memory = self.mem_size // self.segment_size
+        self._build_response()
+        self._buffer = np.empty(
+            (self._seg_per_notify, self.segment_size, 1), dtype=np.int16
+        )
+        self._pending = False
+        self._running = False
+        self.stats.segment_per_notify = self._seg_per_notify
+        logger.info(
+            f"Pre-trigger: {self.pretrig_size}, Segment Size: {self.segment_size}, {self._seg_per_notify} segments per block"
+        )
+
+    def set_config(self):
+        # alias function name to config
+        return self.config()
+
+    def _build_response(self):
+        # mean segment of every distinct level and a pool of its noise, in ADC codes
+        t = (np.arange(self.segment_size) - self.pretrig_size) * (
+            1e9 / self.sampling_frequency
+        )
+        shape = double_exponential(t, **dict(PLINT_WEIGTHT_FITPARA, A=1.0))
+        shape = shape / np.max(shape)
+        # every photon adds the same charge, so the shot noise variance is q * signal
+        charge = self.pl_amplitude * np.sum(shape) / self.photons
+        levels, self._slot_level = np.unique(self.levels, return_inverse=True)
+        signal = self.pl_amplitude * levels[:, None] * shape[None, :]
+        mean = (self.baseline + signal) / self.volt_per_code
+        self._template = np.round(mean).astype(np.int16)
+        noise_std = np.sqrt(charge * signal + self.read_noise**2) / self.volt_per_code
+        noise = self.rng.standard_normal(
+            (len(levels), self.num_pool, self.segment_size)
+        )
+        # a zero-mean pool, so long averages converge to the set response
+        noise -= np.mean(noise, axis=1, keepdims=True)
+        self._noise = np.round(noise * noise_std[:, None, :]).astype(np.int16)
+
+    # streaming ---------------------------------------------------------------------
+    def start_buffer(self, reset_stats=True):
+        if reset_stats:
+            self.stats.reset()
+        else:
+            self.stats.restart()
+        self._running = True
+        self._slot = 0
+        self._t_due = None  # when the next block is complete
+        self._lag = 0.0  # [s] the consumer is behind the card
+        self._num_delivered = 0  # segments read since the start
+        self._num_lost = 0  # segments that did not fit into the card memory
+        self._lost_last = 0  # segments lost while waiting for the last block
+
+    def stop_card(self):
+        self._running = False
+        self._pending = False
+        print("Card stopped")
+
+    def _segment_rate(self):
+        if self.trigger_rate is not None:
+            return self.trigger_rate * self.speedup
+        if self.pulser is None or not self.pulser.isStreaming():
+            return 0.0
+        seq = self.pulser.seq
+        if self._rate_cache[0] is not seq:
+            ch = self.pulser.chmap[self.trigger_ch]
+            _, states, _ = seq._Sequence__channel_digital[ch]
+            num_trig = int(np.sum(np.diff(states) > 0)) + int(states[0] > 0)
+            self._rate_cache = (seq, num_trig / (seq.getDuration() * 1e-9))
+        return self._rate_cache[1] * self.speedup
+
+    def _wait_block(self):
+        # wait until the card would have the next block, False on timeout
+        time_start = time.perf_counter()
+        while True:
+            now = time.perf_counter()
+            rate = self._segment_rate()
+            if rate > 0:
+                break
+            if now - time_start > self.card_timeout:
+                return False
+            time.sleep(1e-3)
+            self._t_due = None
+        self._lost_last = 0
+        if not np.isfinite(rate):
+            # unpaced, the consumer is never behind
+            self._lag = 0.0
+            self._fill = 0.0
+            return True
+        period = self._seg_per_notify / rate
+        if self._t_due is None:
+            self._t_due = now + period
+        if self._t_due > now:
+            time.sleep(self._t_due - now)
+        self._lag = max(time.perf_counter() - self._t_due, 0.0)
+        self._t_due += period
+        # segments that arrive while the memory is full are lost
+        self._lost_last = max(int(self._lag * rate) - self._seg_in_memory, 0)
+        if self._lost_last:
+            self._lag -= self._lost_last / rate
+            self._t_due += self._lost_last / rate
+            self._slot = (self._slot + self._lost_last) % len(self._slot_level)
+            self._num_lost += self._lost_last
+        self._fill = self._lag * rate / self._seg_in_memory
+        return True
+
+    def stream_raw(self):
+        """
+        Simulates the next notify block, see FIFO_DataAcquisition.stream_raw.
+
+        Returns:
+            tuple[np.ndarray, float] | None: int16 codes with shape
+            (num_segment, segment_size, 1) and the volts per ADC code, or None
+            on timeout, i.e. when the card is stopped or nothing triggers it.
+        """
+        self.release()
+        stats = self.stats
+        stats.num_read += 1
+        time_start = time.perf_counter()
+        ready = self._running and self._wait_block()
+        stats.time_read = time.perf_counter() - time_start
+        if not ready:
+            stats.num_timeout += 1
+            stats.last_error = "timeout"
+            logger.warning(f"Digitizer read timed out ({stats.num_timeout} so far)")
+            return None
+
+        num_seg = self._seg_per_notify
+        slots = (self._slot + np.arange(num_seg)) % len(self._slot_level)
+        self._slot = (self._slot + num_seg) % len(self._slot_level)
+        level = self._slot_level[slots]
+        pick = self.rng.integers(0, self.num_pool, num_seg)
+        np.add(
+            self._template[level], self._noise[level, pick], out=self._buffer[:, :, 0]
+        )
+
+        self._num_delivered += num_seg
+        stats.segment_received += num_seg
+        stats.set_acquired(self._num_delivered + self._num_lost)
+        stats.fill_promille = min(int(self._fill * 1000), 1000)
+        stats.fill_promille_max = max(stats.fill_promille_max, stats.fill_promille)
+        stats.avail_bytes = int(min(self._fill, 1.0) * self.mem_size * 2)
+        if self._lost_last:
+            stats.num_overrun += 1
+            logger.warning(f"Digitizer buffer overrun, {self._lost_last} segments lost")
+        scale = self.volt_per_code
+        if not self.zero_copy:
+            return np.copy(self._buffer), scale
+        self._pending = True
+        data_view = self._buffer.view()
+        data_view.flags.writeable = False
+        return data_view, scale
+
+    def stream(self):
+        data_raw = self.stream_raw()
+        if data_raw is None:
+            return None
+        self.raw_data, scale = data_raw
+        data_block = self.raw_data * scale
+        self.release()
+        return data_block
+
+    def release(self):
+        self._pending = False
+
+
+def benchmark(num_slot=202, segment_size=1024, num_segment=8192, num_block=50):
+    from measurement.accumulator import SegmentAccumulator
+
+    dig = SimulatedDataAcquisition(
+        levels=[0.8, 1.0] * (num_slot // 2), trigger_rate=np.inf, seed=0
+    )
+    dig.assign_param(
+        dict(
+            pretrig_size=256,
+            posttrig_size=segment_size - 256,
+            segment_size=segment_size,
+            num_segment=num_segment,
+            zero_copy=True,
+        )
+    )
+    dig.set_config()
+    dig.start_buffer()
+    acc = SegmentAccumulator(num_slot, segment_size, dtype=np.int64)
+    t_sim = 0.0
+    t_acc = 0.0
+    for _ in range(num_block):
+        start = time.perf_counter()
+        block, _ = dig.stream_raw()
+        t_sim += time.perf_counter() - start
+        start = time.perf_counter()
+        acc.add(block)
+        t_acc += time.perf_counter() - start
+    num_seg = num_block * dig._seg_per_notify
+    print(
+        f"{num_block} blocks of {dig._seg_per_notify} segments x {segment_size} samples"
+    )
+    print(f"   simulation:   {num_seg / t_sim:.3g} segments/s")
+    print(f"   accumulation: {num_seg / t_acc:.3g} segments/s")
+    mean = acc.store / acc.count[:, None] * dig.volt_per_code
+    contrast = np.sum(mean[1] - mean[0]) / np.sum(mean[1] - dig.baseline)
+    print(f"   dark/bright contrast {contrast:.3f} (set {1 - 0.8:.3f})")
+
+
+if __name__ == "__main__":
+    benchmark()
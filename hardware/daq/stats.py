@@ -0,0 +1,78 @@
+"""
+Telemetry of the streamed digitizer acquisition, shared by the Spectrum card
+driver and its simulated stand-in
+
+Author: Emmeline Riendeau & ChunTung Cheung
+Email: emmelineriendeau@gmail & ctcheung1123@gmail.com
+Created:  2026-10-18
+"""
+
+
+class StreamStats(object):
+    """
+    Telemetry of the FIFO streaming, updated on every read and reset by
+    start_buffer() at the beginning of a run.
+
+    Attributes:
+        num_read (int): reads attempted since the start of the run.
+        num_timeout (int): reads that ran into the card timeout.
+        num_error (int): reads that failed for any other reason.
+        num_overrun (int): reads after which the card reported a data overrun.
+        segment_received (int): segments delivered to the caller.
+        segment_expected (float): segments the card acquired that should have
+            been delivered by now, i.e. its trigger count minus the segments
+            still waiting in its buffer.
+        fill_promille (int): fill level of the card buffer after the last read [‰].
+        fill_promille_max (int): highest fill level seen.
+        avail_bytes (int): bytes waiting in the card buffer after the last read.
+        time_read (float): seconds spent waiting in the last read.
+        last_error (str): message of the last failed read.
+    """
+
+    def __init__(self, segment_per_notify=0):
+        self.segment_per_notify = segment_per_notify
+        self.reset()
+
+    def reset(self):
+        self.num_read = 0
+        self.num_timeout = 0
+        self.num_error = 0
+        self.num_overrun = 0
+        self.segment_received = 0
+        self.segment_expected = 0.0
+        self._expected_base = 0.0  # segments acquired before the last card start
+        self.fill_promille = 0
+        self.fill_promille_max = 0
+        self.avail_bytes = 0
+        self.time_read = 0.0
+        self.last_error = ""
+
+    def restart(self):
+        """The card counts from zero again, e.g. after a reconfiguration within the run."""
+        self._expected_base = self.segment_expected
+
+    def set_acquired(self, num_segment):
+        """Sets the segments acquired since the last card start and not waiting in its buffer."""
+        self.segment_expected = self._expected_base + num_segment
+
+    @property
+    def segment_dropped(self):
+        return self.segment_expected - self.segment_received
+
+    def as_dict(self, prefix="dig_"):
+        """Flat dictionary of the counters, e.g. to put into a measurement's stateset."""
+        stats = dict(
+            num_read=self.num_read,
+            num_timeout=self.num_timeout,
+            num_error=self.num_error,
+            num_overrun=self.num_overrun,
+            segment_received=self.segment_received,
+            segment_expected=self.segment_expected,
+            segment_dropped=self.segment_dropped,
+            fill_promille=self.fill_promille,
+            fill_promille_max=self.fill_promille_max,
+            avail_bytes=self.avail_bytes,
+            time_read=self.time_read,
+            last_error=self.last_error,
+        )
+        return {prefix + key: value for key, value in stats.items()}
@@ -9,6 +9,7 @@ import hardware.config as hcf
 from hardware.camera.light import WhiteLight
 from hardware.camera.thorlabs import CameraController
 from hardware.daq.sidig import FIFO_DataAcquisition
+from hardware.daq.sidig_sim import SimulatedDataAcquisition
 from hardware.fluidics.uFcontrol import PneumaticControl
 from hardware.laser.laser import LaserControl
 from hardware.mw.detector.pwrcontrol import MWPowerMeter
@@ -18,7 +19,9 @@ from hardware.mw.mwmodulation import Modulator
 from hardware.mw.mwsource import VDISource
 from hardware.mw.mwsynthesizer import Synthesizer
 from hardware.mw.windfreakcontrol import WindfreakSynth
+from hardware.pulser.emulator import EmulatedPulseGenerator
 from hardware.pulser.pulser import PulseGenerator
+from hardware.shadow import SHADOW_RULES, ShadowState
 
 # 1. DEPENDENCIES
 # =================
@@ -69,6 +72,7 @@ class HardwareManager(metaclass=Singleton):
         for attr in self.__annotations__:
             setattr(self, attr, None)
         self.initialization_complete = False
+        self.shadow = ShadowState()
 
     def add_default_hardware(self):
         """Initializes all default hardware controllers in parallel using a thread pool."""
@@ -179,10 +183,55 @@ class HardwareManager(metaclass=Singleton):
                         exc_info=True,
                     )
         logger.info("Hardware initialization process has finished.")
+        if hcf.SHADOW_STATE:
+            self.add_shadow_state()
         # Optional: Add a small delay to ensure all logs are flushed if needed
         time.sleep(0.1)
         self.initialization_complete = True
 
+    def add_shadow_state(self):
+        """
+        Skips setter calls that would apply the value an instrument already has,
+        see hardware/shadow.py for the shadowed settings.
+        """
+        for name in SHADOW_RULES:
+            self.shadow.attach(name, getattr(self, name, None))
+        logger.info("Shadow state of the instrument settings is on.")
+
+    def remove_shadow_state(self):
+        """Sends every setter call to the instruments again."""
+        self.shadow.detach()
+        logger.info("Shadow state of the instrument settings is off.")
+
+    def add_emulated_hardware(self):
+        """
+        Puts software stand-ins in place of the instruments that have one, e.g.
+        for throughput benchmarks and regression tests without the setup.
+        Instruments without a stand-in are left as they are.
+        """
+        hardware_to_emulate = [
+            {
+                "name": "pg",
+                "class": EmulatedPulseGenerator,
+                "info": "Pulse Streamer emulator",
+                "kwargs": lambda s: {"chmap": hcf.PS_chmap, "choffs": hcf.PS_choffs},
+            },
+            {
+                "name": "dig",
+                "class": SimulatedDataAcquisition,
+                "info": "simulated SI Digitizer",
+                # segments are paced by the trigger channel of the emulated pulser
+                "kwargs": lambda s: {"pulser": s.pg},
+            },
+        ]
+        for hw_config in hardware_to_emulate:
+            name, class_name = hw_config["name"], hw_config["class"].__name__
+            instance = hw_config["class"](**hw_config["kwargs"](self))
+            setattr(self, name, instance)
+            self._hardware_instances[class_name] = instance
+            logger.info(f"Added '{name}' for {hw_config['info']}")
+        self.initialization_complete = True
+
     def add(
         self,
         name: str,
@@ -222,6 +271,7 @@ class HardwareManager(metaclass=Singleton):
         close() method if it exists, ensuring a graceful shutdown.
         """
         logger.info("HardwareManager is shutting down all connections...")
+        self.shadow.invalidate()
         for name, instance in self._hardware_instances.items():
             # Check if the instance has a 'close' method
             if hasattr(instance, "close") and callable(getattr(instance, "close")):
@@ -22,6 +22,7 @@ import serial.tools.list_ports
 INT32BIT = int(4294967296)  # int(2**32)
 FLOAT32BIT = 4294967296.0
 READSIZE_MAX = 256
+STEPDWELL_MAX = 0xFFFF * 4  # [ns] longest step dwell of a sweep, 262.14 us
 
 # The instrument calculates the Exclusive OR of
 # all the bytes and compares with the last byte sent. If the results are the same, the instrument
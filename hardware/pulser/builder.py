@@ -0,0 +1,190 @@
+"""
+Block-structured pulse sequences that stay symbolic until they are compiled
+
+A sequence is a tree of Block, Repeat and Concat nodes, e.g.
+    track = Block([(["laser"], 50), ([], 150)]) * 40 + Block([([], 1000)])
+    seq = pretrack + track * 300
+The duration of every node is known without expanding it, so long protocols
+can be checked cheaply. compile() turns the tree into a CompiledSequence with
+one np.tile per Repeat and one np.concatenate per Concat, every distinct node
+is compiled only once.
+
+Author: ChunTung Cheung
+Email: ctcheung1123@gmail.com
+Created:  2026-10-18
+"""
+
+import operator
+from abc import ABC, abstractmethod
+
+from hardware.pulser.pulser import CHANNEL_MAP, CompiledSequence, SequenceError
+
+
+class Node(ABC):
+    """
+    Base class of the sequence nodes, supports node + node and node * n.
+    """
+
+    @property
+    @abstractmethod
+    def duration(self):
+        """Duration of the node in ns."""
+
+    @property
+    @abstractmethod
+    def num_step(self):
+        """Number of (channels, duration) steps once expanded."""
+
+    @abstractmethod
+    def blocks(self):
+        """The distinct Blocks in the tree."""
+
+    @abstractmethod
+    def _compile(self, chmap, memo):
+        """CompiledSequence of the node, `memo` maps id(node) to those compiled already."""
+
+    def compile(self, chmap=CHANNEL_MAP):
+        """
+        Expands the tree into a CompiledSequence.
+
+        Parameters:
+            chmap (dict): channel name to digital channel number.
+        """
+        return self._compile(chmap, dict())
+
+    @abstractmethod
+    def steps(self):
+        """The expanded list of (channels, duration) tuples, only for small sequences."""
+
+    def __add__(self, other):
+        if not isinstance(other, Node):
+            return NotImplemented
+        return Concat(self, other)
+
+    def __mul__(self, num_repeat):
+        # any integer type, e.g. np.int64 from a parameter array
+        try:
+            num_repeat = operator.index(num_repeat)
+        except TypeError:
+            return NotImplemented
+        return Repeat(self, num_repeat)
+
+    __rmul__ = __mul__
+
+
+class Block(Node):
+    """
+    Leaf node holding explicit (channels, duration) steps.
+
+    Parameters:
+        steps (list): e.g. [(["laser"], 300), ([], 300)]
+    """
+
+    def __init__(self, steps):
+        self._steps = list(steps)
+        self._duration = sum(duration for _, duration in self._steps)
+
+    @property
+    def duration(self):
+        return self._duration
+
+    @property
+    def num_step(self):
+        return len(self._steps)
+
+    def blocks(self):
+        return [self]
+
+    def steps(self):
+        return list(self._steps)
+
+    def _compile(self, chmap, memo):
+        if id(self) not in memo:
+            memo[id(self)] = CompiledSequence.from_steps(self._steps, chmap)
+        return memo[id(self)]
+
+    def __repr__(self):
+        return f"Block({self.num_step} steps, {self.duration} ns)"
+
+
+class Repeat(Node):
+    """
+    Node played `num_repeat` times in a row.
+
+    Parameters:
+        node (Node): the repeated node.
+        num_repeat (int): number of repetitions, zero gives an empty node.
+    """
+
+    def __init__(self, node, num_repeat):
+        if num_repeat < 0:
+            raise SequenceError(f"Negative number of repetitions {num_repeat}")
+        self.node = node
+        self.num_repeat = int(num_repeat)
+
+    @property
+    def duration(self):
+        return self.node.duration * self.num_repeat
+
+    @property
+    def num_step(self):
+        return self.node.num_step * self.num_repeat
+
+    def blocks(self):
+        return self.node.blocks()
+
+    def steps(self):
+        return self.node.steps() * self.num_repeat
+
+    def _compile(self, chmap, memo):
+        if id(self) not in memo:
+            memo[id(self)] = self.node._compile(chmap, memo).repeat(self.num_repeat)
+        return memo[id(self)]
+
+    def __repr__(self):
+        return f"Repeat({self.node!r}, {self.num_repeat})"
+
+
+class Concat(Node):
+    """
+    Nodes played one after another, nested Concats are flattened.
+
+    Parameters:
+        *nodes (Node): the nodes in playing order.
+    """
+
+    def __init__(self, *nodes):
+        self.nodes = []
+        for node in nodes:
+            if isinstance(node, Concat):
+                self.nodes.extend(node.nodes)
+            else:
+                self.nodes.append(node)
+
+    @property
+    def duration(self):
+        return sum(node.duration for node in self.nodes)
+
+    @property
+    def num_step(self):
+        return sum(node.num_step for node in self.nodes)
+
+    def blocks(self):
+        found = dict()
+        for node in self.nodes:
+            for block in node.blocks():
+                found[id(block)] = block
+        return list(found.values())
+
+    def steps(self):
+        return [step for node in self.nodes for step in node.steps()]
+
+    def _compile(self, chmap, memo):
+        if id(self) not in memo:
+            parts = [node._compile(chmap, memo) for node in self.nodes]
+            parts = [part for part in parts if len(part)]
+            memo[id(self)] = CompiledSequence.concatenate(parts)
+        return memo[id(self)]
+
+    def __repr__(self):
+        return f"Concat({', '.join(repr(node) for node in self.nodes)})"
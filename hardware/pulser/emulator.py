@@ -0,0 +1,250 @@
+"""
+In-process stand-in for the Swabian Pulse Streamer 8/2
+
+The PulseStreamerEmulator speaks the client API of pulsestreamer.PulseStreamer
+(stream, constant, forceFinal, startNow, setTrigger, rearm, hasFinished, ...)
+without any network connection. An upload takes a latency that grows with the
+pulse count of the sequence, and a stream runs for n_runs times the sequence
+duration in wall-clock time, so the timing of a measurement can be checked and
+benchmarked without the instrument.
+
+EmulatedPulseGenerator is the PulseGenerator running on top of the emulator,
+it is what HardwareManager.add_emulated_hardware() puts in place of hw.pg.
+
+Run this file directly for a small setSequence + stream benchmark and a check
+of when stream() skips the upload.
+
+Author: ChunTung Cheung
+Email: ctcheung1123@gmail.com
+Created:  2026-10-18
+"""
+
+import logging
+import time
+
+import numpy as np
+from pulsestreamer import (
+    ClockSource,
+    OutputState,
+    PulseStreamer,
+    Sequence,
+    TriggerRearm,
+    TriggerStart,
+)
+
+from hardware.pulser.pulser import (
+    CHANNEL_MAP,
+    CHANNEL_OFFSET,
+    MAX_PULSES,
+    REPEAT_INFINITELY,
+    PulseGenerator,
+    SequenceError,
+)
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_OVERHEAD = 5e-3  # [s] fixed cost of one upload
+UPLOAD_TIME_PER_PULSE = 2e-7  # [s] network transfer of one pulse (9 bytes)
+
+
+class PulseStreamerEmulator(PulseStreamer):
+    """
+    Pulse Streamer without hardware, timing is simulated with the wall clock.
+
+    Parameters:
+        ip (str): only kept for the log, no connection is made.
+
+    Attributes:
+        upload_overhead (float): fixed latency of every upload in seconds.
+        upload_time_per_pulse (float): additional latency per pulse in seconds.
+        num_upload (int): number of sequences streamed so far.
+        num_pulse (int): pulse count of the last streamed sequence.
+    """
+
+    def __init__(self, ip="emulator"):
+        # no call to PulseStreamer.__init__, it would connect to the device
+        self._ip_address = ip
+        self._has_binary = False
+        self._socket = None
+        self.upload_overhead = UPLOAD_OVERHEAD
+        self.upload_time_per_pulse = UPLOAD_TIME_PER_PULSE
+        self.num_upload = 0
+        self.num_pulse = 0
+        self._clock = ClockSource.INTERNAL
+        self._trigger = (TriggerStart.IMMEDIATE, TriggerRearm.AUTO)
+        self._has_seq = False
+        self._duration = 0  # [ns] of one run
+        self._n_runs = 0
+        self._armed = False
+        self._t_start = None  # wall-clock start of the stream
+        self._t_end = None  # wall-clock end of the stream, inf for infinite runs
+        logger.info(f"Pulse Streamer emulator '{ip}' in place of the device")
+
+    # status -------------------------------------------------------------------
+    def isStreaming(self):
+        return self._t_start is not None and time.perf_counter() < self._t_end
+
+    def hasFinished(self):
+        return self._t_start is not None and time.perf_counter() >= self._t_end
+
+    def hasSequence(self):
+        return self._has_seq
+
+    def getUnderflow(self):
+        return False
+
+    def getFirmwareVersion(self):
+        return "emulator"
+
+    def getSerial(self):
+        return self._ip_address
+
+    # configuration -------------------------------------------------------------
+    def selectClock(self, source):
+        self._clock = source
+
+    def getClock(self):
+        return self._clock
+
+    def setTrigger(self, start, rearm=TriggerRearm.AUTO):
+        self._trigger = (start, rearm)
+
+    def getTriggerStart(self):
+        return self._trigger[0]
+
+    def getTriggerRearm(self):
+        return self._trigger[1]
+
+    # sequence control ------------------------------------------------------------
+    def reset(self):
+        self.constant(OutputState.ZERO())
+        self._trigger = (TriggerStart.IMMEDIATE, TriggerRearm.AUTO)
+        self._clock = ClockSource.INTERNAL
+
+    def reboot(self):
+        self.reset()
+
+    def constant(self, state=OutputState.ZERO()):
+        # the sequence is dropped, as the pulsestreamer client assumes when it
+        # clears its own record of the uploaded data on constant()
+        self.forceFinal()
+        self._has_seq = False
+        self._armed = False
+
+    def forceFinal(self):
+        if self.isStreaming():
+            self._t_end = time.perf_counter()
+
+    def stream(self, seq, n_runs=REPEAT_INFINITELY, final=OutputState.ZERO()):
+        """Waits the simulated upload time, then starts right away or waits for a trigger."""
+        if isinstance(seq, Sequence):
+            num_pulse = len(seq.getData(as_ndarray=True))
+            duration = seq.getDuration()
+        else:
+            num_pulse = len(seq)
+            duration = sum(step[0] for step in seq)
+        if num_pulse > MAX_PULSES:
+            raise SequenceError(
+                f"Sequence of {num_pulse} pulses exceeds the {MAX_PULSES} the Pulse Streamer holds"
+            )
+        self.forceFinal()
+        time.sleep(self.upload_overhead + num_pulse * self.upload_time_per_pulse)
+        self.num_upload += 1
+        self.num_pulse = num_pulse
+        self._has_seq = True
+        self._duration = int(duration)
+        self._n_runs = n_runs
+        self._armed = True
+        self._t_start = None
+        self._t_end = None
+        if self._trigger[0] == TriggerStart.IMMEDIATE:
+            self._start()
+
+    def _start(self):
+        self._armed = self._trigger[1] == TriggerRearm.AUTO
+        self._t_start = time.perf_counter()
+        if self._n_runs == REPEAT_INFINITELY:
+            self._t_end = np.inf
+        else:
+            self._t_end = self._t_start + self._n_runs * self._duration * 1e-9
+
+    def startNow(self):
+        # a trigger is ignored while streaming or when the device is not armed
+        if self._has_seq and self._armed and not self.isStreaming():
+            self._start()
+
+    def rearm(self):
+        if self.isStreaming():
+            return False
+        self._armed = self._has_seq
+        return self._armed
+
+
+class EmulatedPulseGenerator(PulseGenerator, PulseStreamerEmulator):
+    """
+    PulseGenerator whose device calls go to the PulseStreamerEmulator.
+    """
+
+    def __init__(self, ip="emulator", chmap=CHANNEL_MAP, choffs=CHANNEL_OFFSET):
+        super().__init__(ip, chmap=chmap, choffs=choffs)
+
+
+def benchmark(num_tau=200, num_repeat=20, n_runs=10):
+    from hardware.pulser.builder import Block
+
+    pg = EmulatedPulseGenerator(chmap={"laser": 0, "mwA": 3, "sdtrig": 5})
+    read = Block([([], 300), (["laser", "sdtrig"], 900)])
+    init = Block([(["laser"], 50), ([], 150)]) * 40 + Block([([], 1000)])
+    seq = init + read
+    for tau in range(num_tau):
+        seq = seq + init + Block([(["mwA"], 20), ([], 10 + tau), (["mwA"], 20)]) + read
+
+    pg.setTrigger(TriggerStart.SOFTWARE, rearm=TriggerRearm.AUTO)
+    start = time.perf_counter()
+    for _ in range(num_repeat):
+        tt_seq = pg.setSequence(seq, reset=True)
+        pg.stream(n_runs=n_runs)
+        pg.startNow()
+    t_set = (time.perf_counter() - start) / num_repeat
+    start = time.perf_counter()
+    while not pg.hasFinished():
+        time.sleep(1e-4)
+    t_run = time.perf_counter() - start
+    print(
+        f"{seq.num_step} steps -> {pg.num_pulse} pulses, {tt_seq * 1e-6:.2f} ms per run"
+    )
+    print(f"   setSequence + stream: {t_set * 1e3:.1f} ms")
+    print(
+        f"   {n_runs} runs took {t_run * 1e3:.1f} ms (expected {n_runs * tt_seq * 1e-6:.1f} ms)"
+    )
+
+
+def check_resume():
+    """
+    Checks that streaming the same sequence again skips the upload while the
+    device holds it, and uploads it again once constant() has dropped it.
+    """
+    from hardware.pulser.builder import Block
+
+    pg = EmulatedPulseGenerator(chmap={"laser": 0, "sdtrig": 5})
+    pg.setTrigger(TriggerStart.SOFTWARE, rearm=TriggerRearm.AUTO)
+    pg.setSequence(Block([(["laser"], 1000), (["sdtrig"], 100)]), reset=True)
+    pg.cacheSequence(pg.sequenceKey("check_resume", dict()))
+    pg.stream(n_runs=REPEAT_INFINITELY)
+    num_upload = pg.num_upload
+    pg.stream(n_runs=REPEAT_INFINITELY)
+    pg.startNow()
+    assert pg.num_upload == num_upload, "the held sequence was uploaded again"
+    assert pg.isStreaming()
+    pg.constant(OutputState.ZERO())
+    assert not pg.hasSequence()
+    pg.stream(n_runs=REPEAT_INFINITELY)
+    pg.startNow()
+    assert pg.num_upload == num_upload + 1, "the dropped sequence was not uploaded"
+    assert pg.isStreaming()
+    print("   stream -> stream: no second upload, stream -> constant -> stream: upload")
+
+
+if __name__ == "__main__":
+    benchmark()
+    check_resume()
@@ -11,8 +11,12 @@ Created:  2023-01-11
 Modified: 2024-09-24
 """
 
+import copy
+import hashlib
 import logging
+import threading
 import time
+from collections import OrderedDict
 from typing import Any, List
 from typing import Sequence as TSequence
 
@@ -39,6 +43,8 @@ HIGH = 1
 LOW = 0
 INF = np.iinfo(np.int64).max
 REPEAT_INFINITELY = -1
+ANALOG_CONV = 0x7FFF  # analog codes per volt of the 16-bit DACs, +/-1V range
+MAX_PULSES = 2_000_000  # pulses the Pulse Streamer 8/2 holds in its memory
 
 # use 0 to 7 for digital channels
 # use 8 to 9 for analog channels
@@ -109,6 +115,27 @@ CHANNEL_OFFSET = {
 }
 
 
+# paraset entries that only set up other hardware, they never change the pulse sequence
+NON_SEQUENCE_KEYS = (
+    "rate_refresh",
+    "laser_current",
+    "mw_freq",
+    "mw_power",
+    "mw_powervolt",
+    "mw_phasevolt",
+    "amp_input",
+    "acq_thread",
+    "matched_filter",
+    "moving_aveg",
+    "k_order",
+    "store_scalar",
+    "bgextend_size",
+    "rf_set",
+    "chunk_dwell",
+    "adaptive",
+)
+
+
 class SequenceError(Exception):
     pass
 
@@ -169,6 +196,361 @@ def verify_sequence(
     # if we get here, the sequence passed all checks
 
 
+def compact_pattern(durations, states):
+    """
+    Merges adjacent steps with equal states and drops zero-duration steps.
+
+    Parameters:
+        durations (np.ndarray): int64 duration of every step.
+        states (np.ndarray): state of every step, e.g. HIGH/LOW of one channel.
+
+    Returns:
+        tuple: (durations, states) of the merged runs, same total duration.
+    """
+    if len(durations) == 0:
+        return durations, states
+    keep = durations > 0
+    if not np.all(keep):
+        if not np.any(keep):
+            return durations[:1], states[:1]
+        durations = durations[keep]
+        states = states[keep]
+    idx_run = np.flatnonzero(states[1:] != states[:-1]) + 1
+    idx_run = np.concatenate(([0], idx_run))
+    return np.add.reduceat(durations, idx_run), states[idx_run]
+
+
+def count_pulses(cumsums):
+    """
+    Number of pulses the device plays for a set of channel patterns.
+
+    The channels are joined into one pulse list at every time any channel
+    changes, so the count is the number of distinct edge times.
+
+    Parameters:
+        cumsums (list): cumulative end time of every step of each channel.
+
+    Returns:
+        int: the number of pulses of the joined sequence.
+    """
+    if len(cumsums) == 0:
+        return 0
+    edges = np.concatenate(cumsums)
+    return len(np.unique(edges[edges > 0]))
+
+
+def render_pattern(cumsum, states, t_start, t_stop, num_pixel):
+    """
+    Points to draw one channel between t_start and t_stop on `num_pixel` columns.
+
+    A window with at most `num_pixel` steps is returned exactly, as a step line.
+    A longer window is rasterized: every pixel column gets the minimum and the
+    maximum state of the steps overlapping it, so no edge disappears however
+    many steps fall into one column.
+
+    Parameters:
+        cumsum (np.ndarray): end time of every step.
+        states (np.ndarray): state of every step.
+        t_start, t_stop (float): the time window in ns.
+        num_pixel (int): width of the plot in pixels.
+
+    Returns:
+        tuple: (t, y, line_shape) for a plotly Scatter trace.
+    """
+    # a zero-duration step is never output, it must not be drawn as a glitch
+    nonzero = np.diff(cumsum, prepend=0) > 0
+    if not nonzero.all():
+        if not nonzero.any():
+            return np.array([t_start, t_stop]), np.zeros(2), "hv"
+        cumsum, states = cumsum[nonzero], states[nonzero]
+    starts = np.concatenate(([0], cumsum[:-1]))
+    # steps overlapping the window are idx_i <= idx < idx_f
+    idx_i = min(int(np.searchsorted(cumsum, t_start, side="right")), len(states) - 1)
+    idx_f = max(int(np.searchsorted(starts, t_stop, side="left")), idx_i + 1)
+    if idx_f - idx_i <= num_pixel:
+        t = np.concatenate(([t_start], starts[idx_i + 1 : idx_f], [t_stop]))
+        y = np.append(states[idx_i:idx_f], states[idx_f - 1])
+        return t, y, "hv"
+
+    edges = np.linspace(t_start, t_stop, num_pixel + 1)
+    first = np.searchsorted(cumsum, edges[:-1], side="right")
+    last = np.searchsorted(starts, edges[1:], side="left") - 1
+    values = states[: last[-1] + 1]
+    first = np.minimum(first, len(values) - 1)
+    # reduceat covers first[b] up to first[b+1], the step crossing into the next column is last[b]
+    y_min = np.minimum(np.minimum.reduceat(values, first), values[last])
+    y_max = np.maximum(np.maximum.reduceat(values, first), values[last])
+    t = np.append(np.repeat(edges[:-1], 2), t_stop)
+    y = np.append(np.column_stack((y_min, y_max)).ravel(), values[-1])
+    return t, y, "linear"
+
+
+class CompiledSequence:
+    """
+    Time-based digital sequence stored as arrays instead of a list of tuples.
+
+    Step k lasts durations[k] ns, and digital channel ch is HIGH during it if
+    bit ch of masks[k] is set. Measurements can build the arrays directly, or
+    compile a list of (channels, duration) tuples with from_steps.
+
+    Parameters:
+        durations (array_like): duration of every step in ns, integer valued.
+        masks (array_like): channel bitmask of every step, bit i = digital channel i.
+    """
+
+    def __init__(self, durations, masks):
+        durations = np.asarray(durations)
+        masks = np.asarray(masks, dtype=np.uint8)
+        if durations.ndim != 1 or durations.shape != masks.shape:
+            raise SequenceError(
+                f"durations and masks must be 1D arrays of equal length, got {durations.shape} and {masks.shape}"
+            )
+        if np.any(durations < 0):
+            raise SequenceError(
+                f"Step {int(np.argmax(durations < 0))}: negative duration"
+            )
+        if np.any(masks >> CHNUM_DO):
+            raise SequenceError(f"Channel mask beyond {CHNUM_DO} digital channels")
+        self.durations = durations.astype(np.int64)
+        if np.any(self.durations != durations):
+            raise SequenceError("Sequence Duration must be Int since base unit is 1ns")
+        self.masks = masks.astype(np.uint8)
+
+    @classmethod
+    def from_steps(cls, seq_tbased, chmap=CHANNEL_MAP):
+        """
+        Compiles a list of (channels, duration) tuples.
+
+        Parameters:
+            seq_tbased (list): e.g. [(["laser"], 300), ([], 300)]
+            chmap (dict): channel name to digital channel number.
+        """
+        bits = {}
+        masks = np.empty(len(seq_tbased), dtype=np.uint8)
+        durations = np.empty(len(seq_tbased), dtype=np.float64)
+        for idx, (channels, duration) in enumerate(seq_tbased):
+            mask = 0
+            for ch in channels:
+                if ch not in bits:
+                    bits[ch] = 1 << chmap[ch]
+                mask |= bits[ch]
+            masks[idx] = mask
+            durations[idx] = duration
+        return cls(durations, masks)
+
+    @classmethod
+    def concatenate(cls, sequences):
+        """Joins compiled sequences one after another."""
+        if len(sequences) == 0:
+            return cls(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8))
+        return cls(
+            np.concatenate([sq.durations for sq in sequences]),
+            np.concatenate([sq.masks for sq in sequences]),
+        )
+
+    def compact(self):
+        """The same sequence with adjacent equal steps merged and zero-duration steps dropped."""
+        return CompiledSequence(*compact_pattern(self.durations, self.masks))
+
+    def repeat(self, num_repeat):
+        """The sequence played `num_repeat` times in a row."""
+        return CompiledSequence(
+            np.tile(self.durations, num_repeat), np.tile(self.masks, num_repeat)
+        )
+
+    def __len__(self):
+        return len(self.durations)
+
+    @property
+    def total_time(self):
+        return int(np.sum(self.durations))
+
+    @property
+    def channels(self):
+        """Digital channel numbers that are HIGH in at least one step."""
+        used = int(np.bitwise_or.reduce(self.masks))
+        return [ch for ch in range(CHNUM_DO) if used >> ch & 1]
+
+    def states(self, ch):
+        """HIGH/LOW state of digital channel `ch` for every step."""
+        return ((self.masks >> ch) & 1).astype(np.int64)
+
+
+class AnalogPattern:
+    """
+    Analog pattern stored as arrays instead of a list of (duration, value) tuples.
+
+    Parameters:
+        durations (array_like): duration of every step in ns, integer valued.
+        values (array_like): voltage of every step.
+    """
+
+    def __init__(self, durations, values):
+        self.durations = np.asarray(durations, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        if self.durations.ndim != 1 or self.durations.shape != self.values.shape:
+            raise SequenceError(
+                f"durations and values must be 1D arrays of equal length, got {self.durations.shape} and {self.values.shape}"
+            )
+        if np.any(self.durations < 0):
+            raise SequenceError("Analog pattern with negative duration")
+
+    @classmethod
+    def constant(cls, duration, value=0.0):
+        return cls([int(duration)], [value])
+
+    @staticmethod
+    def _sample_times(duration, dt):
+        # full steps of dt, then one shorter step so the duration is exact
+        duration = int(duration)
+        dt = int(dt)
+        num_full, remain = divmod(duration, dt)
+        ttt = np.arange(num_full + (remain > 0), dtype=np.float64) * dt
+        durations = np.full(len(ttt), dt, dtype=np.int64)
+        if remain:
+            durations[-1] = remain
+        return ttt, durations
+
+    @classmethod
+    def sine(cls, duration, dt, freq, amp=1.0, phase=0.0, t0=0.0):
+        """
+        amp * sin(2 pi freq (t0 + t) + phase) sampled every dt for `duration`
+
+        Parameters:
+            duration (int): total duration in ns.
+            dt (int): sample step in ns.
+            freq (float): frequency in GHz (1/ns).
+            t0 (float): time of the first sample in ns, negative dt reverses time.
+        """
+        ttt, durations = cls._sample_times(duration, abs(dt))
+        ttt = t0 + np.sign(dt) * ttt
+        return cls(durations, amp * np.sin(2 * np.pi * freq * ttt + phase))
+
+    @classmethod
+    def cosine(cls, duration, dt, freq, amp=1.0, phase=0.0, t0=0.0):
+        return cls.sine(duration, dt, freq, amp=amp, phase=phase + np.pi / 2, t0=t0)
+
+    @classmethod
+    def am_sine(cls, duration, dt, freq, envelope, phase=0.0, t0=0.0):
+        """
+        sine whose amplitude follows `envelope`, a function of time in ns or an
+        array with one amplitude per sample
+        """
+        carrier = cls.sine(duration, dt, freq, phase=phase, t0=t0)
+        if callable(envelope):
+            ttt, _ = cls._sample_times(duration, abs(dt))
+            envelope = envelope(t0 + np.sign(dt) * ttt)
+        return cls(carrier.durations, carrier.values * envelope)
+
+    @classmethod
+    def concatenate(cls, patterns):
+        if len(patterns) == 0:
+            return cls(np.zeros(0, dtype=np.int64), np.zeros(0))
+        return cls(
+            np.concatenate([pt.durations for pt in patterns]),
+            np.concatenate([pt.values for pt in patterns]),
+        )
+
+    def __add__(self, other):
+        if not isinstance(other, AnalogPattern):
+            return NotImplemented
+        return AnalogPattern.concatenate([self, other])
+
+    def tile(self, scales):
+        """The pattern repeated once for every entry of `scales`, each copy multiplied by it."""
+        scales = np.asarray(scales, dtype=np.float64)
+        return AnalogPattern(
+            np.tile(self.durations, len(scales)),
+            np.outer(scales, self.values).ravel(),
+        )
+
+    def __len__(self):
+        return len(self.durations)
+
+    @property
+    def duration(self):
+        return int(np.sum(self.durations))
+
+    def quantize(self):
+        """The pattern with its values rounded to the DAC codes."""
+        return AnalogPattern(
+            self.durations, np.round(self.values * ANALOG_CONV) / ANALOG_CONV
+        )
+
+    def merge(self):
+        """The pattern with equal adjacent steps merged and zero-duration steps dropped."""
+        return AnalogPattern(*compact_pattern(self.durations, self.values))
+
+    def to_list(self):
+        return list(zip(self.durations.tolist(), self.values.tolist()))
+
+
+class SequenceCache:
+    """
+    Least-recently-used store of built sequences, keyed by a hash of everything
+    that determines them.
+
+    Parameters:
+        maxsize (int): number of sequences kept, they can be large.
+    """
+
+    def __init__(self, maxsize=4):
+        self.maxsize = int(maxsize)
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(*parts):
+        """
+        blake2b hash of nested dicts, lists and values, e.g.
+        key(name, paraset, chmap, choffs)
+        """
+        digest = hashlib.blake2b(digest_size=16)
+
+        def feed(obj):
+            if isinstance(obj, dict):
+                digest.update(b"{")
+                for kk in sorted(obj, key=repr):
+                    feed(kk)
+                    feed(obj[kk])
+                digest.update(b"}")
+            elif isinstance(obj, (list, tuple)):
+                digest.update(b"[")
+                for vv in obj:
+                    feed(vv)
+                digest.update(b"]")
+            elif isinstance(obj, np.ndarray):
+                digest.update(str(obj.dtype).encode() + str(obj.shape).encode())
+                digest.update(np.ascontiguousarray(obj).tobytes())
+            else:
+                digest.update(repr(obj).encode())
+            digest.update(b";")
+
+        for part in parts:
+            feed(part)
+        return digest.hexdigest()
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
 def invert_chmap(my_map):
     inv_map = {}
     invertedkey = []
@@ -199,6 +581,13 @@ class PulseGenerator(PulseStreamer):
         self.choffs = CHANNEL_OFFSET.copy()
         self.setChOffset(choffs.copy())
         self.seq = Sequence()
+        self.compression = 1.0
+        self.seq_cache = SequenceCache()
+        self.seq_key = None  # cache key of self.seq, None if it was built by hand
+        self.loaded_key = None  # what the device is streaming, see stream()
+        self._staged = None  # sequence built in the background, see stageSequence()
+        self.t_final = None  # when the last block was stopped, see startNow()
+        self.dead_time = 0.0  # [s] between the last two blocks
         self.reset()
         # # 20250519 Tung: Set it manually in the measurement, not at the beginning
         # super().selectClock(ClockSource.EXT_10MHZ)
@@ -258,16 +647,85 @@ class PulseGenerator(PulseStreamer):
         # #reset the device - all outputs 0V
         # super().reset()
 
+        if seq == "AUTO" and self.seq_key is not None:
+            # skip the upload if the device still holds this very sequence
+            loaded_key = (self.seq_key, n_runs, repr(state_i), repr(state_f))
+            if self.loaded_key == loaded_key and self.hasSequence():
+                # e.g. a finished stream, arm it for the next trigger again
+                self.rearm()
+                logger.info(f"Sequence already uploaded, keep {n_runs} runs")
+                return
+        else:
+            loaded_key = None
+
+        if seq == "AUTO":
+            # fail before the upload rather than in the middle of it
+            num_pulse = self.estimatePulses()
+            if num_pulse > MAX_PULSES:
+                raise SequenceError(
+                    f"Sequence has {num_pulse} pulses, more than the {MAX_PULSES} the Pulse Streamer holds; shorten it or split it with planSequence()"
+                )
+
         # set constant state of the device
         super().constant(state_i)  # all outputs 0V
         if seq == "AUTO":
             super().stream(self.seq, n_runs, state_f)
         elif type(seq) is Sequence:
             super().stream(seq, n_runs, state_f)
+        self.loaded_key = loaded_key
         logger.info(f"Stream Sequence with {n_runs} runs")
 
+    def forceFinal(self):
+        super().forceFinal()
+        self.t_final = time.perf_counter()
+
+    def startNow(self):
+        super().startNow()
+        if self.t_final is not None:
+            # outputs were idle from the end of the last block until now
+            self.dead_time = time.perf_counter() - self.t_final
+            self.t_final = None
+            logger.info(f"Dead time between sequences {self.dead_time * 1e3:.1f} ms")
+
+    def sequenceKey(self, name, paraset, exclude=NON_SEQUENCE_KEYS):
+        """
+        cache key of the sequence a measurement builds from its paraset
+        together with the channel map and offsets of this generator
+        """
+        params = {kk: vv for kk, vv in paraset.items() if kk not in exclude}
+        return self.seq_cache.key(name, params, self.chmap, self.choffs)
+
+    def restoreSequence(self, key):
+        """
+        make the cached sequence of `key` the current one
+
+        returns the info stored with it by cacheSequence, or None if it is not cached
+        """
+        cached = self.seq_cache.get(key)
+        if cached is None:
+            return None
+        self.seq, info = cached
+        self.seq_key = key
+        logger.info("Restored sequence from cache")
+        return info
+
+    def cacheSequence(self, key, **info):
+        """
+        store the current sequence under `key`, with some info like its duration
+        """
+        self.seq_cache.put(key, (self.seq, info))
+        self.seq_key = key
+        return info
+
+    def _modifySeq(self):
+        # never modify a cached sequence in place
+        if self.seq_key is not None:
+            self.seq = copy.deepcopy(self.seq)
+            self.seq_key = None
+
     def resetSeq(self):
         self.seq = Sequence()
+        self.seq_key = None
         # self.stream()
 
     def reset(self):
@@ -276,23 +734,40 @@ class PulseGenerator(PulseStreamer):
         self.stream()
         # input("\nPress ENTER to reset system and start delay-compensated sequence")
         super().reset()
+        self.loaded_key = None
         logger.info("Reset Pulse Streamer")
 
     def setDigital(self, ch, pulse_patt, offset=False):
         if offset:
             pulse_patt = [(self.choffs[ch], LOW)] + list(pulse_patt)
+        self._modifySeq()
         self.seq.setDigital(self.chmap[ch], pulse_patt)
 
     def setAnalog(self, ch, pulse_patt, offset=False):
-        if offset:
+        # pulse_patt is a list of (duration, value) or an AnalogPattern
+        if isinstance(pulse_patt, AnalogPattern):
+            if offset:
+                pulse_patt = AnalogPattern.constant(self.choffs[ch]) + pulse_patt
+            num_step = len(pulse_patt)
+            pulse_patt = pulse_patt.quantize().merge()
+            logger.debug(
+                f"Analog pattern merged from {num_step} to {len(pulse_patt)} steps"
+            )
+            pulse_patt = (pulse_patt.durations, pulse_patt.values)
+        elif offset:
             pulse_patt = [(self.choffs[ch], 0)] + pulse_patt
         print(f"Setting Analog channel {self.chmap[ch] % CHNUM_DO}")
+        self._modifySeq()
         self.seq.setAnalog(self.chmap[ch] % CHNUM_DO, pulse_patt)
 
-    def plotSeq(self, plot_all=True):
+    def plotSeq(self, plot_all=True, t_range=None, num_pixel=2000):
         """
         modify from Swabian Instrument package
         plots sequence data using plotly
+
+        long sequences are rasterized to `num_pixel` columns, see render_pattern;
+        zoom in by plotting again with t_range=(t_start, t_stop) in ns, which
+        shows every edge once the window holds few enough steps
         """
         try:
             import plotly.graph_objects as go
@@ -310,6 +785,9 @@ class PulseGenerator(PulseStreamer):
         # assuming self.seq.__pad_seq is a dictionary with the key as the sequence number and pattern_data as an array
         # where pattern_data[1] is channel data and pattern_data[2] is time data
         self.seq._Sequence__pad()
+        duration = self.seq.getDuration()
+        t_start, t_stop = (0, duration) if t_range is None else t_range
+        t_start, t_stop = max(t_start, 0), min(t_stop, duration)
 
         if plot_all:
             # Create a subplot grid with 10 rows (1 for each channel)
@@ -319,8 +797,9 @@ class PulseGenerator(PulseStreamer):
             # Loop through the sequence dictionary
             for key, pattern_data in self.seq._Sequence__pad_seq.items():
                 # Create the time and channel data for plotting
-                t = np.concatenate((np.array([0], dtype=np.int64), pattern_data[2]))
-                plot_ch_data = np.append(pattern_data[1], pattern_data[1][-1])
+                t, plot_ch_data, line_shape = render_pattern(
+                    pattern_data[2], pattern_data[1], t_start, t_stop, num_pixel
+                )
 
                 # Determine the row for subplot
                 row = 10 - key
@@ -333,7 +812,7 @@ class PulseGenerator(PulseStreamer):
                             y=plot_ch_data,
                             mode="lines",
                             name=f"A{key - Sequence.digital_channel}",
-                            line_shape="hv",
+                            line_shape=line_shape,
                             line=dict(color="black"),
                         ),
                         row=row,
@@ -354,7 +833,7 @@ class PulseGenerator(PulseStreamer):
                             y=plot_ch_data,
                             mode="lines",
                             name=f"D{key}",
-                            line_shape="hv",
+                            line_shape=line_shape,
                         ),
                         row=row,
                         col=1,
@@ -375,7 +854,9 @@ class PulseGenerator(PulseStreamer):
                 if key > 0:
                     fig.update_xaxes(showticklabels=False, row=row, col=1)
                 else:
-                    fig.update_xaxes(title_text="time/ns", row=row, col=1)
+                    fig.update_xaxes(
+                        title_text="time/ns", range=[t_start, t_stop], row=row, col=1
+                    )
 
             # Layout adjustments
             fig.update_layout(
@@ -395,8 +876,9 @@ class PulseGenerator(PulseStreamer):
             for key, name in self._chmap_inv.items():
                 # Create the time and channel data for plotting
                 pattern_data = self.seq._Sequence__pad_seq[key]
-                t = np.concatenate((np.array([0], dtype=np.int64), pattern_data[2]))
-                plot_ch_data = np.append(pattern_data[1], pattern_data[1][-1])
+                t, plot_ch_data, line_shape = render_pattern(
+                    pattern_data[2], pattern_data[1], t_start, t_stop, num_pixel
+                )
 
                 if key > (Sequence.digital_channel - 1):
                     # Analog channel plotting
@@ -406,7 +888,7 @@ class PulseGenerator(PulseStreamer):
                             y=plot_ch_data,
                             mode="lines",
                             name=f"A{key - Sequence.digital_channel}",
-                            line_shape="hv",
+                            line_shape=line_shape,
                             line=dict(color="black"),
                         ),
                         row=row,
@@ -427,7 +909,7 @@ class PulseGenerator(PulseStreamer):
                             y=plot_ch_data,
                             mode="lines",
                             name=f"D{key}",
-                            line_shape="hv",
+                            line_shape=line_shape,
                         ),
                         row=row,
                         col=1,
@@ -446,7 +928,9 @@ class PulseGenerator(PulseStreamer):
                 if row < num_ch:
                     fig.update_xaxes(showticklabels=False, row=row, col=1)
                 else:
-                    fig.update_xaxes(title_text="time/ns", row=row, col=1)
+                    fig.update_xaxes(
+                        title_text="time/ns", range=[t_start, t_stop], row=row, col=1
+                    )
                 row += 1
             # Layout adjustments
             fig.update_layout(
@@ -511,7 +995,99 @@ class PulseGenerator(PulseStreamer):
 
         return total_time, seq_chbased
 
-    def setSequence(self, seq_tbased, reset=False):
+    def compile(self, seq_tbased):
+        """
+        verify a time-based sequence and compile it with this generator's channel map
+
+        seq_tbased is a list of (channels, duration) tuples or a sequence tree
+        from hardware.pulser.builder, whose distinct blocks are verified once
+        """
+        from hardware.pulser.builder import Node
+
+        if isinstance(seq_tbased, Node):
+            for block in seq_tbased.blocks():
+                verify_sequence(
+                    block.steps(), self.getValidChNames(), allow_zero_duration=True
+                )
+            return seq_tbased.compile(self.chmap)
+        verify_sequence(seq_tbased, self.getValidChNames(), allow_zero_duration=True)
+        return CompiledSequence.from_steps(seq_tbased, self.chmap)
+
+    def estimatePulses(self, *seqs):
+        """
+        number of pulses the device needs for the given sequences played in parallel,
+        counted after the per-channel compaction of setSequence
+
+        every sequence is a time-based sequence, a CompiledSequence or a builder tree
+        for the digital channels, or an AnalogPattern for an analog channel;
+        without arguments, counts the sequence that is set right now
+        """
+        if len(seqs) == 0:
+            patterns = list(self.seq._Sequence__channel_digital.values()) + list(
+                self.seq._Sequence__channel_analog.values()
+            )
+            return count_pulses([cumsum for _, _, cumsum in patterns])
+        cumsums = []
+        for seq in seqs:
+            if isinstance(seq, AnalogPattern):
+                cumsums.append(np.cumsum(seq.quantize().merge().durations))
+                continue
+            if not isinstance(seq, CompiledSequence):
+                seq = self.compile(seq)
+            for ch in seq.channels:
+                timeline, _ = compact_pattern(
+                    np.concatenate(([self.choffs[ch]], seq.durations)),
+                    np.concatenate(([LOW], seq.states(ch))),
+                )
+                cumsums.append(np.cumsum(timeline))
+        return count_pulses(cumsums)
+
+    def planSequence(self, seq_tbased, num_item, build, max_pulses=MAX_PULSES):
+        """
+        split a sweep into sub-sequences that each fit into the device memory
+
+        seq_tbased is the sequence of the whole sweep over num_item points and
+        build(idx_start, idx_stop) returns the sequence of the points
+        idx_start <= idx < idx_stop, including whatever every sub-sequence
+        needs besides the sweep points, e.g. references
+
+        returns a list of ((idx_start, idx_stop), CompiledSequence), a single
+        entry if the whole sweep fits; the sub-sequences are uploaded and
+        streamed one after another by the measurement
+        """
+        if not isinstance(seq_tbased, CompiledSequence):
+            seq_tbased = self.compile(seq_tbased)
+        num_pulse = self.estimatePulses(seq_tbased)
+        if num_pulse <= max_pulses:
+            return [((0, num_item), seq_tbased)]
+        # equal chunks, more of them until the largest one fits
+        num_chunk = -(-num_pulse // max_pulses)
+        num_chunk = min(num_chunk, num_item)
+        while True:
+            bounds = np.linspace(0, num_item, num_chunk + 1).astype(int)
+            chunks = []
+            for idx_start, idx_stop in zip(bounds[:-1], bounds[1:]):
+                seq_chunk = self.compile(build(int(idx_start), int(idx_stop)))
+                num_pulse_chunk = self.estimatePulses(seq_chunk)
+                if num_pulse_chunk > max_pulses:
+                    break
+                chunks.append(((int(idx_start), int(idx_stop)), seq_chunk))
+            else:
+                logger.info(
+                    f"Sequence of {num_pulse} pulses split into {num_chunk} sub-sequences of at most {max_pulses} pulses"
+                )
+                return chunks
+            if num_chunk == num_item:
+                break
+            num_chunk = min(
+                max(num_chunk + 1, -(-num_pulse_chunk * num_chunk // max_pulses)),
+                num_item,
+            )
+        raise SequenceError(
+            f"A single sweep point needs more than the {max_pulses} pulses the Pulse Streamer holds"
+        )
+
+    def setSequence(self, seq_tbased, reset=False, compact=True):
         """
         set sequence directly using time-based sequence
         for example
@@ -523,45 +1099,131 @@ class PulseGenerator(PulseStreamer):
                             (["mw_B", "laser"], 300),
                             (["laser"], 300)
                          ]
+        or the same sequence as a CompiledSequence or a hardware.pulser.builder tree
+
+        with compact=True, every channel's steps are run-length merged before the
+        upload, since upload time and device memory scale with the pulse count
         """
-        verify_sequence(seq_tbased, self.getValidChNames(), allow_zero_duration=True)
         start = time.time()
-        all_timestamps = [value for _, value in seq_tbased]
-        total_time = sum(all_timestamps)
-        assert total_time // 1 == total_time, (
-            "Sequence Duration must be Int since base unit is 1ns"
-        )
-
-        ch_all = set()
-        for channels, duration in seq_tbased:
-            ch_all.update(channels)
+        seq_comp = self._compileNonEmpty(seq_tbased)
+        total_time = seq_comp.total_time
         end = time.time()
-        logger.debug(f"Time taken for summarizing channels: {end - start:.4f} seconds")
+        logger.debug(f"Time taken for compiling sequence: {end - start:.4f} seconds")
 
         start_time = time.time()
         if reset:
             self.resetSeq()
-        self.seq._Sequence__sequence_up_to_date = False
-        for ch in ch_all:
-            if self.choffs[ch] >= 0:
-                ch_state = [LOW]
-                timeline = np.array([self.choffs[ch]] + all_timestamps, dtype=np.int64)
-            else:
-                ch_state = []
-                timeline = np.array(all_timestamps, dtype=np.int64)
-            for channels, duration in seq_tbased:
-                chstate = HIGH if ch in channels else LOW
-                ch_state.append(chstate)
-            self.seq._Sequence__channel_digital[self.chmap[ch]] = (
-                timeline,
-                np.array(ch_state, dtype=np.int64),
-                np.cumsum(timeline),
-            )
+        else:
+            self._modifySeq()
+        self.compression = self._fillSequence(self.seq, seq_comp, compact)
         end_time = time.time()
         logger.debug(
             f"Time taken for setting digital channels: {end_time - start_time:.4f} seconds"
         )
-        logger.info(f"Set Sequence total time {total_time} ns")
+        return total_time
+
+    def _compileNonEmpty(self, seq_tbased):
+        if isinstance(seq_tbased, CompiledSequence):
+            seq_comp = seq_tbased
+        else:
+            seq_comp = self.compile(seq_tbased)
+        if len(seq_comp) == 0:
+            raise SequenceError("Sequence is empty")
+        return seq_comp
+
+    def _fillSequence(self, seq, seq_comp, compact=True):
+        # write the digital channels of a compiled sequence into a pulsestreamer Sequence
+        seq._Sequence__sequence_up_to_date = False
+        num_step = 0
+        num_step_compact = 0
+        for ch in seq_comp.channels:
+            # every channel starts LOW for its offset, then follows the steps
+            timeline = np.empty(len(seq_comp) + 1, dtype=np.int64)
+            timeline[0] = self.choffs[ch]
+            timeline[1:] = seq_comp.durations
+            ch_state = np.empty(len(seq_comp) + 1, dtype=np.int64)
+            ch_state[0] = LOW
+            ch_state[1:] = seq_comp.states(ch)
+            num_step += len(timeline)
+            if compact:
+                timeline, ch_state = compact_pattern(timeline, ch_state)
+            num_step_compact += len(timeline)
+            seq._Sequence__channel_digital[ch] = (
+                timeline,
+                ch_state,
+                np.cumsum(timeline),
+            )
+        compression = num_step / max(num_step_compact, 1)
+        logger.info(
+            f"Set Sequence total time {seq_comp.total_time} ns, {num_step_compact} channel steps ({compression:.1f}x compression)"
+        )
+        return compression
+
+    def stageSequence(self, seq_tbased, compact=True):
+        """
+        build the device sequence of `seq_tbased` in a background thread
+        while the current sequence keeps running
+
+        the channels are compiled and joined into the final pulse list ahead of
+        time, so swapSequence() only has to upload and start it
+        """
+        staged = dict(source=seq_tbased, seq=None, error=None)
+
+        def build():
+            try:
+                start = time.perf_counter()
+                seq_comp = self._compileNonEmpty(seq_tbased)
+                seq = Sequence()
+                staged["compression"] = self._fillSequence(seq, seq_comp, compact)
+                seq.getData(as_ndarray=True)  # join the channels, cached in seq
+                staged["seq"] = seq
+                staged["total_time"] = seq_comp.total_time
+                logger.debug(
+                    f"Staged sequence in {time.perf_counter() - start:.4f} seconds"
+                )
+            except Exception as ee:
+                staged["error"] = ee
+
+        staged["thread"] = threading.Thread(
+            target=build, name="StageSequence", daemon=True
+        )
+        staged["thread"].start()
+        self._staged = staged
+
+    def swapSequence(
+        self,
+        seq_tbased=None,
+        n_runs=1,
+        state_i=OutputState.ZERO(),
+        state_f=OutputState.ZERO(),
+    ):
+        """
+        make the staged sequence the current one and stream it
+
+        if `seq_tbased` is given and is not the staged sequence, it is set
+        right away instead, as setSequence(seq_tbased, reset=True) would;
+        with a software trigger the new block starts at startNow(), which
+        reports the dead time since the last forceFinal()
+
+        returns the total time of the sequence in ns
+        """
+        staged, self._staged = self._staged, None
+        if staged is None or (
+            seq_tbased is not None and staged["source"] is not seq_tbased
+        ):
+            if seq_tbased is None:
+                raise SequenceError("No sequence staged")
+            logger.info("Sequence was not staged, setting it now")
+            total_time = self.setSequence(seq_tbased, reset=True)
+        else:
+            staged["thread"].join()
+            if staged["error"] is not None:
+                raise staged["error"]
+            self.seq = staged["seq"]
+            self.seq_key = None
+            self.compression = staged["compression"]
+            total_time = staged["total_time"]
+        self.stream(n_runs=n_runs, state_i=state_i, state_f=state_f)
         return total_time
 
     def close(self):
@@ -0,0 +1,192 @@
+"""
+Shadow copy of the instrument settings to skip redundant writes
+
+Every measurement sends its full instrument configuration in _setup_exp, also
+when a preempted job resumes with the same settings. Each of those writes is a
+round trip over a serial or USB link. The ShadowState wraps the setter methods
+of the instruments, remembers the last value each one applied and skips a call
+that would apply the same value again.
+
+The wrapped setters and the value they apply are listed in SHADOW_RULES. Each
+rule has the signature of the setter and returns (key, value), with the value
+formatted the way the instrument receives it, e.g. the laser current to two
+decimals. Methods that leave the instrument in an unknown state (reset, open,
+close, sweeps, ...) are listed in SHADOW_INVALIDATE and drop the shadow copy of
+their instrument.
+
+Author: ChunTung Cheung
+Email: ctcheung1123@gmail.com
+Created:  2026-10-18
+"""
+
+import functools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# HardwareManager attribute -> {setter: rule(*args, **kwargs) -> (key, value)}
+SHADOW_RULES = dict(
+    laser=dict(
+        set_laser_emission_activation=lambda on: ("emission", bool(on)),
+        set_analog_control_mode=lambda mode: ("control_mode", mode.lower()),
+        set_modulation_state=lambda state: ("modulation", state.lower()),
+        set_diode_current_realtime=lambda current_percent: (
+            "current",
+            f"{current_percent:.2f}",
+        ),
+        set_laser_power_realtime=lambda power: ("power", f"{power:.1f}"),
+    ),
+    mwsyn=dict(
+        cw_frequency=lambda *args, **kwargs: (
+            "freq",
+            (args, tuple(sorted(kwargs.items()))),
+        ),
+    ),
+    mwmod=dict(
+        set_amp_volt=lambda voltage: ("amp_volt", float(voltage)),
+        set_phase_volt=lambda voltage: ("phase_volt", float(voltage)),
+    ),
+    windfreak=dict(
+        set_freq=lambda freq_hz, channel=0, log_it=False: (
+            ("freq", channel),
+            float(freq_hz),
+        ),
+        set_power=lambda power_dbm, channel=0, log_it=False: (
+            ("power", channel),
+            float(power_dbm),
+        ),
+    ),
+)
+
+# HardwareManager attribute -> methods after which the shadow copy is dropped
+SHADOW_INVALIDATE = dict(
+    laser=(
+        "open",
+        "close",
+        "reset_alarm",
+        "set_diode_current_memory",
+        "set_laser_power_memory",
+    ),
+    mwsyn=(
+        "open",
+        "close",
+        "close_gracefully",
+        "reboot",
+        "simple_sweep",
+        "sweep",
+        "sweep_continue",
+        "sweep_up",
+        "sweep_down",
+        "sweep_direction",
+        "sweep_pause",
+        "reset_trigger",
+    ),
+    mwmod=("close", "restart"),
+    windfreak=("connect", "disconnect", "close", "set_phase", "set_reference"),
+)
+
+# setters whose None return means the instrument did not confirm the value
+SHADOW_CONFIRMED = dict(mwsyn=("cw_frequency",))
+
+
+class ShadowState:
+    """
+    Last applied value of every shadowed instrument setting.
+
+    Attributes:
+        num_sent (int): setter calls that went to an instrument.
+        num_skip (int): setter calls skipped because the value was already applied.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = dict()  # (name, key) -> (value, result of the setter)
+        self._wrapped = dict()  # name -> (instance, names of the wrapped methods)
+        self.num_sent = 0
+        self.num_skip = 0
+
+    def attach(self, name, instance):
+        """
+        Wraps the methods of `instance` that SHADOW_RULES and SHADOW_INVALIDATE list for `name`.
+
+        Parameters:
+            name (str): the HardwareManager attribute of the instrument, e.g. "laser".
+            instance: the instrument controller.
+        """
+        if instance is None or name in self._wrapped:
+            return
+        methods = []
+        confirmed = SHADOW_CONFIRMED.get(name, ())
+        for method, rule in SHADOW_RULES.get(name, dict()).items():
+            if hasattr(instance, method):
+                wrapper = self._setter(
+                    name, getattr(instance, method), rule, method in confirmed
+                )
+                setattr(instance, method, wrapper)
+                methods.append(method)
+        for method in SHADOW_INVALIDATE.get(name, ()):
+            if hasattr(instance, method):
+                setattr(
+                    instance, method, self._invalidator(name, getattr(instance, method))
+                )
+                methods.append(method)
+        self._wrapped[name] = (instance, methods)
+        logger.debug(f"Shadow state attached to '{name}': {methods}")
+
+    def detach(self):
+        """Restores the original methods of all instruments and drops the shadow copy."""
+        for instance, methods in self._wrapped.values():
+            for method in methods:
+                # the wrapper lives in the instance dict, the original on the class
+                instance.__dict__.pop(method, None)
+        self._wrapped.clear()
+        self.invalidate()
+
+    def invalidate(self, name=None):
+        """
+        Drops the shadow copy of one instrument, or of all with `name` None,
+        e.g. after a setting was changed on the front panel.
+        """
+        with self._lock:
+            if name is None:
+                self._state.clear()
+            else:
+                for entry in [ee for ee in self._state if ee[0] == name]:
+                    del self._state[entry]
+
+    def _setter(self, name, func, rule, confirmed):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key, value = rule(*args, **kwargs)
+            with self._lock:
+                applied = self._state.get((name, key))
+                if applied is not None and applied[0] == value:
+                    self.num_skip += 1
+                    logger.debug(f"Skipped {name}.{func.__name__}, {key} is {value}")
+                    return applied[1]
+                # unknown until the call returns, e.g. if it raises
+                self._state.pop((name, key), None)
+            result = func(*args, **kwargs)
+            with self._lock:
+                self.num_sent += 1
+                if not (confirmed and result is None):
+                    self._state[(name, key)] = (value, result)
+            return result
+
+        return wrapper
+
+    def _invalidator(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.invalidate(name)
+
+        return wrapper
+
+    def as_dict(self, prefix="shadow_"):
+        """Flat dictionary of the counters, e.g. to put into a measurement's stateset."""
+        stats = dict(num_sent=self.num_sent, num_skip=self.num_skip)
+        return {prefix + key: value for key, value in stats.items()}
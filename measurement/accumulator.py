@@ -0,0 +1,352 @@
+"""
+Accumulate streamed digitizer segments into a ring of per-slot sums.
+
+A pulse sequence with `num_slot` readouts produces segments in the order
+slot 0, 1, ..., num_slot-1, 0, 1, ... while the digitizer delivers them in
+blocks whose length is unrelated to `num_slot`. Every block therefore starts
+at an arbitrary slot (the pointer) and may wrap around the ring many times.
+The SegmentAccumulator folds such a block into the per-slot sums and counts
+with a fixed number of in-place numpy operations, whatever the block length.
+
+Raw int16 ADC codes can be summed exactly into integer sums and converted to
+voltage once when the data is organized. int64 sums never overflow in
+practice; int32 sums halve the memory traffic and are flushed into an int64
+bank before a slot could overflow.
+
+Sums and counts give the mean of every slot but not its uncertainty. With
+`stats=True` the accumulator also keeps a RunningStats of the integrated
+value of every segment. Each block's per-slot count, mean and spread is
+merged into the running mean and variance with Chan's parallel update. That
+gives error bars and lets a measurement decide when a point is good enough,
+without keeping any raw segment. Integrating every segment reads the block a
+second time, so the measurements keep statistics only when asked for error bars.
+
+Run this file directly for a small benchmark against a per-segment reference.
+
+Author: ChunTung Cheung
+Email: ctcheung1123@gmail.com
+Created:  2026-10-18
+"""
+
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# number of int16 codes that surely fit into an int32 sum
+INT32_SAFE_COUNT = (2**31 - 1) // 2**15
+
+
+class RunningStats:
+    """
+    Per-slot running mean and variance, merged a block of values at a time.
+
+    Parameters:
+        num_slot (int): number of slots.
+
+    Attributes:
+        count (np.ndarray): number of values added to each slot.
+        mean (np.ndarray): mean of the values of each slot.
+        m2 (np.ndarray): sum of the squared deviations from the mean of each slot.
+    """
+
+    def __init__(self, num_slot):
+        self.num_slot = int(num_slot)
+        self.reset()
+
+    def reset(self):
+        self.count = np.zeros(self.num_slot, dtype=np.float64)
+        self.mean = np.zeros(self.num_slot, dtype=np.float64)
+        self.m2 = np.zeros(self.num_slot, dtype=np.float64)
+
+    @property
+    def var(self):
+        """Sample variance of the values of each slot, zero below two values."""
+        return np.divide(
+            self.m2,
+            self.count - 1.0,
+            out=np.zeros(self.num_slot),
+            where=self.count > 1,
+        )
+
+    @property
+    def sem(self):
+        """Standard error of the mean of each slot."""
+        return np.sqrt(
+            np.divide(
+                self.var, self.count, out=np.zeros(self.num_slot), where=self.count > 0
+            )
+        )
+
+    def merge(self, count, mean, m2):
+        """Merges the count, mean and m2 of another set of values per slot (Chan et al.)."""
+        total = self.count + count
+        ratio = np.divide(count, total, out=np.zeros(self.num_slot), where=total > 0)
+        delta = mean - self.mean
+        self.m2 += m2 + delta**2 * self.count * ratio
+        self.mean += delta * ratio
+        self.count = total
+
+    def add(self, values, slots):
+        """
+        Adds a block of values.
+
+        Parameters:
+            values (np.ndarray): 1D array of values.
+            slots (np.ndarray | int): slot of every value, or one slot for all of them.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        count = np.zeros(self.num_slot)
+        mean = np.zeros(self.num_slot)
+        m2 = np.zeros(self.num_slot)
+        if np.ndim(slots) == 0:
+            count[slots] = values.size
+            mean[slots] = np.mean(values)
+            m2[slots] = np.sum((values - mean[slots]) ** 2)
+        else:
+            count += np.bincount(slots, minlength=self.num_slot)
+            sums = np.bincount(slots, weights=values, minlength=self.num_slot)
+            np.divide(sums, count, out=mean, where=count > 0)
+            m2 += np.bincount(
+                slots, weights=(values - mean[slots]) ** 2, minlength=self.num_slot
+            )
+        self.merge(count, mean, m2)
+
+
+class SegmentAccumulator:
+    """
+    Ring of per-slot segment sums fed by blocks of digitizer segments.
+
+    Parameters:
+        num_slot (int): number of segments in one repetition of the sequence.
+        segment_size (int | None): samples per segment; None keeps one scalar per slot.
+        dtype: data type of the per-slot sums, e.g. np.float64 for voltages or
+            np.int64 / np.int32 for raw ADC codes.
+        reducer (callable | None): maps a (num_seg, segment_size) block to
+            (num_seg,) values before folding, e.g. a weighted integration.
+            It must be linear for the sums to equal the reduction of the sums.
+        stats (bool): also keep the running mean and variance of every slot.
+        stats_reducer (callable | None): maps a block to one value per segment for
+            the statistics, needed for whole segments without a `reducer`.
+
+    Attributes:
+        store (np.ndarray): per-slot sums, shape (num_slot,) or (num_slot, segment_size).
+            With int32 sums this only holds the part since the last flush, use sums().
+        count (np.ndarray): number of segments added to each slot.
+        pointer (int): slot that the next incoming segment belongs to.
+        stats (RunningStats | None): per-slot mean and variance of the reduced
+            segments, in the unit of the reduced values (e.g. ADC codes).
+    """
+
+    def __init__(
+        self,
+        num_slot,
+        segment_size=None,
+        dtype=np.float64,
+        reducer=None,
+        stats=False,
+        stats_reducer=None,
+    ):
+        self.num_slot = int(num_slot)
+        self.segment_size = segment_size
+        self.reducer = reducer
+        if stats and segment_size is not None and reducer is stats_reducer is None:
+            raise ValueError("Statistics of whole segments need a 'stats_reducer'")
+        self.stats_reducer = stats_reducer
+        self.stats = RunningStats(self.num_slot) if stats else None
+        shape = (
+            (self.num_slot,)
+            if segment_size is None
+            else (self.num_slot, int(segment_size))
+        )
+        self.store = np.zeros(shape, dtype=dtype, order="C")
+        self.count = np.zeros(self.num_slot, dtype=np.float64, order="C")
+        self.pointer = 0
+        self._scratch = None
+        # int32 sums are flushed into an int64 bank before they can overflow
+        self._bank = (
+            np.zeros(shape, dtype=np.int64)
+            if np.dtype(dtype) == np.int32 and reducer is None
+            else None
+        )
+        self._num_unflushed = 0
+
+    def reset(self):
+        self.store[:] = 0
+        self.count[:] = 0
+        self.pointer = 0
+        if self._bank is not None:
+            self._bank[:] = 0
+        self._num_unflushed = 0
+        if self.stats is not None:
+            self.stats.reset()
+
+    def flush(self):
+        """Moves the int32 sums into the int64 bank."""
+        if self._bank is not None:
+            self._bank += self.store
+            self.store[:] = 0
+            self._num_unflushed = 0
+
+    def sums(self):
+        """Complete per-slot sums, including the int64 bank of int32 sums."""
+        if self._bank is None:
+            return self.store
+        return self._bank + self.store
+
+    @property
+    def num_repeat(self):
+        """Number of complete passes over the ring."""
+        return self.count[-1]
+
+    def skip(self, num_seg):
+        """Advances the pointer past segments that were lost before reaching the ring."""
+        self.pointer = (self.pointer + int(num_seg)) % self.num_slot
+
+    def add(self, block, store=None, count=None):
+        """
+        Folds a block of consecutive segments into the ring and advances the pointer.
+
+        Parameters:
+            block (np.ndarray): segments along the first axis, any trailing shape
+                that flattens to the segment size (e.g. (num_seg, segment_size, 1)).
+            store (np.ndarray | None): alternative sums to fold into, same shape as `store`.
+            count (np.ndarray | None): alternative counts to fold into, same shape as `count`.
+
+        Returns:
+            int: number of segments folded.
+        """
+        store = self.store if store is None else store
+        count = self.count if count is None else count
+        num_seg = block.shape[0]
+        if num_seg == 0:
+            return 0
+        if self.reducer is None:
+            data = np.reshape(block, (num_seg,) + store.shape[1:])
+        else:
+            data = self.reducer(np.reshape(block, (num_seg, -1)))
+
+        num_slot = self.num_slot
+        idx_i = self.pointer
+        if self.stats is not None:
+            values = (
+                data
+                if data.ndim == 1
+                else self.stats_reducer(np.reshape(block, (num_seg, -1)))
+            )
+            self.stats.add(values, (idx_i + np.arange(num_seg)) % num_slot)
+        if self._bank is not None and store is self.store:
+            # a slot receives at most this many segments from one block
+            num_per_slot = -(-num_seg // num_slot)
+            if self._num_unflushed + num_per_slot > INT32_SAFE_COUNT:
+                self.flush()
+            self._num_unflushed += num_per_slot
+        # fill from the pointer up to the end of the ring ----------------
+        num_head = min(num_slot - idx_i, num_seg)
+        store[idx_i : idx_i + num_head] += data[:num_head]
+        count[idx_i : idx_i + num_head] += 1
+        # add the complete passes over the ring ----------------
+        num_wrap, num_tail = divmod(num_seg - num_head, num_slot)
+        if num_wrap:
+            wraps = data[num_head : num_head + num_wrap * num_slot]
+            if num_wrap == 1:
+                store += wraps
+            else:
+                # reduce the passes into a reused buffer instead of a fresh array
+                if self._scratch is None or self._scratch.shape != store.shape:
+                    self._scratch = np.empty_like(store)
+                np.add.reduce(
+                    np.reshape(wraps, (num_wrap,) + store.shape),
+                    axis=0,
+                    out=self._scratch,
+                )
+                store += self._scratch
+            count += num_wrap
+        # fill the head of the ring with the remaining segments ----------------
+        if num_tail:
+            store[:num_tail] += data[num_seg - num_tail :]
+            count[:num_tail] += 1
+
+        self.pointer = (idx_i + num_seg) % num_slot
+        return num_seg
+
+
+def _add_reference(store, count, pointer, block):
+    """Per-segment fold used to check and benchmark SegmentAccumulator.add."""
+    num_slot = store.shape[0]
+    data = np.reshape(block, (block.shape[0],) + store.shape[1:])
+    for seg in data:
+        store[pointer] += seg
+        count[pointer] += 1
+        pointer = (pointer + 1) % num_slot
+    return pointer
+
+
+def benchmark(
+    num_slot=202, segment_size=1024, num_seg=4096, num_block=20, dtype=np.float64
+):
+    rng = np.random.default_rng(0)
+    blocks = [
+        rng.integers(-(2**15), 2**15, size=(num_seg, segment_size, 1), dtype=np.int16)
+        for _ in range(num_block)
+    ]
+
+    acc = SegmentAccumulator(num_slot, segment_size, dtype=dtype)
+    start = time.perf_counter()
+    for block in blocks:
+        acc.add(block)
+    t_acc = time.perf_counter() - start
+
+    store = np.zeros((num_slot, segment_size))
+    count = np.zeros(num_slot)
+    pointer = 0
+    start = time.perf_counter()
+    for block in blocks:
+        pointer = _add_reference(store, count, pointer, block)
+    t_ref = time.perf_counter() - start
+
+    assert np.array_equal(acc.sums(), store)
+    assert np.array_equal(acc.count, count)
+    assert acc.pointer == pointer
+    rate = num_block * num_seg / t_acc
+    print(
+        f"{num_block} blocks of {num_seg} segments x {segment_size} samples into {num_slot} {np.dtype(dtype)} slots"
+    )
+    print(f"   SegmentAccumulator: {t_acc * 1e3:.1f} ms ({rate:.3g} segments/s)")
+    print(f"   per-segment loop:   {t_ref * 1e3:.1f} ms ({t_ref / t_acc:.1f}x slower)")
+
+    # the same blocks with per-slot statistics of the integrated segments
+    from measurement.integration import IntegrationKernel
+
+    kernel = IntegrationKernel(signal_range=(segment_size // 4, segment_size // 2))
+    acc = SegmentAccumulator(
+        num_slot, segment_size, dtype=dtype, stats=True, stats_reducer=kernel
+    )
+    start = time.perf_counter()
+    for block in blocks:
+        acc.add(block)
+    t_stats = time.perf_counter() - start
+    values = np.concatenate([kernel(np.reshape(bb, (num_seg, -1))) for bb in blocks])
+    slots = np.arange(values.size) % num_slot
+    var = [np.var(values[slots == kk], ddof=1) for kk in range(num_slot)]
+    assert np.allclose(acc.stats.var, var)
+    assert np.allclose(acc.stats.mean * acc.count, kernel(acc.sums()))
+    print(f"   with statistics:    {t_stats * 1e3:.1f} ms ({t_stats / t_acc:.2f}x)")
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+
+    # the project root, for the measurement package when run as a script
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    benchmark()
+    benchmark(dtype=np.int64)
+    benchmark(dtype=np.int32)
+    benchmark(num_slot=8, segment_size=256, num_seg=32768)
+    benchmark(num_slot=4000, segment_size=512, num_seg=512)
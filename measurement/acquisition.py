@@ -0,0 +1,190 @@
+"""
+Background acquisition of digitizer blocks for the Measurement loop.
+
+The AcquisitionWorker owns the reads from the digitizer in its own thread and
+copies every notify block into a ring of preallocated buffers. The measurement
+thread only consumes blocks from that ring, so draining the card's DMA buffer
+never waits on `_organize_data` or on the GUI. When the measurement falls so
+far behind that the ring is full, new blocks are dropped and counted as
+overruns instead of letting the card's FIFO overflow. The number of dropped
+segments travels with the next buffered block, so the consumer can advance its
+slot pointer and stay aligned with the pulse sequence.
+
+Author: ChunTung Cheung
+Email: ctcheung1123@gmail.com
+Created:  2026-10-18
+"""
+
+import logging
+import threading
+
+import numpy as np
+
+from measurement.task_base import StoppableThread
+
+logger = logging.getLogger(__name__)
+
+
+class AcquisitionWorker:
+    """
+    Reads raw blocks from a FIFO_DataAcquisition in a thread into a bounded ring.
+
+    Parameters:
+        dig: the digitizer, anything with stream_raw() and release().
+        num_buffer (int): number of blocks the ring can hold.
+
+    Attributes:
+        num_block (int): blocks read from the digitizer.
+        num_overrun (int): blocks dropped because the ring was full.
+        max_fill (int): highest number of blocks waiting in the ring.
+    """
+
+    def __init__(self, dig, num_buffer=16):
+        self.dig = dig
+        self.num_buffer = int(num_buffer)
+        self._ring = None
+        self._idx_head = 0  # next slot to write
+        self._idx_tail = 0  # next slot to read
+        self._fill = 0
+        self._skip = np.zeros(self.num_buffer, dtype=np.int64)
+        self._num_skip_pending = 0  # segments dropped since the last buffered block
+        self._lock = threading.Condition()
+        self._thread = None
+        self.num_block = 0
+        self.num_overrun = 0
+        self.max_fill = 0
+
+    @property
+    def fill(self):
+        """Number of blocks waiting in the ring."""
+        return self._fill
+
+    def start(self):
+        self._thread = StoppableThread(
+            target=self._run, name=self.__class__.__name__ + str(id(self))
+        )
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=10.0):
+        if self._thread is not None:
+            self._thread.stop(timeout=timeout)
+            self._thread = None
+        if self.num_overrun:
+            logger.warning(
+                f"Acquisition dropped {self.num_overrun} of {self.num_block} blocks"
+            )
+
+    def as_dict(self, prefix="acq_"):
+        """Flat dictionary of the counters, e.g. to put into a measurement's stateset."""
+        stats = dict(
+            num_block=self.num_block,
+            num_overrun=self.num_overrun,
+            fill=self._fill,
+            max_fill=self.max_fill,
+        )
+        return {prefix + key: value for key, value in stats.items()}
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _allocate(self, data_block):
+        self._ring = np.empty(
+            (self.num_buffer,) + data_block.shape, dtype=data_block.dtype
+        )
+        logger.debug(
+            f"Allocated acquisition ring of {self.num_buffer} x {data_block.shape} {data_block.dtype}"
+        )
+
+    def _run(self):
+        stop_request = self._thread.stop_request
+        while not stop_request.is_set():
+            data_raw = self.dig.stream_raw()
+            if data_raw is None:
+                continue
+            data_block = data_raw[0]
+            self.num_block += 1
+            if self._ring is None or self._ring.shape[1:] != data_block.shape:
+                with self._lock:
+                    if self._fill:
+                        # a different block size only happens after a reconfiguration
+                        logger.warning("Block size changed, dropping buffered blocks")
+                        self.num_overrun += self._fill
+                        self._fill = 0
+                        self._idx_tail = self._idx_head
+                    self._allocate(data_block)
+            with self._lock:
+                full = self._fill == self.num_buffer
+                if full:
+                    self.num_overrun += 1
+                    self._num_skip_pending += data_block.shape[0]
+            if full:
+                self.dig.release()
+                if self.num_overrun == 1 or self.num_overrun % 100 == 0:
+                    logger.warning(
+                        f"Acquisition ring full, {self.num_overrun} blocks dropped so far"
+                    )
+                continue
+            # the slot is not visible to the consumer until the fill is increased
+            np.copyto(self._ring[self._idx_head], data_block)
+            self.dig.release()
+            with self._lock:
+                self._skip[self._idx_head] = self._num_skip_pending
+                self._num_skip_pending = 0
+                self._idx_head = (self._idx_head + 1) % self.num_buffer
+                self._fill += 1
+                self.max_fill = max(self.max_fill, self._fill)
+                self._lock.notify()
+
+    def drain(self, timeout=0.0):
+        """
+        Yields (num_skip, block) for the buffered blocks in the order they were
+        acquired, where num_skip is the number of segments dropped right before
+        the block.
+
+        Each block is a view into the ring and is only valid until the next
+        iteration. Waits up to `timeout` seconds for the first block. Only the
+        blocks already buffered are yielded, so a fast card cannot keep the
+        consumer from returning.
+        """
+        with self._lock:
+            if not self._fill and timeout:
+                self._lock.wait(timeout)
+            num_ready = self._fill
+        for _ in range(num_ready):
+            with self._lock:
+                num_skip = int(self._skip[self._idx_tail])
+                data_block = self._ring[self._idx_tail]
+            yield num_skip, data_block
+            with self._lock:
+                self._idx_tail = (self._idx_tail + 1) % self.num_buffer
+                self._fill -= 1
+
+
+def stream_telemetry(dig, worker=None):
+    """Digitizer stream counters, plus the acquisition ring counters if there is a worker."""
+    telemetry = dig.stats.as_dict()
+    if worker is not None:
+        telemetry.update(worker.as_dict())
+    return telemetry
+
+
+def iter_raw_blocks(dig, worker=None, accumulator=None):
+    """
+    Yields the raw blocks that are ready, from the worker's ring if there is one,
+    otherwise a single block read directly from the digitizer.
+
+    Segments the worker had to drop are skipped in `accumulator`, so the next
+    block lands on the right slots. The blocks are only valid until the next
+    iteration.
+    """
+    if worker is not None:
+        for num_skip, data_block in worker.drain():
+            if num_skip and accumulator is not None:
+                accumulator.skip(num_skip)
+            yield data_block
+        return
+    data_raw = dig.stream_raw()
+    if data_raw is not None:
+        yield data_raw[0]
+        dig.release()
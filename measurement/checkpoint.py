@@ -0,0 +1,474 @@
+"""
+Checkpoints of a measurement as a directory of arrays and a JSON manifest.
+
+The dill backup of a whole instance serializes every attribute twice, once to
+test it and once to write it, including the segment stores of hundreds of MB.
+A checkpoint instead writes every numeric array to its own .npy file and the
+small state to state.json:
+
+    <name>.ckpt/
+        state.json                   class, attributes and the array table
+        objects.pkl                  small objects without a JSON form (dill)
+        dataset.signal-<digest>.npy  one file per array, named by its content
+
+Attributes are encoded recursively: dicts, lists and plain objects are walked
+down to their arrays, so e.g. the store of an accumulator is an array file of
+its own. Scratch buffers of nested objects (SCRATCH_ATTRS) are left out, and
+an attribute that holds a runtime handle (RUNTIME_TYPES), e.g. a thread or a
+lock, is not stored at all. An array whose content did not change since the
+last checkpoint keeps its file and is not written again, and arrays with the
+same content share one file, e.g. the dataset and the initial dataset of a
+measurement. Loading maps the array files copy-on-write, so they are only read
+from the disk when they are used. A file that can not be removed yet, e.g. while it is mapped on Windows,
+stays listed in the manifest and is removed by a later checkpoint.
+
+For autosaves during a run, take_snapshot(copy=True) copies the arrays in the
+measurement thread and the shared checkpoint_writer writes them from a
+background thread.
+
+Author: ChunTung Cheung
+Email: ctcheung1123@gmail.com
+Created:  2026-10-18
+"""
+
+import hashlib
+import importlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import types
+
+import dill
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_EXT = ".ckpt"
+MANIFEST_FN = "state.json"
+OBJECTS_FN = "objects.pkl"
+FORMAT_VERSION = 2  # 2: objects.pkl is a list with one pickle per object
+
+# attributes of nested objects that only hold buffers rebuilt on demand, stored as None
+SCRATCH_ATTRS = ("_scratch",)
+
+# runtime handles that can not be restored, an attribute holding one is not stored
+RUNTIME_TYPES = (
+    threading.Thread,
+    type(threading.Lock()),
+    type(threading.RLock()),
+    threading.Condition,
+    threading.Event,
+    threading.Semaphore,
+    types.MethodType,
+)
+
+
+def _digest(arr):
+    # hash the raw bytes without a copy for contiguous arrays, arrays with the
+    # same bytes but another dtype or shape must not share a file
+    digest = hashlib.blake2b(f"{arr.dtype.str}{arr.shape}".encode(), digest_size=16)
+    digest.update(memoryview(np.ascontiguousarray(arr)).cast("B"))
+    return digest.hexdigest()
+
+
+def _class_path(cls):
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def _import_class(path):
+    module, qualname = path.split(":")
+    obj = importlib.import_module(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _is_plain_object(value):
+    """Objects rebuilt from their __dict__, i.e. without a custom pickling protocol."""
+    cls = type(value)
+    return (
+        hasattr(value, "__dict__")
+        and not isinstance(value, type)
+        and not callable(value)
+        and cls.__reduce_ex__ is object.__reduce_ex__
+        and getattr(cls, "__getstate__", None) is getattr(object, "__getstate__", None)
+        and "<locals>" not in cls.__qualname__
+    )
+
+
+class _Encoder:
+    """Splits the attributes into JSON nodes, array files and pickled leaves."""
+
+    def __init__(self):
+        self.arrays = dict()  # key -> array
+        self.leaves = []  # pickles of the objects that go to objects.pkl
+        self._memo = dict()  # id -> node of the arrays and objects seen so far
+        self._keep = []  # keeps the memoized objects alive, their ids stay unique
+
+    def encode(self, value, path):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, np.generic) and value.dtype.kind in "biuf":
+            return value.item()
+        if id(value) in self._memo:
+            return self._memo[id(value)]
+        if isinstance(value, RUNTIME_TYPES):
+            # e.g. an acquisition thread with its lock and the hardware it reads,
+            # pickling a bound method would serialize its whole instance as well
+            raise TypeError(f"Cannot store {value!r}")
+        if isinstance(value, np.ndarray) and value.dtype.kind in "biufc":
+            key = re.sub(r"[^\w.\-]", "_", path)
+            self.arrays[key] = value
+            node = {"__array__": key}
+        elif isinstance(value, dict) and all(isinstance(kk, str) for kk in value):
+            node = {
+                "__dict__": {
+                    kk: self.encode(vv, f"{path}.{kk}") for kk, vv in value.items()
+                }
+            }
+        elif isinstance(value, (list, tuple)):
+            items = [self.encode(vv, f"{path}.{ii}") for ii, vv in enumerate(value)]
+            node = {"__tuple__": items} if isinstance(value, tuple) else items
+            return node  # containers are not shared between attributes
+        elif _is_plain_object(value):
+            node = {"__object__": _class_path(type(value)), "id": len(self._keep)}
+            self._memo[id(value)] = {"__ref__": node["id"]}
+            self._keep.append(value)
+            state = {
+                kk: None if kk in SCRATCH_ATTRS else vv
+                for kk, vv in value.__dict__.items()
+            }
+            node["state"] = self.encode(state, path)["__dict__"]
+            return node
+        else:
+            # raises for an unpicklable value, the pickle is kept so it is made only once
+            pickled = dill.dumps(value)
+            node = {"__pickle__": len(self.leaves)}
+            self.leaves.append(pickled)
+        self._memo[id(value)] = node
+        self._keep.append(value)
+        return node
+
+
+class _Decoder:
+    def __init__(self, dirname, table, leaves, lazy):
+        self.dirname = dirname
+        self.table = table
+        self.leaves = leaves
+        self.lazy = lazy
+        self._arrays = dict()
+        self._objects = dict()
+
+    def array(self, key):
+        if key not in self._arrays:
+            entry = self.table[key]
+            filename = os.path.join(self.dirname, entry["file"])
+            # copy-on-write: changes in memory never reach the checkpoint file
+            mmap_mode = "c" if self.lazy and np.prod(entry["shape"]) else None
+            self._arrays[key] = np.load(filename, mmap_mode=mmap_mode)
+        return self._arrays[key]
+
+    def decode(self, node):
+        if isinstance(node, list):
+            return [self.decode(nn) for nn in node]
+        if not isinstance(node, dict):
+            return node
+        if "__array__" in node:
+            return self.array(node["__array__"])
+        if "__dict__" in node:
+            return {kk: self.decode(vv) for kk, vv in node["__dict__"].items()}
+        if "__tuple__" in node:
+            return tuple(self.decode(nn) for nn in node["__tuple__"])
+        if "__pickle__" in node:
+            return self.leaves[node["__pickle__"]]
+        if "__ref__" in node:
+            return self._objects[node["__ref__"]]
+        cls = _import_class(node["__object__"])
+        obj = cls.__new__(cls)
+        self._objects[node["id"]] = obj  # before the state, for self-references
+        obj.__dict__.update({kk: self.decode(vv) for kk, vv in node["state"].items()})
+        return obj
+
+
+def _read_manifest(dirname):
+    filename = os.path.join(dirname, MANIFEST_FN)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def _write_manifest(dirname, manifest):
+    tmp = os.path.join(dirname, MANIFEST_FN + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(dirname, MANIFEST_FN))
+
+
+class Snapshot:
+    """
+    Encoded attributes of an instance, ready for write_snapshot().
+
+    Attributes:
+        cls (str): module:qualname of the class of the instance.
+        state (dict): the JSON nodes of the attributes.
+        arrays (dict): array key to array.
+        objects (list[bytes]): the pickle of every object without a JSON form.
+        time_snapshot (float): time taken by take_snapshot() in seconds.
+    """
+
+    def __init__(self, cls, state, arrays, objects, time_snapshot):
+        self.cls = cls
+        self.state = state
+        self.arrays = arrays
+        self.objects = objects
+        self.time_snapshot = time_snapshot
+
+
+def take_snapshot(instance, copy=False):
+    """
+    Encodes the attributes of `instance`, skipping those that cannot be stored
+    like save_instance does.
+
+    Parameters:
+        instance: the object to store, e.g. a Measurement.
+        copy (bool): copy the arrays, so the instance can go on changing them
+            while the snapshot is written from another thread.
+
+    Returns:
+        Snapshot
+    """
+    time_start = time.perf_counter()
+    encoder = _Encoder()
+    state = dict()
+    for key, value in instance.__dict__.items():
+        num_leaf, arrays, memo = (
+            len(encoder.leaves),
+            dict(encoder.arrays),
+            dict(encoder._memo),
+        )
+        try:
+            state[key] = encoder.encode(value, key)
+        except Exception:
+            logger.info(f"Skipping unstorable attribute: {key}")
+            # forget what the attribute had added so far
+            del encoder.leaves[num_leaf:]
+            encoder.arrays, encoder._memo = arrays, memo
+    arrays = encoder.arrays
+    if copy:
+        arrays = {key: np.array(arr, copy=True) for key, arr in arrays.items()}
+    return Snapshot(
+        _class_path(type(instance)),
+        state,
+        arrays,
+        encoder.leaves,
+        time.perf_counter() - time_start,
+    )
+
+
+def write_snapshot(snapshot, dirname):
+    """
+    Writes a snapshot to the checkpoint directory `dirname`, only the arrays
+    that changed since the last checkpoint are written.
+
+    Parameters:
+        snapshot (Snapshot): from take_snapshot().
+        dirname (str): the checkpoint directory, created if it does not exist.
+
+    Returns:
+        dict: num_array, num_written, bytes_written, time_snapshot and
+        time_write, the times in seconds.
+    """
+    time_start = time.perf_counter()
+    os.makedirs(dirname, exist_ok=True)
+    previous = _read_manifest(dirname)
+    previous = dict(arrays=dict()) if previous is None else previous
+    # content -> file, the arrays with the same content are stored once
+    files = {
+        entry["digest"]: entry["file"]
+        for entry in previous["arrays"].values()
+        if os.path.exists(os.path.join(dirname, entry["file"]))
+    }
+    table = dict()
+    num_written, bytes_written = 0, 0
+    for key, arr in snapshot.arrays.items():
+        digest = _digest(arr)
+        filename = files.setdefault(digest, f"{key}-{digest}.npy")
+        if not os.path.exists(os.path.join(dirname, filename)):
+            tmp = os.path.join(dirname, filename + ".tmp")
+            with open(tmp, "wb") as f:
+                np.save(f, arr)
+            os.replace(tmp, os.path.join(dirname, filename))
+            num_written += 1
+            bytes_written += arr.nbytes
+        table[key] = dict(
+            file=filename, digest=digest, dtype=arr.dtype.str, shape=list(arr.shape)
+        )
+
+    with open(os.path.join(dirname, OBJECTS_FN), "wb") as f:
+        dill.dump(snapshot.objects, f)
+
+    # the files of arrays that changed, and those a previous checkpoint failed to remove
+    current = {entry["file"] for entry in table.values()}
+    stale = {entry["file"] for entry in previous["arrays"].values()}
+    stale = sorted((stale | set(previous.get("stale", ()))) - current)
+    manifest = dict(
+        version=FORMAT_VERSION,
+        cls=snapshot.cls,
+        time=time.time(),
+        state=snapshot.state,
+        arrays=table,
+        stale=stale,
+    )
+    _write_manifest(dirname, manifest)
+
+    # a file that is still mapped, e.g. on Windows, is retried by the next checkpoint
+    remaining = []
+    for filename in stale:
+        try:
+            os.remove(os.path.join(dirname, filename))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            remaining.append(filename)
+    if remaining != stale:
+        manifest["stale"] = remaining
+        _write_manifest(dirname, manifest)
+
+    stats = dict(
+        num_array=len(table),
+        num_written=num_written,
+        bytes_written=bytes_written,
+        time_snapshot=snapshot.time_snapshot,
+        time_write=time.perf_counter() - time_start,
+    )
+    logger.debug(f"Checkpoint {dirname}: {stats}")
+    return stats
+
+
+def save_checkpoint(instance, dirname):
+    """
+    Writes the attributes of `instance` to the checkpoint directory `dirname`
+    in the calling thread, see take_snapshot() and write_snapshot().
+    """
+    return write_snapshot(take_snapshot(instance), dirname)
+
+
+def read_checkpoint(dirname, lazy=True):
+    """
+    Reads a checkpoint without creating an instance.
+
+    Parameters:
+        dirname (str): the checkpoint directory.
+        lazy (bool): map the array files instead of reading them.
+
+    Returns:
+        tuple: (class, dict of the attributes).
+    """
+    manifest = _read_manifest(dirname)
+    if manifest is None:
+        raise FileNotFoundError(f"No checkpoint in '{dirname}'")
+    with open(os.path.join(dirname, OBJECTS_FN), "rb") as f:
+        leaves = dill.load(f)
+    if manifest.get("version", 1) >= 2:
+        leaves = [dill.loads(pickled) for pickled in leaves]
+    decoder = _Decoder(dirname, manifest["arrays"], leaves, lazy)
+    state = {kk: decoder.decode(vv) for kk, vv in manifest["state"].items()}
+    return _import_class(manifest["cls"]), state
+
+
+def load_checkpoint(dirname, lazy=True):
+    """
+    Loads the instance from a checkpoint, like load_instance for a dill backup.
+    """
+    class_type, state = read_checkpoint(dirname, lazy=lazy)
+    instance = class_type()
+    instance.__dict__.update(state)
+    return instance
+
+
+def is_checkpoint(filename):
+    """Whether `filename` is a checkpoint directory, as opposed to a dill backup."""
+    return os.path.isdir(filename) and os.path.exists(
+        os.path.join(filename, MANIFEST_FN)
+    )
+
+
+class CheckpointWriter:
+    """
+    Background thread writing snapshots, so that a measurement loop never waits
+    for the disk. At most one snapshot per checkpoint directory is pending.
+
+    Attributes:
+        stats (dict): checkpoint directory -> statistics of its last write.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._jobs = []  # (snapshot, dirname) in order of submission
+        self._pending = set()  # directories with a snapshot not written yet
+        self._thread = None
+        self.stats = dict()
+
+    def busy(self, dirname):
+        """Whether a snapshot for `dirname` is still waiting or being written."""
+        with self._cond:
+            return dirname in self._pending
+
+    def submit(self, snapshot, dirname):
+        """
+        Queues a snapshot for writing.
+
+        Returns:
+            bool: False if a snapshot for `dirname` is still pending, the new one is dropped.
+        """
+        with self._cond:
+            if dirname in self._pending:
+                return False
+            self._pending.add(dirname)
+            self._jobs.append((snapshot, dirname))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._work, name="CheckpointWriter", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify_all()
+        return True
+
+    def wait(self, dirname, timeout=None):
+        """Waits until the pending snapshot for `dirname` is written, True if there is none left."""
+        with self._cond:
+            return self._cond.wait_for(lambda: dirname not in self._pending, timeout)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._jobs)
+                snapshot, dirname = self._jobs.pop(0)
+            stats = None
+            try:
+                stats = write_snapshot(snapshot, dirname)
+                logger.info(
+                    f"Autosaved {dirname}: {stats['bytes_written'] / 1e6:.1f} MB in"
+                    f" {stats['time_write']:.2f} s, snapshot {stats['time_snapshot'] * 1e3:.0f} ms"
+                )
+            except Exception:
+                logger.exception(f"Failed to write the checkpoint {dirname}")
+            finally:
+                with self._cond:
+                    if stats is not None:
+                        self.stats[dirname] = stats
+                    self._pending.discard(dirname)
+                    self._cond.notify_all()
+
+    def as_dict(self, dirname, prefix="ckpt_"):
+        """Flat dictionary of the last write to `dirname`, e.g. to put into a measurement's stateset."""
+        with self._cond:
+            stats = self.stats.get(dirname, dict())
+        return {prefix + key: value for key, value in stats.items()}
+
+
+checkpoint_writer = CheckpointWriter()  # shared by all measurements
@@ -25,6 +25,7 @@ def fake_nv_spectrum(freq, mw_power, bfield, freq_zfs=2.8705, linewidth=0.0005,
     return spectrum-np.min(spectrum)
 
 class DummyODMR(Measurement):  
+    resources = ()  # no hardware
 
     def __init__(self, name="dummy-default"):
         # ==some dictionaries stored with some default values--------------------------
@@ -0,0 +1,260 @@
+"""
+Reduce digitizer segments to one integrated value each.
+
+The weighted PL integration with background subtraction used by the
+measurements, e.g. `weighted_average_offset` in sensingprotocol.py, is linear
+in the samples of a segment. Its normalized signal weights and the background
+window can therefore be folded into one vector, and a whole block of segments
+reduces to a single matrix-vector product. The IntegrationKernel caches that
+vector per segment size and reduces raw int16 blocks in chunks, so a block is
+never converted to a full float array.
+
+The MatchedFilterEstimator refines the signal weights during a run from the
+dark and bright reference segments of the sequence. The weights that best
+separate the two references are the matched filter w ~ (bright - dark) / var,
+with the per-sample mean and variance estimated from the raw references.
+
+Author: ChunTung Cheung
+Email: ctcheung1123@gmail.com
+Created:  2026-10-18
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256  # segments converted to float at a time
+
+
+class IntegrationKernel:
+    """
+    Background-subtracted weighted integration of segments as one dot product.
+
+    reduce(segments) equals
+    sum(w * x) / sum(w) - mean(x[background_range]) for every segment x.
+
+    Parameters:
+        weight_fn (callable | None): maps sample indices (np.arange) to signal weights.
+        signal_range (tuple[int, int] | None): (start, end) of a flat signal window,
+            used when weight_fn is None.
+        background_range (tuple[int, int] | None): (start, end) of the background
+            window that is subtracted, None for no background.
+    """
+
+    def __init__(self, weight_fn=None, signal_range=None, background_range=None):
+        if weight_fn is None and signal_range is None:
+            raise ValueError("Either 'weight_fn' or 'signal_range' must be given")
+        self.weight_fn = weight_fn
+        self.signal_range = signal_range
+        self.background_range = background_range
+        # segment size -> (float64 vector, float32 vector, (start, end) of the nonzero samples)
+        self._vectors = dict()
+        self._scratch = None
+
+    def set_weight_fn(self, weight_fn):
+        """Replaces the signal weights and drops the cached vectors."""
+        self.weight_fn = weight_fn
+        self._vectors.clear()
+
+    def weights(self, segment_size):
+        """Normalized signal weights for a segment size."""
+        if self.weight_fn is not None:
+            weights = np.asarray(
+                self.weight_fn(np.arange(segment_size)), dtype=np.float64
+            )
+        else:
+            start, end = self.signal_range
+            weights = np.zeros(segment_size)
+            weights[start:end] = 1.0
+        return weights / np.sum(weights)
+
+    def vector(self, segment_size):
+        """The cached dot-product vector for a segment size."""
+        if segment_size not in self._vectors:
+            vec = self.weights(segment_size)
+            if self.background_range is not None:
+                start, end = self.background_range
+                vec[start:end] -= 1.0 / (end - start)
+            nonzero = np.flatnonzero(vec)
+            span = (nonzero[0], nonzero[-1] + 1) if nonzero.size else (0, 0)
+            self._vectors[segment_size] = (vec, vec.astype(np.float32), span)
+        return self._vectors[segment_size][0]
+
+    def reduce(self, segments):
+        """
+        Integrates every segment of a block.
+
+        Parameters:
+            segments (np.ndarray): 2D array (rows = segments, columns = samples),
+                float or raw integer ADC codes.
+
+        Returns:
+            np.ndarray: 1D float64 array with one value per segment, in the unit
+            of the input (e.g. ADC codes).
+        """
+        num_seg, segment_size = segments.shape
+        self.vector(segment_size)
+        vec, vec32, (start, end) = self._vectors[segment_size]
+        # samples outside the signal and background windows have zero weight
+        segments = segments[:, start:end]
+        if segments.dtype.kind == "f":
+            return segments @ vec[start:end]
+        # integer codes: convert a chunk at a time into a reused float32 buffer
+        vec32 = vec32[start:end]
+        if self._scratch is None or self._scratch.shape[1] != end - start:
+            self._scratch = np.empty((CHUNK_SIZE, end - start), dtype=np.float32)
+        result = np.empty(num_seg, dtype=np.float64)
+        for idx in range(0, num_seg, CHUNK_SIZE):
+            chunk = segments[idx : idx + CHUNK_SIZE]
+            scratch = self._scratch[: chunk.shape[0]]
+            np.copyto(scratch, chunk, casting="unsafe")
+            result[idx : idx + chunk.shape[0]] = scratch @ vec32
+        return result
+
+    __call__ = reduce
+
+
+class MatchedFilterEstimator:
+    """
+    Running estimate of the matched-filter weights from dark and bright references.
+
+    The raw reference segments are picked out of every block by their slot, their
+    per-sample sums and sums of squares are kept, and the weights
+    w ~ (bright - dark) / var are published to an IntegrationKernel once enough
+    references were seen.
+
+    Parameters:
+        num_slot (int): number of segments in one repetition of the sequence.
+        segment_size (int): samples per segment.
+        dark_slot (int): slot of the dark reference segment.
+        bright_slot (int): slot of the bright reference segment.
+        search_range (tuple[int, int] | None): (start, end) of the samples that may get
+            a weight, None for the whole segment.
+        smooth (int): length of the moving average applied to the contrast and variance.
+        min_count (int): references of each kind needed before weights are published.
+    """
+
+    def __init__(
+        self,
+        num_slot,
+        segment_size,
+        dark_slot=0,
+        bright_slot=1,
+        search_range=None,
+        smooth=16,
+        min_count=100,
+    ):
+        self.num_slot = int(num_slot)
+        self.segment_size = int(segment_size)
+        self.slots = (int(dark_slot), int(bright_slot))
+        self.search_range = search_range
+        self.smooth = int(smooth)
+        self.min_count = int(min_count)
+        self.reset()
+
+    def reset(self):
+        self._sum = np.zeros((2, self.segment_size), dtype=np.float64)
+        self._sumsq = np.zeros((2, self.segment_size), dtype=np.float64)
+        self.count = np.zeros(2, dtype=np.int64)
+        self._weights = None
+
+    @property
+    def ready(self):
+        return self.count.min() >= self.min_count
+
+    def add(self, block, pointer, num_slot=None):
+        """
+        Adds the reference segments of a block.
+
+        Parameters:
+            block (np.ndarray): consecutive segments along the first axis, raw codes
+                or voltages, the same block that is folded into the accumulator.
+            pointer (int): slot of the first segment of the block, i.e. the
+                accumulator's pointer before the block is added.
+            num_slot (int | None): segments per repetition of the sequence that is
+                streamed right now, if it differs from `num_slot`, e.g. for a
+                sweep split into sub-sequences that all start with the references.
+        """
+        num_slot = self.num_slot if num_slot is None else int(num_slot)
+        num_seg = block.shape[0]
+        for kk, slot in enumerate(self.slots):
+            idx_first = (slot - pointer) % num_slot
+            if idx_first >= num_seg:
+                continue
+            refs = np.reshape(block[idx_first::num_slot], (-1, self.segment_size))
+            refs = refs.astype(np.float64)
+            self._sum[kk] += np.sum(refs, axis=0)
+            self._sumsq[kk] += np.einsum("ij,ij->j", refs, refs)
+            self.count[kk] += refs.shape[0]
+
+    def _smooth(self, arr):
+        if self.smooth <= 1:
+            return arr
+        return np.convolve(arr, np.ones(self.smooth) / self.smooth, mode="same")
+
+    def estimate(self):
+        """
+        Current matched-filter weights, normalized to sum to one.
+
+        Returns:
+            np.ndarray | None: the weights, or None before min_count references
+            of each kind were added.
+        """
+        if not self.ready:
+            return None
+        mean = self._sum / self.count[:, None]
+        var = self._sumsq / self.count[:, None] - mean**2
+        contrast = self._smooth(mean[1] - mean[0])
+        noise = self._smooth(np.mean(var, axis=0))
+        noise = np.maximum(noise, np.max(noise) * 1e-6 + 1e-12)
+        weights = contrast / noise
+        weights *= np.sign(np.sum(weights))  # orient the weights to the contrast
+        np.clip(weights, 0.0, None, out=weights)
+        if self.search_range is not None:
+            start, end = self.search_range
+            weights[:start] = 0.0
+            weights[end:] = 0.0
+        if not np.any(weights):
+            return None
+        return weights / np.sum(weights)
+
+    def snr(self, weights=None):
+        """Single-shot contrast-to-noise ratio of the references for the given weights."""
+        weights = self._weights if weights is None else weights
+        if weights is None or not self.ready:
+            return 0.0
+        mean = self._sum / self.count[:, None]
+        var = self._sumsq / self.count[:, None] - mean**2
+        contrast = np.dot(mean[1] - mean[0], weights)
+        noise = np.sqrt(np.dot(np.mean(var, axis=0), weights**2))
+        return float(np.abs(contrast) / noise) if noise else 0.0
+
+    def weight_fn(self, idx):
+        """The published weights as a weight function for IntegrationKernel."""
+        return self._weights[idx]
+
+    def publish(self, kernel):
+        """
+        Re-estimates the weights and hands them to `kernel`.
+
+        Returns:
+            bool: True if the kernel got new weights, False if there were not
+            enough references yet and the kernel keeps its previous weights.
+        """
+        weights = self.estimate()
+        if weights is None:
+            return False
+        self._weights = weights
+        kernel.set_weight_fn(self.weight_fn)
+        return True
+
+    def as_dict(self, prefix="mf_"):
+        """Flat dictionary of the estimator state, e.g. to put into a measurement's stateset."""
+        stats = dict(
+            num_dark=int(self.count[0]),
+            num_bright=int(self.count[1]),
+            snr=self.snr(),
+        )
+        return {prefix + key: value for key, value in stats.items()}
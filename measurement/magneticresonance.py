@@ -5,17 +5,30 @@ import numpy as np
 
 from hardware import config as hcf
 from hardware.hardwaremanager import HardwareManager
+from hardware.mw.mwsynthesizer import STEPDWELL_MAX
+from hardware.pulser.builder import Block
 from hardware.pulser.pulser import (
     REPEAT_INFINITELY,
     OutputState,
     TriggerRearm,
     TriggerStart,
 )
+from measurement.accumulator import RunningStats, SegmentAccumulator
+from measurement.acquisition import (
+    AcquisitionWorker,
+    iter_raw_blocks,
+    stream_telemetry,
+)
+from measurement.integration import IntegrationKernel
+from measurement.sampler import AdaptiveSampler
 from measurement.task_base import Measurement
 
 logger = logging.getLogger(__name__)
 hw = HardwareManager()
 
+SWEEP_TRIG_LEN = 100  # [ns] pulse that starts a synthesizer sweep
+SWEEP_SETTLE = 2000  # [ns] for the synthesizer to return to the start frequency
+
 
 def seqtime(seq_tb):
     return np.sum([pulse[-1] for pulse in seq_tb])
@@ -98,6 +111,30 @@ def sequence_pODMR(
     return seq_exp, _aux
 
 
+def sequence_pODMR_sweep(
+    seq_exp,
+    num_freq: int,
+    step_dwell: int,
+    trig_ch: str,
+    trig_len: int = SWEEP_TRIG_LEN,
+    settle: int = SWEEP_SETTLE,
+):
+    """
+    One pass over the whole spectrum for a hardware-timed frequency sweep.
+
+    The pulse on `trig_ch` starts the synthesizer sweep, which then steps to the
+    next frequency every `step_dwell` ns on its own timer. Every frequency plays
+    `seq_exp` padded to `step_dwell`, and the pass ends with `settle` ns for the
+    synthesizer to return to the start frequency and wait for the next trigger.
+
+    Returns:
+        Node: the sequence tree of one pass.
+    """
+    pad = step_dwell - seqtime(seq_exp)
+    step = Block(list(seq_exp) + ([([], pad)] if pad > 0 else []))
+    return Block([([trig_ch], trig_len)]) + step * int(num_freq) + Block([([], settle)])
+
+
 def sequence_pODMR_WDF(
     init_nslaser: int,
     init_isc: int,
@@ -129,6 +166,8 @@ def sequence_pODMR_WDF(
 
 
 class pODMR(Measurement):
+    resources = ("pg", "dig", "laser", "vdi", "mwsyn", "mwmod")
+
     # development notebook "dev_odmr_mwsweep.ipynb"
 
     def __init__(self, name="default"):
@@ -155,6 +194,9 @@ class pODMR(Measurement):
             bz_bias_vol=1,  # -1V to 1V
             # -------------------
             rate_refresh=30.0,  # Hz rate of refreshing the entire spectrum, approx
+            hw_sweep=False,  # step the frequencies with the synthesizer sweep instead of serial calls
+            adaptive=False,  # visit the frequencies near resonances more often, not with hw_sweep
+            error_bars=False,  # per-frequency standard errors of the synthesizer sweep
         )
 
         # !!< has to be specific by users>
@@ -187,6 +229,24 @@ class pODMR(Measurement):
                     )
                 )
             ),
+            signal_err=np.zeros(
+                len(
+                    np.arange(
+                        __paraset["freq_start"],
+                        __paraset["freq_stop"],
+                        __paraset["freq_step"],
+                    )
+                )
+            ),
+            background_err=np.zeros(
+                len(
+                    np.arange(
+                        __paraset["freq_start"],
+                        __paraset["freq_stop"],
+                        __paraset["freq_step"],
+                    )
+                )
+            ),
         )
         # ==--------------------------------------------------------------------------
         super().__init__(name, __paraset, __dataset)
@@ -207,16 +267,48 @@ class pODMR(Measurement):
         hw.vdi.set_amp_volt(mwpower_vlevel)
 
         # set the measurement sequence-------------------------------------------
-        seq_exp, _ = sequence_pODMR(
-            self.paraset["init_nslaser"],
-            self.paraset["init_isc"],
-            self.paraset["init_wait"],
-            self.paraset["init_repeat"],
-            self.paraset["read_wait"],
-            self.paraset["read_laser"],
-            self.paraset["mw_time"],
-        )
-        tt_seq = seqtime(seq_exp)
+        # reuse the sequence if only non-sequence parameters changed, e.g. on resume
+        hw_sweep = self.paraset["hw_sweep"]
+        if hw_sweep and self.paraset["adaptive"]:
+            logger.warning(
+                "Adaptive sampling is ignored, the synthesizer sweep visits every frequency once per pass."
+            )
+        seq_key = hw.pg.sequenceKey(self.__class__.__name__, self.paraset)
+        seq_info = hw.pg.restoreSequence(seq_key)
+        if seq_info is None:
+            seq_exp, _ = sequence_pODMR(
+                self.paraset["init_nslaser"],
+                self.paraset["init_isc"],
+                self.paraset["init_wait"],
+                self.paraset["init_repeat"],
+                self.paraset["read_wait"],
+                self.paraset["read_laser"],
+                self.paraset["mw_time"],
+            )
+            # the synthesizer dwells in multiples of its 4ns timebase
+            step_dwell = (
+                int(np.ceil(seqtime(seq_exp) / hcf.VDISYN_timebase))
+                * hcf.VDISYN_timebase
+            )
+            if hw_sweep:
+                if step_dwell > STEPDWELL_MAX:
+                    raise ValueError(
+                        f"Sequence of {step_dwell} ns per frequency exceeds the longest synthesizer step dwell of {STEPDWELL_MAX} ns"
+                    )
+                # the whole spectrum in one sequence, triggering one synthesizer sweep
+                seq_exp = sequence_pODMR_sweep(
+                    seq_exp, num_freq, step_dwell, hcf.VDISYN_trigch
+                )
+            tt_seq = hw.pg.setSequence(seq_exp, reset=True)
+            hw.pg.setAnalog("Bz", [(tt_seq, self.paraset["bz_bias_vol"])])
+            seq_info = hw.pg.cacheSequence(
+                seq_key, tt_seq=tt_seq, step_dwell=step_dwell
+            )
+        tt_seq = seq_info["tt_seq"]
+
+        if hw_sweep:
+            # load the frequency list once, the sweep steps on the synthesizer's timer
+            freq_sweep = self._load_sweep(freq_array, seq_info["step_dwell"])
         # self.dig_trig_len = 20
         # self.divpart_pt = 2
 
@@ -238,9 +330,10 @@ class pODMR(Measurement):
         # hw.pg.setDigital("laser", seq_laser)
         # hw.pg.setDigital("mwA", seq_mwA)
         # hw.pg.setDigital("sdtrig", seq_dig)
-        hw.pg.setSequence(seq_exp, reset=True)
-        hw.pg.setAnalog("Bz", [(tt_seq, self.paraset["bz_bias_vol"])])
-        hw.pg.setTrigger(start=TriggerStart.SOFTWARE, rearm=TriggerRearm.MANUAL)
+        if hw_sweep:
+            hw.pg.setTrigger(start=TriggerStart.SOFTWARE, rearm=TriggerRearm.AUTO)
+        else:
+            hw.pg.setTrigger(start=TriggerStart.SOFTWARE, rearm=TriggerRearm.MANUAL)
 
         # def seqtime_tb(seq_tb):
         #     return np.sum([pulse[-1] for pulse in seq_tb])
@@ -251,7 +344,8 @@ class pODMR(Measurement):
         # set up the digitizer-------------------------------------------
         read_wait = self.paraset["read_wait"]
         read_laser = self.paraset["read_laser"]
-        databufferlen = 2  # mw on and mw off
+        # mw on and mw off, for every frequency if the whole spectrum is one sequence
+        databufferlen = 2 * num_freq if hw_sweep else 2
 
         rate_refresh = self.paraset[
             "rate_refresh"
@@ -259,8 +353,8 @@ class pODMR(Measurement):
 
         amp_input = self.paraset["amp_input"]
         readout_ch = hcf.SIDIG_chmap["apd"]
-        num_segment = (
-            int(databufferlen / (tt_seq * rate_refresh / 1e9)) // 32 * 32
+        num_segment = max(
+            int(databufferlen / (tt_seq * rate_refresh / 1e9)) // 32 * 32, 32
         )  # number of "reads" every data refresh
 
         # configures the readout to match the pulse sequence
@@ -297,7 +391,10 @@ class pODMR(Measurement):
 
         # set the pulse streamer stream-------------------------------------------
         hw.pg.setClock10MHzExt()
-        hw.pg.stream(n_runs=num_segment // databufferlen)
+        if hw_sweep:
+            hw.pg.stream(n_runs=REPEAT_INFINITELY)
+        else:
+            hw.pg.stream(n_runs=num_segment // databufferlen)
 
         # amp_input = self.paraset["amp_input"]
         # self.readout_ch = hcf.SIDIG_chmap["apd"]
@@ -340,15 +437,94 @@ class pODMR(Measurement):
             self.sig_mwoff = np.zeros_like(self.freq_actual)
             self.num_repeat = 0
             self.freq_idx = 0
+        if not self.tokeep or getattr(self, "sampler", None) is None:
+            self.sampler = AdaptiveSampler(num_freq)
+            # per-frequency mean and variance of the integrated mw on / off segments
+            self.stats_on = RunningStats(num_freq)
+            self.stats_off = RunningStats(num_freq)
+        # integrates a segment like average_repeated_data, for the per-visit
+        # contrast and the error bars
+        self.kernel = IntegrationKernel(
+            signal_range=(self.bgextend_size + 160, self.bgextend_size + 400),
+            background_range=(self.bgextend_size - 156, self.bgextend_size - 56),
+        )
+        if hw_sweep:
+            self.freq_actual = freq_sweep
+            if not self.tokeep or getattr(self, "accumulator", None) is None:
+                # sum raw ADC codes exactly, convert to voltage in _organize_data
+                self.accumulator = SegmentAccumulator(
+                    databufferlen,
+                    segment_size,
+                    dtype=np.int64,
+                    stats=self.paraset["error_bars"],
+                    stats_reducer=self.kernel,
+                )
+            # the new stream starts at the first frequency again
+            self.accumulator.pointer = 0
+            # the first pass may run before the synthesizer waits for the trigger
+            self.num_seg_discard = databufferlen
+            self.volt_per_code = hw.dig.volt_per_code
 
         # start the digitizer buffering------------------------------------
         hw.dig.set_config()
         hw.dig.start_buffer()
+        if hw_sweep:
+            # park the synthesizer at the start frequency, the pulse streamer triggers every pass
+            hw.mwsyn.reset_trigger()
+            hw.mwsyn.sweep_continue()
+            hw.pg.startNow()
+
+    def _load_sweep(self, freq_array, step_dwell):
+        """
+        Loads the frequencies into a synthesizer sweep that waits at the start
+        frequency for a trigger, then rises one step every `step_dwell` ns and falls
+        back in a single step.
+
+        Returns:
+            np.ndarray: the actual output frequencies in GHz.
+        """
+        multiplier = hcf.VDISYN_multiplier
+        freq_start = freq_array[0] / multiplier
+        freq_stop = freq_array[-1] / multiplier
+        step_rise = self.paraset["freq_step"] / multiplier
+        step_fall = max(freq_stop - freq_start, step_rise)
+        actualpara = hw.mwsyn.simple_sweep(
+            freq_start,
+            freq_stop,
+            step_rise,
+            step_fall,
+            step_dwell,
+            hcf.VDISYN_timebase,
+            True,  # dwell at low until triggered
+            False,
+        )
+        if actualpara is None:
+            logger.warning("Failed to confirm the sweep setting from synthesizer.")
+            return np.copy(freq_array)
+        freq_start_actual, _, step_rise_actual, _ = actualpara
+        logger.info(
+            f"Loaded a sweep of {len(freq_array)} frequencies, {step_dwell} ns each"
+        )
+        return multiplier * (
+            freq_start_actual + step_rise_actual * np.arange(len(freq_array))
+        )
 
     def _run_exp(self):
+        if self.paraset["hw_sweep"]:
+            # the synthesizer steps on its own, only fold what the digitizer delivered
+            for data_block in iter_raw_blocks(hw.dig, None, self.accumulator):
+                num_discard = min(self.num_seg_discard, data_block.shape[0])
+                if num_discard:
+                    self.accumulator.skip(num_discard)
+                    self.num_seg_discard -= num_discard
+                self.accumulator.add(data_block[num_discard:])
+            return
         hw.pg.rearm()
         # for jj, ff in enumerate(self.freq_array):
-        jj = self.freq_idx % self.num_freq
+        if self.paraset["adaptive"]:
+            jj = self.sampler.next()
+        else:
+            jj = self.freq_idx % self.num_freq
         ff = self.freq_actual[jj]
         # freq = ff / hcf.VDISYN_multiplier
         # freq_actual = hw.mwsyn.cw_frequency(freq)
@@ -378,9 +554,22 @@ class pODMR(Measurement):
             self.sig_mwon_raw[jj, :] += np.sum(rawraw_on, axis=0)
             self.sig_mwoff_raw[jj, :] += np.sum(rawraw_off, axis=0)
             self.segment_list[jj] += num_seg_collected
+            pl_on = self.kernel(rawraw_on)
+            pl_off = self.kernel(rawraw_off)
+            self.stats_on.add(pl_on, jj)
+            self.stats_off.add(pl_off, jj)
+            if self.paraset["adaptive"] and pl_off.size and np.mean(pl_off):
+                # mw on / mw off ratio of this visit
+                self.sampler.add(jj, np.mean(pl_on) / np.mean(pl_off))
         self.freq_idx += 1
         # hw.pg.forceFinal()
 
+    def _telemetry(self):
+        telemetry = hw.dig.stats.as_dict()
+        if self.paraset["adaptive"]:
+            telemetry.update(self.sampler.as_dict())
+        return telemetry
+
     def average_repeated_data(self, arr, start, stop, segments):
         averaged_norm = np.mean(arr[:, start:stop], axis=1)
         averaged_bg = np.mean(
@@ -397,6 +586,32 @@ class pODMR(Measurement):
         return result
 
     def _organize_data(self):
+        if self.paraset["hw_sweep"]:
+            sums = self.accumulator.sums()
+            self.sig_mwon_raw = sums[0::2] * self.volt_per_code
+            self.sig_mwoff_raw = sums[1::2] * self.volt_per_code
+            # counts both segments of a frequency, as in the stepped mode
+            self.segment_list = (
+                self.accumulator.count[0::2] + self.accumulator.count[1::2]
+            )
+            if self.accumulator.stats is not None:
+                err = self.accumulator.stats.sem * self.volt_per_code
+            else:
+                err = np.zeros(self.accumulator.num_slot)
+            sem_on, sem_off = err[0::2], err[1::2]
+            count_on = self.accumulator.count[0::2]
+        else:
+            sem_on, sem_off = self.stats_on.sem, self.stats_off.sem
+            count_on = self.stats_on.count
+        # the spectrum is normalized by the segments of both halves, so are its errors
+        scale = np.divide(
+            count_on,
+            self.segment_list,
+            out=np.zeros_like(sem_on),
+            where=self.segment_list != 0,
+        )
+        self.dataset["signal_err"] = sem_on * scale
+        self.dataset["background_err"] = sem_off * scale
         self.sig_mwon = self.average_repeated_data(
             self.sig_mwon_raw,
             self.bgextend_size + 160,
@@ -418,6 +633,8 @@ class pODMR(Measurement):
         super()._organize_data()
 
     def _shutdown_exp(self):
+        if self.paraset["hw_sweep"]:
+            hw.mwsyn.sweep_pause()
         # reconnect the mw syn connection
         hw.mwsyn.close_gracefully()
         hw.mwsyn.open()
@@ -477,6 +694,8 @@ class pODMR(Measurement):
 
 
 class pODMR_WDF(Measurement):
+    resources = ("pg", "dig", "laser", "mwsyn", "windfreak")
+
     # development notebook "dev_odmr_mwsweep.ipynb"
 
     def __init__(self, name="default"):
@@ -550,16 +769,24 @@ class pODMR_WDF(Measurement):
         # freq = freq_start / hcf.VDISYN_multiplier
 
         # set the measurement sequence-------------------------------------------
-        seq_exp, _ = sequence_pODMR_WDF(
-            self.paraset["init_nslaser"],
-            self.paraset["init_isc"],
-            self.paraset["init_wait"],
-            self.paraset["init_repeat"],
-            self.paraset["read_wait"],
-            self.paraset["read_laser"],
-            self.paraset["mw_time"],
-        )
-        tt_seq = seqtime(seq_exp)
+        # reuse the sequence if only non-sequence parameters changed, e.g. on resume
+        seq_key = hw.pg.sequenceKey(self.__class__.__name__, self.paraset)
+        seq_info = hw.pg.restoreSequence(seq_key)
+        if seq_info is None:
+            seq_exp, _ = sequence_pODMR_WDF(
+                self.paraset["init_nslaser"],
+                self.paraset["init_isc"],
+                self.paraset["init_wait"],
+                self.paraset["init_repeat"],
+                self.paraset["read_wait"],
+                self.paraset["read_laser"],
+                self.paraset["mw_time"],
+            )
+            tt_seq = seqtime(seq_exp)
+            hw.pg.setSequence(seq_exp, reset=True)
+            hw.pg.setAnalog("Bz", [(tt_seq, self.paraset["bz_bias_vol"])])
+            seq_info = hw.pg.cacheSequence(seq_key, tt_seq=tt_seq)
+        tt_seq = seq_info["tt_seq"]
         # self.dig_trig_len = 20
         # self.divpart_pt = 2
 
@@ -581,8 +808,6 @@ class pODMR_WDF(Measurement):
         # hw.pg.setDigital("laser", seq_laser)
         # hw.pg.setDigital("mwA", seq_mwA)
         # hw.pg.setDigital("sdtrig", seq_dig)
-        hw.pg.setSequence(seq_exp, reset=True)
-        hw.pg.setAnalog("Bz", [(tt_seq, self.paraset["bz_bias_vol"])])
         hw.pg.setTrigger(start=TriggerStart.SOFTWARE, rearm=TriggerRearm.MANUAL)
 
         # def seqtime_tb(seq_tb):
@@ -717,6 +942,9 @@ class pODMR_WDF(Measurement):
         self.freq_idx += 1
         # hw.pg.forceFinal()
 
+    def _telemetry(self):
+        return hw.dig.stats.as_dict()
+
     def average_repeated_data(self, arr, start, stop, segments):
         averaged_norm = np.mean(arr[:, start:stop], axis=1)
         averaged_bg = np.mean(
@@ -912,6 +1140,8 @@ def sequence_Rabi_WDF(
 
 
 class Rabi(Measurement):
+    resources = ("pg", "dig", "laser", "vdi", "mwsyn", "mwmod")
+
     def __init__(self, name="default"):
         __paraset = dict(
             laser_current=80.0,  # percentage
@@ -934,6 +1164,9 @@ class Rabi(Measurement):
             rate_refresh=10.0,
             moving_aveg=False,  # do moving average on data
             k_order=100,  # from int 1 to  inf
+            acq_thread=False,  # read the digitizer in a background thread
+            store_scalar=False,  # integrate segments on arrival instead of keeping them
+            error_bars=False,  # standard errors of the integrated segments
         )
         num_steps = int(
             (__paraset["mw_dur_end"] - __paraset["mw_dur_begin"])
@@ -945,6 +1178,8 @@ class Rabi(Measurement):
             mw_dur=np.zeros(num_steps),
             sig_mw=np.zeros(num_steps),
             sig_nomw=np.zeros(num_steps),
+            sig_mw_err=np.zeros(num_steps),
+            sig_nomw_err=np.zeros(num_steps),
         )
 
         super().__init__(name, __paraset, __dataset)
@@ -980,22 +1215,29 @@ class Rabi(Measurement):
         mw_dur_end = self.paraset["mw_dur_end"]
         mw_dur_step = self.paraset["mw_dur_step"]
 
-        seq_rabiexp, mw_dur = sequence_Rabi(
-            init_nslaser,
-            init_isc,
-            init_wait,
-            init_repeat,
-            read_wait,
-            read_laser,
-            mw_dur_begin,
-            mw_dur_end,
-            mw_dur_step,
-            mw_AB=self.paraset["mw_AB"],
-        )
+        # reuse the sequence if only non-sequence parameters changed, e.g. on resume
+        seq_key = hw.pg.sequenceKey(self.__class__.__name__, self.paraset)
+        seq_info = hw.pg.restoreSequence(seq_key)
+        if seq_info is None:
+            seq_rabiexp, mw_dur = sequence_Rabi(
+                init_nslaser,
+                init_isc,
+                init_wait,
+                init_repeat,
+                read_wait,
+                read_laser,
+                mw_dur_begin,
+                mw_dur_end,
+                mw_dur_step,
+                mw_AB=self.paraset["mw_AB"],
+            )
 
-        tt_seq = hw.pg.setSequence(
-            seq_rabiexp, reset=True
-        )  # WARNING only works well with small seq
+            tt_seq = hw.pg.setSequence(
+                seq_rabiexp, reset=True
+            )  # WARNING only works well with small seq
+            seq_info = hw.pg.cacheSequence(seq_key, tt_seq=tt_seq, mw_dur=mw_dur)
+        tt_seq = seq_info["tt_seq"]
+        mw_dur = seq_info["mw_dur"]
         hw.pg.setTrigger(TriggerStart.SOFTWARE, rearm=TriggerRearm.AUTO)
         hw.pg.setClock10MHzExt()
         hw.pg.stream(n_runs=REPEAT_INFINITELY)
@@ -1037,6 +1279,7 @@ class Rabi(Measurement):
                 pretrig_size=pretrig_size + self.bgextend_size,  # TODO: why 256?
                 posttrig_size=posttrig_size - self.bgextend_size,
                 segment_size=segment_size,
+                zero_copy=True,
             )
         )
         logger.debug(
@@ -1050,20 +1293,34 @@ class Rabi(Measurement):
         self.mw_dur = mw_dur
         # self.freq_actual = freq_actual
         self.freq_actual = self.paraset["mw_freq"]
-        self.data_store = np.zeros(
-            (self.databufferlen, pretrig_size + posttrig_size),
-            dtype=np.float64,
-            order="C",
+        self.kernel = IntegrationKernel(
+            signal_range=(self.bgextend_size + 160, self.bgextend_size + 400),
+            background_range=(self.bgextend_size - 156, self.bgextend_size - 56),
         )
-        self.idx_pointer = 0
+        if self.paraset["store_scalar"]:
+            # integrate every raw segment on arrival, only one scalar per slot is kept
+            self.accumulator = SegmentAccumulator(
+                self.databufferlen,
+                reducer=self.kernel,
+                stats=self.paraset["error_bars"],
+            )
+        else:
+            # sum raw ADC codes exactly, convert to voltage in _organize_data
+            self.accumulator = SegmentAccumulator(
+                self.databufferlen,
+                pretrig_size + posttrig_size,
+                dtype=np.int64,
+                stats=self.paraset["error_bars"],
+                stats_reducer=self.kernel,
+            )
+        self.volt_per_code = hw.dig.volt_per_code
+        self.acquisition = None
+        self.data_store = self.accumulator.store
+        self.segments = self.accumulator.count
         if self.paraset["moving_aveg"]:
             self.data_store_ma = np.zeros(
-                (
-                    self.paraset["k_order"],
-                    self.databufferlen,
-                    pretrig_size + posttrig_size,
-                ),
-                dtype=np.float64,
+                (self.paraset["k_order"],) + self.data_store.shape,
+                dtype=self.data_store.dtype,
                 order="C",
             )
             self.segments_ma = np.zeros((self.paraset["k_order"], self.databufferlen))
@@ -1074,96 +1331,42 @@ class Rabi(Measurement):
         self.dataset["sig_mw"] = np.zeros(self.mw_dur_num)
         self.dataset["sig_nomw"] = np.zeros(self.mw_dur_num)
         # -----------------------------------------------------------------------
-        self.segments = np.zeros(self.databufferlen)
 
         # start the laser and DAQ then wait for trigger from the  pulse streamer--------------
         hw.laser.laser_on()  # turn on laser
         # logger.debug("Start the trigger from the pulse streamer")
         hw.dig.start_buffer()
+        if self.paraset["acq_thread"]:
+            self.acquisition = AcquisitionWorker(hw.dig).start()
         hw.pg.startNow()
 
     def _run_exp(self):
-        self.rawraw = hw.dig.stream()
-        if self.rawraw is not None:
-            # # Check if self.rawraw is a numpy array
-            # if not isinstance(self.rawraw, np.ndarray):
-            #     raise ValueError("self.rawraw is not a numpy array")
-            # Get the number of segments
-            # print(self.rawraw.shape)
-            num_segs = self.rawraw.shape[0]
-            idx_ptr_overflow = self.idx_pointer + num_segs
-            count_fill, idx_pointer_new = divmod(idx_ptr_overflow, self.databufferlen)
-            # print(
-            #     f"idx_pointer: {self.idx_pointer}, num_segs: {num_segs}, count_fill: {count_fill}, idx_pointer_new: {idx_pointer_new}, databufferlen: {self.databufferlen}"
-            # )
+        # fold the raw ADC codes straight from the DMA buffer or acquisition ring
+        shifted = False
+        for data_block in iter_raw_blocks(hw.dig, self.acquisition, self.accumulator):
             if self.paraset["moving_aveg"]:
-                # TODO: !! this is a dummy way to do moving average that would throw out some data
-                # shift the MA data store buffer
-                self.data_store -= self.data_store_ma[0]
-                self.segments -= self.segments_ma[0]
-                self.data_store_ma[0:-1] = self.data_store_ma[1:]
-                self.segments_ma[0:-1] = self.segments_ma[1:]
-
-                # assign the new data to the last slot in the MA data store
-                if count_fill > 1:
-                    num_tailslot = self.databufferlen - self.idx_pointer
-                    to_add_unstructured = np.reshape(
-                        self.rawraw[
-                            num_tailslot : num_tailslot
-                            + (count_fill - 1) * self.databufferlen
-                        ],
-                        (count_fill - 1, self.databufferlen, -1),
-                    )
-
-                    self.data_store_ma[-1] = np.sum(to_add_unstructured, axis=0)
-                    self.segments_ma[-1] = count_fill - 1
-                self.data_store += self.data_store_ma[-1]
-                self.segments += self.segments_ma[-1]
+                if not shifted:
+                    # shift the MA data store buffer once per call as with a single
+                    # read, all blocks drained by the acquisition thread share a slot
+                    self.data_store -= self.data_store_ma[0]
+                    self.segments -= self.segments_ma[0]
+                    self.data_store_ma[0:-1] = self.data_store_ma[1:]
+                    self.segments_ma[0:-1] = self.segments_ma[1:]
+                    self.data_store_ma[-1] = 0
+                    self.segments_ma[-1] = 0
+                    shifted = True
+
+                # fold the new data into the last slot in the MA data store
+                self.accumulator.add(
+                    data_block,
+                    store=self.data_store_ma[-1],
+                    count=self.segments_ma[-1],
+                )
             else:
-                if count_fill < 1:
-                    # underfill================================
-                    # if the segment number is small to the remaining slot numbers in the buffer
-                    idx_i = self.idx_pointer
-                    idx_f = self.idx_pointer + num_segs
-                    self.data_store[idx_i:idx_f, :] += np.reshape(
-                        self.rawraw[:num_segs], (num_segs, -1)
-                    )
-                    self.segments[idx_i:idx_f] += 1
-                else:
-                    # exactly fill or overfill===============================
-
-                    # fill the tail of the data_store buffer ----------------
-                    num_tailslot = self.databufferlen - self.idx_pointer
-                    idx_i = self.idx_pointer
-                    idx_f = self.databufferlen
-                    self.data_store[idx_i:idx_f, :] += np.reshape(
-                        self.rawraw[:num_tailslot], (num_tailslot, -1)
-                    )
-
-                    self.segments[idx_i:idx_f] += 1
-
-                    # fill the entire data_store buffer multiple times ----------------
-                    if count_fill > 1:
-                        to_add_unstructured = np.reshape(
-                            self.rawraw[
-                                num_tailslot : num_tailslot
-                                + (count_fill - 1) * self.databufferlen
-                            ],
-                            (count_fill - 1, self.databufferlen, -1),
-                        )
-                        self.data_store += np.sum(to_add_unstructured, axis=0)
-                        self.segments += count_fill - 1
-
-                    # fill the head of the data_store buffer for the remaining segments --------------
-                    self.data_store[:idx_pointer_new, :] += (
-                        np.reshape(
-                            self.rawraw[-idx_pointer_new:], (idx_pointer_new, -1)
-                        )
-                        if idx_pointer_new
-                        else self.data_store[:idx_pointer_new, :]
-                    )  # the if condition is needed to handle the case that the idx_pointer_new is 0
-                    self.segments[:idx_pointer_new] += 1
-            self.idx_pointer = idx_pointer_new
+                self.accumulator.add(data_block)
+        if shifted:
+            self.data_store += self.data_store_ma[-1]
+            self.segments += self.segments_ma[-1]
 
         # self.data_store_push = np.copy(self.data_store)
         # self.segments_push = np.copy(self.segments)
@@ -1173,7 +1376,14 @@ class Rabi(Measurement):
         # -----------------------------------------------------------------------
         return None
 
+    def _telemetry(self):
+        return stream_telemetry(hw.dig, self.acquisition)
+
     def average_repeated_data(self, arr, start, stop, segments):
+        if arr.ndim == 1:
+            # the segments were already integrated on arrival
+            averaged = arr / segments
+            return averaged[1::2], averaged[0::2]
         averaged_norm = np.mean(arr[:, start:stop], axis=1) / segments
         averaged_bg = (
             np.mean(arr[:, self.bgextend_size - 156 : self.bgextend_size - 56], axis=1)
@@ -1191,9 +1401,19 @@ class Rabi(Measurement):
             self.bgextend_size + 400,
             self.segments_push,
         )  # TODO: use parameters instead of fixed number to select integration window
+        # the stores hold summed ADC codes, convert them to voltage once here
+        self.no_mw = self.no_mw * self.volt_per_code
+        self.mw = self.mw * self.volt_per_code
+        # standard errors of the integrated segments, over the whole run
+        if self.accumulator.stats is not None:
+            err = self.accumulator.stats.sem * self.volt_per_code
+        else:
+            err = np.zeros(self.accumulator.num_slot)
 
         self.dataset["sig_mw"] = self.mw
         self.dataset["sig_nomw"] = self.no_mw
+        self.dataset["sig_mw_err"] = err[0::2]
+        self.dataset["sig_nomw_err"] = err[1::2]
         self.dataset["mw_dur"] = self.mw_dur
         self.dataset["mw_freq"] = self.freq_actual
         self.dataset["num_repeat"] = self.idx_run
@@ -1215,11 +1435,20 @@ class Rabi(Measurement):
         hw.pg.constant(OutputState.ZERO())
         # hw.pg.reset()
 
+        if self.acquisition is not None:
+            self.acquisition.stop()
         _ = hw.dig.stream()
         hw.dig.stop_card()
         # hw.dig.reset()
 
     def _handle_exp_error(self):
+        try:
+            if getattr(self, "acquisition", None) is not None:
+                self.acquisition.stop()
+        except Exception as ee:
+            print("I tried to stop the acquisition thread but failed")
+            print(ee)
+
         try:
             hw.laser.laser_off()  # turn off laser
             hw.laser.set_diode_current(0.00, save_memory=False)
@@ -1320,6 +1549,8 @@ class Rabi(Measurement):
 
 
 class Rabi_WDF(Measurement):
+    resources = ("pg", "dig", "laser", "mwsyn", "windfreak")
+
     def __init__(self, name="default"):
         __paraset = dict(
             laser_current=80.0,  # percentage
@@ -1341,6 +1572,8 @@ class Rabi_WDF(Measurement):
             rate_refresh=10.0,
             moving_aveg=False,  # do moving average on data
             k_order=100,  # from int 1 to  inf
+            acq_thread=False,  # read the digitizer in a background thread
+            store_scalar=False,  # integrate segments on arrival instead of keeping them
         )
         num_steps = int(
             (__paraset["mw_dur_end"] - __paraset["mw_dur_begin"])
@@ -1382,21 +1615,28 @@ class Rabi_WDF(Measurement):
         mw_dur_end = self.paraset["mw_dur_end"]
         mw_dur_step = self.paraset["mw_dur_step"]
 
-        seq_rabiexp, mw_dur = sequence_Rabi_WDF(
-            init_nslaser,
-            init_isc,
-            init_wait,
-            init_repeat,
-            read_wait,
-            read_laser,
-            mw_dur_begin,
-            mw_dur_end,
-            mw_dur_step,
-        )
+        # reuse the sequence if only non-sequence parameters changed, e.g. on resume
+        seq_key = hw.pg.sequenceKey(self.__class__.__name__, self.paraset)
+        seq_info = hw.pg.restoreSequence(seq_key)
+        if seq_info is None:
+            seq_rabiexp, mw_dur = sequence_Rabi_WDF(
+                init_nslaser,
+                init_isc,
+                init_wait,
+                init_repeat,
+                read_wait,
+                read_laser,
+                mw_dur_begin,
+                mw_dur_end,
+                mw_dur_step,
+            )
 
-        tt_seq = hw.pg.setSequence(
-            seq_rabiexp, reset=True
-        )  # WARNING only works well with small seq
+            tt_seq = hw.pg.setSequence(
+                seq_rabiexp, reset=True
+            )  # WARNING only works well with small seq
+            seq_info = hw.pg.cacheSequence(seq_key, tt_seq=tt_seq, mw_dur=mw_dur)
+        tt_seq = seq_info["tt_seq"]
+        mw_dur = seq_info["mw_dur"]
         hw.pg.setTrigger(TriggerStart.SOFTWARE, rearm=TriggerRearm.AUTO)
         hw.pg.stream(n_runs=REPEAT_INFINITELY)
         # -----------------------------------------------------------------------
@@ -1437,6 +1677,7 @@ class Rabi_WDF(Measurement):
                 pretrig_size=pretrig_size + self.bgextend_size,  # TODO: why 256?
                 posttrig_size=posttrig_size - self.bgextend_size,
                 segment_size=segment_size,
+                zero_copy=True,
             )
         )
         logger.debug(
@@ -1451,20 +1692,28 @@ class Rabi_WDF(Measurement):
         self.freq_actual = self.paraset["mw_freq"]
         # self.task_uca = task_uca
         # self.task_mwbp = task_mwbp
-        self.data_store = np.zeros(
-            (self.databufferlen, pretrig_size + posttrig_size),
-            dtype=np.float64,
-            order="C",
-        )
-        self.idx_pointer = 0
+        if self.paraset["store_scalar"]:
+            # integrate every raw segment on arrival, only one scalar per slot is kept
+            self.kernel = IntegrationKernel(
+                signal_range=(self.bgextend_size + 160, self.bgextend_size + 400),
+                background_range=(self.bgextend_size - 156, self.bgextend_size - 56),
+            )
+            self.accumulator = SegmentAccumulator(
+                self.databufferlen, reducer=self.kernel
+            )
+        else:
+            # sum raw ADC codes exactly, convert to voltage in _organize_data
+            self.accumulator = SegmentAccumulator(
+                self.databufferlen, pretrig_size + posttrig_size, dtype=np.int64
+            )
+        self.volt_per_code = hw.dig.volt_per_code
+        self.acquisition = None
+        self.data_store = self.accumulator.store
+        self.segments = self.accumulator.count
         if self.paraset["moving_aveg"]:
             self.data_store_ma = np.zeros(
-                (
-                    self.paraset["k_order"],
-                    self.databufferlen,
-                    pretrig_size + posttrig_size,
-                ),
-                dtype=np.float64,
+                (self.paraset["k_order"],) + self.data_store.shape,
+                dtype=self.data_store.dtype,
                 order="C",
             )
             self.segments_ma = np.zeros((self.paraset["k_order"], self.databufferlen))
@@ -1475,96 +1724,42 @@ class Rabi_WDF(Measurement):
         self.dataset["sig_mw"] = np.zeros(self.mw_dur_num)
         self.dataset["sig_nomw"] = np.zeros(self.mw_dur_num)
         # -----------------------------------------------------------------------
-        self.segments = np.zeros(self.databufferlen)
 
         # start the laser and DAQ then wait for trigger from the  pulse streamer--------------
         hw.laser.laser_on()  # turn on laser
         # logger.debug("Start the trigger from the pulse streamer")
         hw.dig.start_buffer()
+        if self.paraset["acq_thread"]:
+            self.acquisition = AcquisitionWorker(hw.dig).start()
         hw.pg.startNow()
 
     def _run_exp(self):
-        self.rawraw = hw.dig.stream()
-        if self.rawraw is not None:
-            # # Check if self.rawraw is a numpy array
-            # if not isinstance(self.rawraw, np.ndarray):
-            #     raise ValueError("self.rawraw is not a numpy array")
-            # Get the number of segments
-            # print(self.rawraw.shape)
-            num_segs = self.rawraw.shape[0]
-            idx_ptr_overflow = self.idx_pointer + num_segs
-            count_fill, idx_pointer_new = divmod(idx_ptr_overflow, self.databufferlen)
-            # print(
-            #     f"idx_pointer: {self.idx_pointer}, num_segs: {num_segs}, count_fill: {count_fill}, idx_pointer_new: {idx_pointer_new}, databufferlen: {self.databufferlen}"
-            # )
+        # fold the raw ADC codes straight from the DMA buffer or acquisition ring
+        shifted = False
+        for data_block in iter_raw_blocks(hw.dig, self.acquisition, self.accumulator):
             if self.paraset["moving_aveg"]:
-                # TODO: !! this is a dummy way to do moving average that would throw out some data
-                # shift the MA data store buffer
-                self.data_store -= self.data_store_ma[0]
-                self.segments -= self.segments_ma[0]
-                self.data_store_ma[0:-1] = self.data_store_ma[1:]
-                self.segments_ma[0:-1] = self.segments_ma[1:]
-
-                # assign the new data to the last slot in the MA data store
-                if count_fill > 1:
-                    num_tailslot = self.databufferlen - self.idx_pointer
-                    to_add_unstructured = np.reshape(
-                        self.rawraw[
-                            num_tailslot : num_tailslot
-                            + (count_fill - 1) * self.databufferlen
-                        ],
-                        (count_fill - 1, self.databufferlen, -1),
-                    )
-
-                    self.data_store_ma[-1] = np.sum(to_add_unstructured, axis=0)
-                    self.segments_ma[-1] = count_fill - 1
-                self.data_store += self.data_store_ma[-1]
-                self.segments += self.segments_ma[-1]
+                if not shifted:
+                    # shift the MA data store buffer once per call as with a single
+                    # read, all blocks drained by the acquisition thread share a slot
+                    self.data_store -= self.data_store_ma[0]
+                    self.segments -= self.segments_ma[0]
+                    self.data_store_ma[0:-1] = self.data_store_ma[1:]
+                    self.segments_ma[0:-1] = self.segments_ma[1:]
+                    self.data_store_ma[-1] = 0
+                    self.segments_ma[-1] = 0
+                    shifted = True
+
+                # fold the new data into the last slot in the MA data store
+                self.accumulator.add(
+                    data_block,
+                    store=self.data_store_ma[-1],
+                    count=self.segments_ma[-1],
+                )
             else:
-                if count_fill < 1:
-                    # underfill================================
-                    # if the segment number is small to the remaining slot numbers in the buffer
-                    idx_i = self.idx_pointer
-                    idx_f = self.idx_pointer + num_segs
-                    self.data_store[idx_i:idx_f, :] += np.reshape(
-                        self.rawraw[:num_segs], (num_segs, -1)
-                    )
-                    self.segments[idx_i:idx_f] += 1
-                else:
-                    # exactly fill or overfill===============================
-
-                    # fill the tail of the data_store buffer ----------------
-                    num_tailslot = self.databufferlen - self.idx_pointer
-                    idx_i = self.idx_pointer
-                    idx_f = self.databufferlen
-                    self.data_store[idx_i:idx_f, :] += np.reshape(
-                        self.rawraw[:num_tailslot], (num_tailslot, -1)
-                    )
-
-                    self.segments[idx_i:idx_f] += 1
-
-                    # fill the entire data_store buffer multiple times ----------------
-                    if count_fill > 1:
-                        to_add_unstructured = np.reshape(
-                            self.rawraw[
-                                num_tailslot : num_tailslot
-                                + (count_fill - 1) * self.databufferlen
-                            ],
-                            (count_fill - 1, self.databufferlen, -1),
-                        )
-                        self.data_store += np.sum(to_add_unstructured, axis=0)
-                        self.segments += count_fill - 1
-
-                    # fill the head of the data_store buffer for the remaining segments --------------
-                    self.data_store[:idx_pointer_new, :] += (
-                        np.reshape(
-                            self.rawraw[-idx_pointer_new:], (idx_pointer_new, -1)
-                        )
-                        if idx_pointer_new
-                        else self.data_store[:idx_pointer_new, :]
-                    )  # the if condition is needed to handle the case that the idx_pointer_new is 0
-                    self.segments[:idx_pointer_new] += 1
-            self.idx_pointer = idx_pointer_new
+                self.accumulator.add(data_block)
+        if shifted:
+            self.data_store += self.data_store_ma[-1]
+            self.segments += self.segments_ma[-1]
 
         # self.data_store_push = np.copy(self.data_store)
         # self.segments_push = np.copy(self.segments)
@@ -1574,7 +1769,14 @@ class Rabi_WDF(Measurement):
         # -----------------------------------------------------------------------
         return None
 
+    def _telemetry(self):
+        return stream_telemetry(hw.dig, self.acquisition)
+
     def average_repeated_data(self, arr, start, stop, segments):
+        if arr.ndim == 1:
+            # the segments were already integrated on arrival
+            averaged = arr / segments
+            return averaged[1::2], averaged[0::2]
         averaged_norm = np.mean(arr[:, start:stop], axis=1) / segments
         averaged_bg = (
             np.mean(arr[:, self.bgextend_size - 156 : self.bgextend_size - 56], axis=1)
@@ -1592,6 +1794,9 @@ class Rabi_WDF(Measurement):
             self.bgextend_size + 400,
             self.segments_push,
         )  # TODO: use parameters instead of fixed number to select integration window
+        # the stores hold summed ADC codes, convert them to voltage once here
+        self.no_mw = self.no_mw * self.volt_per_code
+        self.mw = self.mw * self.volt_per_code
 
         self.dataset["sig_mw"] = self.mw
         self.dataset["sig_nomw"] = self.no_mw
@@ -1602,6 +1807,13 @@ class Rabi_WDF(Measurement):
         return super()._organize_data()
 
     def _handle_exp_error(self):
+        try:
+            if getattr(self, "acquisition", None) is not None:
+                self.acquisition.stop()
+        except Exception as ee:
+            print("I tried to stop the acquisition thread but failed")
+            print(ee)
+
         try:
             hw.laser.laser_off()  # turn off laser
             hw.laser.set_diode_current(0.00, save_memory=False)
@@ -1648,6 +1860,8 @@ class Rabi_WDF(Measurement):
         # self.task_uca.close()
         # self.task_mwbp.stop()
         # self.task_mwbp.close()
+        if self.acquisition is not None:
+            self.acquisition.stop()
         hw.dig.stop_card()
         # hw.dig.reset()
         # reboot(optional) and close the MW synthesizer
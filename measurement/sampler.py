@@ -0,0 +1,149 @@
+"""
+Adaptive choice of the next point of a stepped sweep.
+
+A stepped measurement like pODMR visits one sweep point at a time and gets
+one noisy estimate of its contrast per visit. Spending the same number of
+visits on every point wastes most of the time on the flat baseline. The
+AdaptiveSampler keeps the running mean and variance of the estimates of every
+point and picks the point where one more visit reduces the variance of the
+spectrum the most, weighted up near features (dips or peaks off the
+baseline) and their neighbours. A fraction of the visits still goes to the
+least visited points, so the baseline and newly appearing features keep
+being sampled.
+
+Run this file directly for a small simulation of a Lorentzian dip.
+
+Author: ChunTung Cheung
+Email: ctcheung1123@gmail.com
+Created:  2026-10-18
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveSampler:
+    """
+    Running per-point statistics of a sweep and the choice of the next point.
+
+    Parameters:
+        num_point (int): number of points in the sweep.
+        gain (float): extra weight of a point whose mean is the furthest off the
+            baseline, the weight is 1 + gain * deviation / max deviation.
+        explore (float): fraction of the picks that go to the least visited point.
+        min_visit (int): visits every point gets before the statistics are used.
+        seed (int | None): seed of the random exploration.
+
+    Attributes:
+        count (np.ndarray): visits of every point.
+        mean (np.ndarray): mean of the values added to every point.
+    """
+
+    def __init__(self, num_point, gain=9.0, explore=0.1, min_visit=2, seed=None):
+        self.num_point = int(num_point)
+        self.gain = float(gain)
+        self.explore = float(explore)
+        self.min_visit = max(int(min_visit), 2)
+        self._rng = np.random.default_rng(seed)
+        self.reset()
+
+    def reset(self):
+        self.count = np.zeros(self.num_point, dtype=np.int64)
+        self.mean = np.zeros(self.num_point, dtype=np.float64)
+        self._m2 = np.zeros(self.num_point, dtype=np.float64)
+
+    def add(self, idx, value):
+        """Adds the value of one visit of point `idx` (Welford update)."""
+        self.count[idx] += 1
+        delta = value - self.mean[idx]
+        self.mean[idx] += delta / self.count[idx]
+        self._m2[idx] += delta * (value - self.mean[idx])
+
+    @property
+    def var(self):
+        """Sample variance of the values of every point, zero below two visits."""
+        return np.divide(
+            self._m2,
+            self.count - 1,
+            out=np.zeros(self.num_point),
+            where=self.count > 1,
+        )
+
+    def weights(self):
+        """Importance of every point, highest on and next to the features."""
+        deviation = np.abs(self.mean - np.median(self.mean))
+        # a feature also raises its neighbours, to resolve its flanks
+        deviation[1:] = np.maximum(deviation[1:], deviation[:-1])
+        deviation[:-1] = np.maximum(deviation[:-1], deviation[1:])
+        scale = np.max(deviation)
+        if scale == 0:
+            return np.ones(self.num_point)
+        return 1.0 + self.gain * deviation / scale
+
+    def score(self):
+        """Weighted reduction of the variance of the mean by one more visit of every point."""
+        var = self.var
+        # a point that happened to see similar values must not starve
+        var = np.maximum(var, 0.25 * np.median(var))
+        return self.weights() * var / (self.count * (self.count + 1.0))
+
+    def next(self):
+        """
+        Index of the point to visit next.
+
+        Returns:
+            int: the least visited point until every point has `min_visit`
+            visits, and for a fraction `explore` of the picks afterwards,
+            otherwise the point with the highest score.
+        """
+        if self.count.min() < self.min_visit or self._rng.random() < self.explore:
+            return int(np.argmin(self.count))
+        return int(np.argmax(self.score()))
+
+    def as_dict(self, prefix="ad_"):
+        """Flat dictionary of the visit counts, e.g. to put into a measurement's stateset."""
+        stats = dict(
+            num_visit=int(np.sum(self.count)),
+            min_visit=int(np.min(self.count)),
+            max_visit=int(np.max(self.count)),
+        )
+        return {prefix + key: value for key, value in stats.items()}
+
+
+def _lorentzian(freq, center, width, depth):
+    return -depth / (1.0 + ((freq - center) / (0.5 * width)) ** 2)
+
+
+def simulate(num_point=250, num_visit=20000, noise=0.02, depth=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    freq = np.linspace(-1.0, 1.0, num_point)
+    truth = _lorentzian(freq, 0.1, 0.06, depth)
+    in_line = np.abs(freq - 0.1) < 0.06
+
+    sampler = AdaptiveSampler(num_point, seed=seed)
+    for _ in range(num_visit):
+        idx = sampler.next()
+        sampler.add(idx, truth[idx] + noise * rng.standard_normal())
+    err_adaptive = np.sqrt(np.mean((sampler.mean[in_line] - truth[in_line]) ** 2))
+
+    count = num_visit // num_point
+    uniform = truth + noise * rng.standard_normal((count, num_point)).mean(axis=0)
+    err_uniform = np.sqrt(np.mean((uniform[in_line] - truth[in_line]) ** 2))
+
+    print(f"{num_visit} visits of {num_point} points, {np.sum(in_line)} on the line")
+    print(
+        f"   uniform:  {count} visits per point, rms error on the line {err_uniform:.2e}"
+    )
+    print(
+        f"   adaptive: {np.mean(sampler.count[in_line]):.0f} visits per line point, rms error on the line {err_adaptive:.2e}"
+    )
+    print(
+        f"   same precision as uniform in {(err_adaptive / err_uniform) ** 2:.2f}x the time"
+    )
+
+
+if __name__ == "__main__":
+    simulate()
@@ -6,7 +6,16 @@ import numpy as np
 import calibration.setting as clb
 import hardware.config as hcf
 from hardware.hardwaremanager import HardwareManager
-from hardware.pulser.pulser import OutputState, TriggerRearm, TriggerStart
+from hardware.pulser.builder import Block
+from hardware.pulser.pulser import (
+    AnalogPattern,
+    OutputState,
+    TriggerRearm,
+    TriggerStart,
+)
+from measurement.accumulator import SegmentAccumulator
+from measurement.acquisition import iter_raw_blocks
+from measurement.integration import IntegrationKernel
 from measurement.task_base import Measurement
 
 hw = HardwareManager()
@@ -169,6 +178,17 @@ class NuclearQuasiStaticTrack(Measurement):
         RF B + RF A
     """
 
+    resources = (
+        "pg",
+        "dig",
+        "laser",
+        "vdi",
+        "mwsyn",
+        "mwmod",
+        "windfreak",
+        "uf",
+    )
+
     # repeated ramsey sequence on sensors to extract the slow-dressing nuclear spin signals
     def __init__(self, name="default"):
         # ==some dictionaries stored with some default values--------------------------
@@ -308,6 +328,14 @@ class NuclearQuasiStaticTrack(Measurement):
         # n_seg = n_dbloc * 4  # number of readout segments per track
         # paraset["n_seg"] = n_seg
 
+        # the sequence trees give their durations without being expanded
+        seq_sensor, _ = self._sequence_sensor()
+        seq_target, _ = self._sequence_target()
+        assert seq_sensor.duration == seq_target.duration, (
+            f"Sensor ({seq_sensor.duration} ns) and target ({seq_target.duration} ns) sequences differ in length"
+        )
+        self.paraset["t_total"] = seq_sensor.duration
+
     def _sequence_sensor(self):
         t_prob_init_wait = self.paraset["t_prob_init_wait"]
         t_prob_mw_a_pio2 = self.paraset["t_prob_mw_a_pio2"]
@@ -327,25 +355,34 @@ class NuclearQuasiStaticTrack(Measurement):
         t_prep_empt = self.paraset["t_prep_empt"]
         # t_dbloc = self.paraset["t_dbloc"]
 
-        seq_prep = [([], t_prep_empt)] + [
-            (["laser"], t_prep_laser),
-            ([], t_prep_isc),
-        ] * n_prep_lpul
+        # the blocks stay symbolic, they are only expanded when compiled
+        seq_prep = (
+            Block([([], t_prep_empt)])
+            + Block(
+                [
+                    (["laser"], t_prep_laser),
+                    ([], t_prep_isc),
+                ]
+            )
+            * n_prep_lpul
+        )
 
         seq_prob_no_nodig = (
-            [([], t_prob_empt_fwd)]
-            + [
-                ([], t_prob_init_wait),
-                # (["mwA"], t_prob_mw_a_pio2),
-                ([], t_prob_mw_a_pio2),
-                ([], t_prob_phacc),
-                # (["mwA"], t_prob_mw_a_pio2),
-                ([], t_prob_mw_a_pio2),
-                ([], t_prob_read_wait),
-                (["laser"], t_prob_laser),
-            ]
+            Block([([], t_prob_empt_fwd)])
+            + Block(
+                [
+                    ([], t_prob_init_wait),
+                    # (["mwA"], t_prob_mw_a_pio2),
+                    ([], t_prob_mw_a_pio2),
+                    ([], t_prob_phacc),
+                    # (["mwA"], t_prob_mw_a_pio2),
+                    ([], t_prob_mw_a_pio2),
+                    ([], t_prob_read_wait),
+                    (["laser"], t_prob_laser),
+                ]
+            )
             * (n_dbloc_fwd + n_dbloc_bwd)
-            + [([], t_prob_empt_bwd)]
+            + Block([([], t_prob_empt_bwd)])
         )
 
         seq_pretrack = (
@@ -355,41 +392,45 @@ class NuclearQuasiStaticTrack(Measurement):
         )
 
         seq_prob_no = (
-            [([], t_prob_empt_fwd)]
-            + [
-                ([], t_prob_init_wait),
-                # (["mwA"], t_prob_mw_a_pio2),
-                ([], t_prob_mw_a_pio2),
-                ([], t_prob_phacc),
-                # (["mwA"], t_prob_mw_a_pio2),
-                ([], t_prob_mw_a_pio2),
-                ([], t_prob_read_wait),
-                (["laser", "sdtrig"], t_prob_laser),
-            ]
+            Block([([], t_prob_empt_fwd)])
+            + Block(
+                [
+                    ([], t_prob_init_wait),
+                    # (["mwA"], t_prob_mw_a_pio2),
+                    ([], t_prob_mw_a_pio2),
+                    ([], t_prob_phacc),
+                    # (["mwA"], t_prob_mw_a_pio2),
+                    ([], t_prob_mw_a_pio2),
+                    ([], t_prob_read_wait),
+                    (["laser", "sdtrig"], t_prob_laser),
+                ]
+            )
             * (n_dbloc_fwd + n_dbloc_bwd)
-            + [([], t_prob_empt_bwd)]
+            + Block([([], t_prob_empt_bwd)])
         )
         seq_prob = (
-            [([], t_prob_empt_fwd)]
-            + [
-                ([], t_prob_init_wait),
-                (["mwA"], t_prob_mw_a_pio2),
-                # ([], t_prob_mw_a_pio2),
-                ([], t_prob_phacc),
-                (["mwA"], t_prob_mw_a_pio2),
-                # ([], t_prob_mw_a_pio2),
-                ([], t_prob_read_wait),
-                (["laser", "sdtrig"], t_prob_laser),
-            ]
+            Block([([], t_prob_empt_fwd)])
+            + Block(
+                [
+                    ([], t_prob_init_wait),
+                    (["mwA"], t_prob_mw_a_pio2),
+                    # ([], t_prob_mw_a_pio2),
+                    ([], t_prob_phacc),
+                    (["mwA"], t_prob_mw_a_pio2),
+                    # ([], t_prob_mw_a_pio2),
+                    ([], t_prob_read_wait),
+                    (["laser", "sdtrig"], t_prob_laser),
+                ]
+            )
             * (n_dbloc_fwd + n_dbloc_bwd)
-            + [([], t_prob_empt_bwd)]
+            + Block([([], t_prob_empt_bwd)])
         )
         if self.paraset["emulate"]:
             seq = seq_prep + seq_prob_no + seq_prep + seq_prob
         else:
             seq = seq_prep + seq_prob + seq_prep + seq_prob
         # return seq * n_track
-        return seq_pretrack + seq * 2 * n_track, None
+        return seq_pretrack + seq * (2 * n_track), None
 
     def _sequence_target(self):
         t_rf_pio2 = self.paraset["t_rf_pio2"]
@@ -405,7 +446,7 @@ class NuclearQuasiStaticTrack(Measurement):
         seq_nolock = [([], t_lock_fwd)] + [([], t_lock_bwd)]
         seq_lockAB = [(["rfA", "BLK"], t_lock_fwd)] + [(["rfB", "BLK"], t_lock_bwd)]
         seq_lockBA = [(["rfB", "BLK"], t_lock_fwd)] + [(["rfA", "BLK"], t_lock_bwd)]
-        seq = (
+        seq = Block(
             seq_prlo_blk_fall
             + seq_nolock
             + seq_prlo_blk_rise
@@ -415,11 +456,13 @@ class NuclearQuasiStaticTrack(Measurement):
             + seq_prlo_blk_rise
             + seq_lockBA
         )
-        seq_pretrack = [
-            ([], t_track * MULTIPLE_PRESEQ_PAD - t_rf_pio2 - T_UBLK_PRERF),
-            (["BLK"], T_UBLK_PRERF),
-            (["rfB", "BLK"], t_rf_pio2),
-        ]
+        seq_pretrack = Block(
+            [
+                ([], t_track * MULTIPLE_PRESEQ_PAD - t_rf_pio2 - T_UBLK_PRERF),
+                (["BLK"], T_UBLK_PRERF),
+                (["rfB", "BLK"], t_rf_pio2),
+            ]
+        )
         return seq_pretrack + seq * n_track, None
 
     def _sequence_target_emulation(self):
@@ -445,7 +488,7 @@ class NuclearQuasiStaticTrack(Measurement):
         seq_lockAB = [(["rfA", "BLK"], t_lock_fwd)] + [(["rfB", "BLK"], t_lock_bwd)]
         seq_lockBA = [(["rfB", "BLK"], t_lock_fwd)] + [(["rfA", "BLK"], t_lock_bwd)]
 
-        seq = (
+        seq = Block(
             seq_prlo_blk_fall
             + seq_nolock
             + seq_prlo_blk_rise
@@ -456,72 +499,34 @@ class NuclearQuasiStaticTrack(Measurement):
             + seq_lockBA
         )
 
-        seq_pretrack = [
-            ([], t_track * MULTIPLE_PRESEQ_PAD - t_rf_pio2 - T_UBLK_PRERF),
-            (["BLK"], T_UBLK_PRERF),
-            (["rfB", "BLK"], t_rf_pio2),
-        ]
+        seq_pretrack = Block(
+            [
+                ([], t_track * MULTIPLE_PRESEQ_PAD - t_rf_pio2 - T_UBLK_PRERF),
+                (["BLK"], T_UBLK_PRERF),
+                (["rfB", "BLK"], t_rf_pio2),
+            ]
+        )
         seq_digi = seq_pretrack + seq * n_track
         # some analog seq --------------------------
         amp = self.paraset["emulate_volt"]
         omega = 2 * np.pi * self.paraset["emulate_acfreq"] * Hz
-        # wmf_fevo = [(t_fevo, 0)]
-        wmf_prlo = [(t_prlo, 0)]
-        wfm_anlg = [(t_track * MULTIPLE_PRESEQ_PAD, 0)]
-        for ii_track in range(n_track):
-            t_i_AB = ii_track * t_fevo * 2 + 1 * t_fevo
-            t_i_BA = ii_track * t_fevo * 2 + 2 * t_fevo
-            amp_mod_AB = amp * np.cos(omega * t_i_AB)
-            # amp_mod_AB = 0
-            amp_mod_BA = amp * np.cos(omega * t_i_BA)
-            # mz analog pattern in a spin lock
-            rabi_nuclear = 1.0 / t_rf_pio2 / 4.0
-            ac_samplerate = rabi_nuclear * 20.0  # 20 pt per period
-            dt = int(1 / ac_samplerate)
-            # n_dt = int(t_rf_pio2 * ac_samplerate)
-            # dt = int(t_rf_pio2 / n_dt)
-            ttt_fwd = np.arange(0.0, t_lock_fwd // dt * dt, dt)
-            ttt_bwd = np.arange(0.0, t_lock_bwd // dt * dt, dt)
-            ttt_fwd_end_compen = t_lock_fwd - len(ttt_fwd) * dt
-            ttt_bwd_end_compen = t_lock_bwd - len(ttt_bwd) * dt
-            # print(f" t pi/2 rf : {t_rf_pio2}")
-            # print(f"dt sampling time: {dt}")
-            # print(f" dt time total : {len(ttt_fwd)*dt}")
-            # print(f"forward ttt time end: {ttt_fwd[-1]}")
-            # print(f" forward lock time : {t_lock_fwd}")
-            # ttt_fwd = np.linspace(0.0, t_rf_pio2, n_dt, endpoint=True)
-            # ttt_bwd = np.linspace(0.0, t_rf_pio2, n_dt, endpoint=True)
-
-            mz_wave_fwd = np.sin(2 * np.pi * rabi_nuclear * ttt_fwd)
-            mz_wave_fwd_end = np.sin(2 * np.pi * rabi_nuclear * len(ttt_fwd) * dt)
-            mz_wave_bwd = np.sin(2 * np.pi * rabi_nuclear * (-ttt_bwd + t_lock_fwd))
-            mz_wave_bwd_end = np.sin(
-                2 * np.pi * rabi_nuclear * (-len(ttt_bwd) * dt + t_lock_fwd)
-            )
-
-            wfm_lock_AB = (
-                [(dt, amp_mod_AB * val) for val in mz_wave_fwd]
-                + [(ttt_fwd_end_compen, amp_mod_AB * mz_wave_fwd_end)]
-                + [(dt, amp_mod_AB * val) for val in mz_wave_bwd]
-                + [(ttt_bwd_end_compen, amp_mod_AB * mz_wave_bwd_end)]
-            )
-
-            wfm_lock_BA = (
-                [(dt, amp_mod_BA * val) for val in mz_wave_fwd]
-                + [(ttt_fwd_end_compen, amp_mod_BA * mz_wave_fwd_end)]
-                + [(dt, amp_mod_BA * val) for val in mz_wave_bwd]
-                + [(ttt_bwd_end_compen, amp_mod_BA * mz_wave_bwd_end)]
-            )
-            wfm_anlg += (
-                wmf_prlo
-                + wfm_lock_AB
-                + wmf_prlo
-                + wfm_lock_AB
-                + wmf_prlo
-                + wfm_lock_BA
-                + wmf_prlo
-                + wfm_lock_BA
-            )
+        # the emulated ac signal modulates the amplitude of every lock
+        idx_track = np.arange(n_track)
+        amp_mod_AB = amp * np.cos(omega * (idx_track * t_fevo * 2 + 1 * t_fevo))
+        amp_mod_BA = amp * np.cos(omega * (idx_track * t_fevo * 2 + 2 * t_fevo))
+        # mz analog pattern in a spin lock
+        rabi_nuclear = 1.0 / t_rf_pio2 / 4.0
+        ac_samplerate = rabi_nuclear * 20.0  # 20 pt per period
+        dt = int(1 / ac_samplerate)
+        wfm_lock = AnalogPattern.sine(
+            t_lock_fwd, dt, rabi_nuclear
+        ) + AnalogPattern.sine(t_lock_bwd, -dt, rabi_nuclear, t0=t_lock_fwd)
+        wfm_prlo_lock = AnalogPattern.constant(t_prlo, 0) + wfm_lock
+        wfm_anlg = AnalogPattern.constant(
+            t_track * MULTIPLE_PRESEQ_PAD, 0
+        ) + wfm_prlo_lock.tile(
+            np.stack([amp_mod_AB, amp_mod_AB, amp_mod_BA, amp_mod_BA], axis=1).ravel()
+        )
         return seq_digi, wfm_anlg
 
     def _setup_exp(self):
@@ -575,7 +580,12 @@ class NuclearQuasiStaticTrack(Measurement):
         # set the pulse sequence-------------------------------------------
         hw.pg.setClock10MHzExt()
         hw.pg.setTrigger(TriggerStart.SOFTWARE, rearm=TriggerRearm.MANUAL)
-        if self.paraset["emulate"]:
+        # reuse the sequence if only non-sequence parameters changed, e.g. on resume
+        seq_key = hw.pg.sequenceKey(self.__class__.__name__, self.paraset)
+        seq_info = hw.pg.restoreSequence(seq_key)
+        if seq_info is not None:
+            tt_seqs = seq_info["tt_seq"]
+        elif self.paraset["emulate"]:
             logger.info("Emulating the sequence")
             seq_sensor, _ = self._sequence_sensor()
             seq_target, wfm_emul = self._sequence_target_emulation()
@@ -585,7 +595,7 @@ class NuclearQuasiStaticTrack(Measurement):
             tt_seqt = hw.pg.setSequence(seq_target, reset=False)
             logger.info(f"tt_seqs = {tt_seqs}, tt_seqt = {tt_seqt}")
             assert tt_seqs == tt_seqt
-            hw.pg.stream(n_runs=1)
+            hw.pg.cacheSequence(seq_key, tt_seq=tt_seqs)
         else:
             seq_sensor, _ = self._sequence_sensor()
             tt_seqs = hw.pg.setSequence(seq_sensor, reset=True)
@@ -593,8 +603,8 @@ class NuclearQuasiStaticTrack(Measurement):
             tt_seqt = hw.pg.setSequence(seq_target, reset=False)
             logger.info(f"tt_seqs = {tt_seqs}, tt_seqt = {tt_seqt}")
             assert tt_seqs == tt_seqt
-
-            hw.pg.stream(n_runs=1)
+            hw.pg.cacheSequence(seq_key, tt_seq=tt_seqs)
+        hw.pg.stream(n_runs=1)
         tt_seq = tt_seqs
         # -----------------------------------------------------------------------
 
@@ -634,6 +644,7 @@ class NuclearQuasiStaticTrack(Measurement):
                 posttrig_size=posttrig_size,
                 segment_size=segment_size,
                 notify_size=notify_size,
+                zero_copy=True,
             )
         )
         logger.debug(
@@ -643,23 +654,17 @@ class NuclearQuasiStaticTrack(Measurement):
         # -----------------------------------------------------------------------
 
         # put some necessary variables in self-------------------------------------
+        self.volt_per_code = hw.dig.volt_per_code
         if not self.tokeep:
-            self.idx_pointer = 0
-            self.seg_count = np.zeros(
-                self.databufferlen,
-                dtype=np.float64,
-                order="C",
-            )
-            self.seg_store = np.zeros(
-                (self.databufferlen),
-                dtype=np.float64,
-                order="C",
+            # integrate every raw segment on arrival, only one scalar per slot is kept
+            self.kernel = IntegrationKernel(
+                clb.WEIGHT_FUNC_DEFAULT, background_range=(self.idx_bg_0, self.idx_bg_1)
             )
-            self.rawraw = np.zeros(
-                (self.databufferlen, segment_size, 1),
-                dtype=np.float64,
-                order="C",
+            self.accumulator = SegmentAccumulator(
+                self.databufferlen, reducer=self.kernel
             )
+            self.seg_count = self.accumulator.count
+            self.seg_store = self.accumulator.store
         # -----------------------------------------------------------------------
         # start the laser and digitizer then wait for trigger from the  pulse streamer--------------
         hw.laser.laser_on()  # turn on laser
@@ -702,75 +707,16 @@ class NuclearQuasiStaticTrack(Measurement):
             # hw.uf.pressurize(1)
             hw.pg.startNow()
 
-        self.rawraw = hw.dig.stream()
-        # logger.info(f"raw stream: {self.rawraw}")
-        if self.rawraw is not None:
-            num_segs = self.rawraw.shape[0]
-            idx_ptr_overflow = self.idx_pointer + num_segs
-            count_fill, idx_pointer_new = divmod(idx_ptr_overflow, self.databufferlen)
-            if count_fill < 1:
-                # underfill================================
-                # if the segment number is small to the remaining slot numbers in the buffer
-                idx_i = self.idx_pointer
-                idx_f = self.idx_pointer + num_segs
-                rawreshaped = np.reshape(self.rawraw[:num_segs], (num_segs, -1))
-                self.seg_store[idx_i:idx_f] += weighted_average_offset(
-                    rawreshaped,
-                    clb.WEIGHT_FUNC_DEFAULT,
-                    (self.idx_bg_0, self.idx_bg_1),
-                )
-                self.seg_count[idx_i:idx_f] += 1
-            else:
-                # exactly fill or overfill===============================
-
-                # fill the tail of the data_store buffer ----------------
-                num_tailslot = self.databufferlen - self.idx_pointer
-                idx_i = self.idx_pointer
-                idx_f = self.databufferlen
-                rawreshaped = np.reshape(self.rawraw[:num_tailslot], (num_tailslot, -1))
-                self.seg_store[idx_i:idx_f] += weighted_average_offset(
-                    rawreshaped,
-                    clb.WEIGHT_FUNC_DEFAULT,
-                    (self.idx_bg_0, self.idx_bg_1),
-                )
-
-                self.seg_count[idx_i:idx_f] += 1
-
-                # fill the entire data_store buffer multiple times ----------------
-                if count_fill > 1:
-                    to_add_unstructured = np.reshape(
-                        self.rawraw[
-                            num_tailslot : num_tailslot
-                            + (count_fill - 1) * self.databufferlen
-                        ],
-                        (count_fill - 1, self.databufferlen, -1),
-                    )
-                    repeatedsegments = np.sum(to_add_unstructured, axis=0)
-                    self.seg_store += weighted_average_offset(
-                        repeatedsegments,
-                        clb.WEIGHT_FUNC_DEFAULT,
-                        (self.idx_bg_0, self.idx_bg_1),
-                    )
-                    self.seg_count += count_fill - 1
-
-                # fill the head of the data_store buffer for the remaining segments --------------
-                if idx_pointer_new:
-                    # the if condition is needed to handle the case that the idx_pointer_new is 0
-                    rawreshaped = np.reshape(
-                        self.rawraw[-idx_pointer_new:], (idx_pointer_new, -1)
-                    )
-                    self.seg_store[:idx_pointer_new] += weighted_average_offset(
-                        rawreshaped,
-                        clb.WEIGHT_FUNC_DEFAULT,
-                        (self.idx_bg_0, self.idx_bg_1),
-                    )
-                self.seg_count[:idx_pointer_new] += 1
-            self.idx_pointer = idx_pointer_new
+        for data_block in iter_raw_blocks(hw.dig, accumulator=self.accumulator):
+            self.accumulator.add(data_block)
 
         self.idx_run = self.seg_count[-1]
         # -----------------------------------------------------------------------
         return None
 
+    def _telemetry(self):
+        return hw.dig.stats.as_dict()
+
     # TODO: Generalize the start stop, maybe add the SNR opt
     def _organize_data(self):
         t_fevo = self.paraset["t_fevo"]
@@ -779,7 +725,8 @@ class NuclearQuasiStaticTrack(Measurement):
         tau_BA = 2 * t_fevo * np.arange(0.0, n_track, 1.0) + 2 * t_fevo
         self.dataset["tau_AB"] = tau_AB
         self.dataset["tau_BA"] = tau_BA
-        seg_store_av = self.seg_store / self.seg_count
+        # the store holds integrated ADC codes, convert them to voltage here
+        seg_store_av = self.seg_store * (self.volt_per_code / self.seg_count)
         seg_store_av_rs = np.reshape(seg_store_av, (-1, self.paraset["n_dbloc"]))
         seg_store_av_av = np.mean(seg_store_av_rs, axis=1)
 
@@ -3,7 +3,7 @@ This script includes classes and functions to handle tasks with multi-threads an
 It is improved from the pi3diamond softwares developped in Jorg Wrachtrup group and Sen Yang group.
 
 The Singleton pattern is used to ensure that only one instance of the JobManager and Measurement class is created.
-The JobManager uses a thread to execute the run() method of the Job objects one by one according to their priority. The JobManager also provides a queue to store the Job objects, and a lock to protect the queue.
+The JobManager uses a thread to execute the run() method of the Job objects according to their priority, jobs that do not share hardware resources run at the same time. The JobManager also provides a queue to store the Job objects, and a lock to protect the queue.
 The Job class is an abstract class that has a run() method which is the main method to be executed by the JobManager. The run() method is supposed to be overridden in the subclass.
 The Measurement class is a subclass of Job and provides a template for a measurement task.
 It has a run() method that is NOT supposed to be overridden in the subclass
@@ -20,7 +20,10 @@ Created:  2023-03-03
 Modified: 2024-10-03
 """
 
+import collections
 import copy
+import heapq
+import itertools
 import logging
 import threading
 import time
@@ -33,10 +36,19 @@ import os
 import dill
 
 from logmodule import BACKUP_DIR
+from measurement.checkpoint import (
+    CHECKPOINT_EXT,
+    checkpoint_writer,
+    is_checkpoint,
+    read_checkpoint,
+    save_checkpoint,
+    take_snapshot,
+)
 
 INT_INF = np.iinfo(np.int32).max
 FLOAT_INF = np.finfo(np.float32).max
 BACKUP_FN = os.path.join(BACKUP_DIR, "temp.pkl")
+AUTOSAVE_INTERVAL = 600.0  # [s] default time between autosaves of a running measurement
 
 
 def save_instance(instance, filename):
@@ -72,6 +84,15 @@ def load_instance(filename):
         return instance
 
 
+def resources_conflict(resources_a, resources_b):
+    """
+    Whether two jobs claim the same hardware, None claims all of it.
+    """
+    if resources_a is None or resources_b is None:
+        return True
+    return not set(resources_a).isdisjoint(resources_b)
+
+
 def timestamp():
     """Returns the current time as a human readable string."""
     return time.strftime("%y%m%dh%Hm%Ms%S", time.localtime())
@@ -171,6 +192,16 @@ class JobManager(metaclass=Singleton):
     """
     Provides a queue for starting and stopping jobs according to their priority.
 
+    The queue is a heap of (-priority, order of submission, job) entries, so jobs
+    of the same priority run first come first served. The process loop sleeps
+    until something changes: a submit, a remove, a stop of the manager or the end
+    of a running job, which every job reports through a completion callback.
+
+    Jobs whose `resources` do not overlap run at the same time. A waiting job
+    preempts only the running jobs it conflicts with, and only if it has a
+    higher priority than all of them. A job that cannot start reserves its
+    resources, so jobs behind it in the queue cannot take them first.
+
     ToDo: In principle this need not be a singleton. Then there could be different job managers handling different sets of resources.
           However currently we need singleton since the JobManager is called explicitly on ManagedJob class.
     """
@@ -180,9 +211,42 @@ class JobManager(metaclass=Singleton):
         self.lock = (
             threading.Condition()
         )  # lock to control access to 'queue' and 'running'
-        self.queue = []
-        self.running = None
-        self.refresh_interval = 0.1  # seconds
+        self._heap = []  # [-priority, order of submission, job]
+        self._order = itertools.count()
+        self._active = []  # heap entries of the running jobs, kept for preemption
+        self._finished = collections.deque()  # (job, thread) of the runs that ended
+        self._wake = threading.Event()  # set whenever the process loop has work
+
+    @property
+    def queue(self):
+        """The waiting jobs, in the order they will be started."""
+        with self.lock:
+            return [entry[-1] for entry in sorted(self._heap)]
+
+    @property
+    def running_jobs(self):
+        """The running jobs, highest priority first."""
+        with self.lock:
+            return [entry[-1] for entry in sorted(self._active)]
+
+    @property
+    def running(self):
+        """The running job of the highest priority, None if no job is running."""
+        jobs = self.running_jobs
+        return jobs[0] if jobs else None
+
+    def _queued(self, job):
+        return any(entry[-1] is job for entry in self._heap)
+
+    def _is_running(self, job):
+        return any(entry[-1] is job for entry in self._active)
+
+    def _on_job_done(self, job):
+        # called from the job's thread, must not wait for the lock
+        # the thread is still alive here, so the run is recorded for _schedule
+        logger.debug("Job " + str(job) + " finished. Waking the process thread.")
+        self._finished.append((job, threading.current_thread()))
+        self._wake.set()
 
     def submit(self, job):
         """
@@ -192,35 +256,28 @@ class JobManager(metaclass=Singleton):
 
         If the job is the running job or the job is already in the queue, do nothing.
 
-        If job.priority =< priority of the running job,
-            the job is appended to the queue and the queue sorted according to priority.
+        If the job conflicts with a running job of the same or higher priority,
+            the job waits in the queue behind the jobs of higher or the same priority.
 
-        If job.priority > priority of the running job,
-            the job is inserted at the first position of the queue, the running job is stopped
-            and inserted again at the first position of the queue.
+        If job.priority > priority of all the running jobs it conflicts with,
+            those jobs are paused and put back into the queue, and the job is started.
+
+        A job that conflicts with no running job is started right away.
         """
 
         logger.debug("Attempt to submit job " + str(job))
-        self.lock.acquire()
-
-        running = self.running
-        queue = self.queue
-
-        if job is running or job in queue:
-            logger.info("The job " + str(job) + " is already running or in the queue.")
-            self.lock.release()
-            return
+        with self.lock:
+            if self._is_running(job) or self._queued(job):
+                logger.info(
+                    "The job " + str(job) + " is already running or in the queue."
+                )
+                return
 
-        job._set_state("wait")
-        queue.append(job)
-        queue.sort(
-            key=lambda job: job.priority, reverse=True
-        )  # ToDo: Job sorting not thoroughly tested
+            job._set_state("wait")
+            heapq.heappush(self._heap, [-job.priority, next(self._order), job])
 
         logger.debug("Notifying process thread.")
-        self.lock.notify()
-
-        self.lock.release()
+        self._wake.set()
         logger.debug("Job " + str(job) + " submitted.")
 
     def remove(self, job):
@@ -238,24 +295,26 @@ class JobManager(metaclass=Singleton):
         self.lock.acquire()
 
         try:
-            if job is self.running:
+            if self._is_running(job):
                 logger.debug("Job " + str(job) + " is running. Attempt stop.")
                 job.stop()
                 logger.debug("Job " + str(job) + " removed.")
             else:
-                if job not in self.queue:
+                if not self._queued(job):
                     logger.debug(
                         "Job " + str(job) + " neither running nor in queue. Returning."
                     )
                 else:
                     logger.debug("Job " + str(job) + " is in queue. Attempt remove.")
-                    self.queue.remove(job)
+                    self._heap = [entry for entry in self._heap if entry[-1] is not job]
+                    heapq.heapify(self._heap)
                     logger.debug("Job " + str(job) + " removed.")
             job._set_state(
                 "idle"
             )  # ToDo: improve handling of state. Move handling to Job?
         finally:
             self.lock.release()
+        self._wake.set()
 
     def start(self):
         """Start the process loop in a thread."""
@@ -265,16 +324,78 @@ class JobManager(metaclass=Singleton):
         self._thread = StoppableThread(
             target=self._process, name=self.__class__.__name__ + timestamp()
         )
+        self._wake.set()  # jobs may have been submitted before the loop started
         self._thread.start()
 
     def stop(self, timeout=None):
         """Stop the process loop."""
         self._thread.stop_request.set()
-        self.lock.acquire()
-        self.lock.notify()
-        self.lock.release()
+        self._wake.set()
         self._thread.stop(timeout=timeout)
 
+    def _start(self, entry):
+        job = entry[-1]
+        self._active.append(entry)
+        logger.debug("Found job " + str(job) + ". Starting.")
+        job.add_done_callback(self._on_job_done)
+        job.start()
+
+    def _preempt(self, entry):
+        job = entry[-1]
+        logger.debug("Attempt to stop running job " + str(job) + ".")
+        job.pause()
+        self._active.remove(entry)
+        if job.state != "done":
+            logger.debug("Reinserting job " + str(job) + " in queue.")
+            # keeps its order of submission, so it resumes before later jobs
+            heapq.heappush(self._heap, entry)
+            job.state = "wait"
+
+    def _schedule(self):
+        """Starts, finishes or preempts jobs, called with the lock held."""
+        while self._finished:
+            job, thread = self._finished.popleft()
+            thread.join()  # only the remaining done callbacks are left to run
+            # a preempted job may already run again in a new thread
+            for entry in [
+                ee for ee in self._active if ee[-1] is job and job._thread is thread
+            ]:
+                logger.debug("Job " + str(job) + " stopped.")
+                self._active.remove(entry)
+        if not self._heap:
+            if not self._active:
+                logger.debug(
+                    "No job running. No job in queue. Waiting for notification."
+                )
+            return
+        reserved = []  # resources of the waiting jobs that could not start
+        for entry in sorted(self._heap):
+            job = entry[-1]
+            if any(resources_conflict(job.resources, rr) for rr in reserved):
+                reserved.append(job.resources)
+                continue
+            blocking = [
+                ee
+                for ee in self._active
+                if resources_conflict(job.resources, ee[-1].resources)
+            ]
+            if any(ee[-1].priority >= job.priority for ee in blocking):
+                reserved.append(job.resources)
+                continue
+            if blocking:
+                logger.debug(
+                    "Found job "
+                    + str(job)
+                    + " in queue with higher priority than the running jobs it conflicts with."
+                )
+            for ee in blocking:
+                self._preempt(ee)
+                # the paused job keeps its place ahead of the jobs behind it
+                reserved.append(ee[-1].resources)
+            self._heap.remove(entry)
+            heapq.heapify(self._heap)
+            self._start(entry)
+
     def _process(self):
         """
         The process loop.
@@ -283,54 +404,14 @@ class JobManager(metaclass=Singleton):
         """
 
         while True:
-            self._thread.stop_request.wait(self.refresh_interval)
+            self._wake.wait()
+            self._wake.clear()
             if self._thread.stop_request.is_set():
                 break
 
-            # ToDo: jobs can be in queue before process loop is started
-            # what happens when manager is stopped while jobs are running?
-
-            self.lock.acquire()
-            if self.running is None:
-                if self.queue == []:
-                    logger.debug(
-                        "No job running. No job in queue. Waiting for notification."
-                    )
-                    self.lock.wait()
-                    logger.debug("Caught notification.")
-                    if self._thread.stop_request.is_set():
-                        self.lock.release()
-                        break
-                logger.debug("Attempt to fetch first job in queue.")
-                self.running = self.queue.pop(0)
-                logger.debug("Found job " + str(self.running) + ". Starting.")
-                self.running.start()
-            elif not self.running._thread.is_alive():
-                logger.debug("Job " + str(self.running) + " stopped.")
-                self.running = None
-                if self.queue != []:
-                    logger.debug("Attempt to fetch first job in queue.")
-                    self.running = self.queue.pop(0)
-                    logger.debug("Found job " + str(self.running) + ". Starting.")
-                    self.running.start()
-            elif self.queue != [] and self.queue[0].priority > self.running.priority:
-                logger.debug(
-                    "Found job "
-                    + str(self.queue[0])
-                    + " in queue with higher priority than running job. Attempt to stop running job."
-                )
-                self.running.pause()
-                if self.running.state != "done":
-                    logger.debug("Reinserting job " + str(self.running) + " in queue.")
-                    self.queue.insert(0, self.running)
-                    self.queue.sort(
-                        key=lambda job: job.priority, reverse=True
-                    )  # ToDo: Job sorting not thoroughly tested
-                    self.running.state = "wait"
-                self.running = self.queue.pop(0)
-                logger.debug("Found job " + str(self.running) + ". Starting.")
-                self.running.start()
-            self.lock.release()
+            # ToDo: what happens when manager is stopped while jobs are running?
+            with self.lock:
+                self._schedule()
 
 
 class Job(metaclass=Singleton):
@@ -340,6 +421,8 @@ class Job(metaclass=Singleton):
 
     priority = 1  # from 1 to 10
     state = "idle"  # 'idle', 'run', 'wait', 'done', 'error'
+    # names of the HardwareManager attributes the job uses, None claims all of them
+    resources = None
     tokeep = (
         False  # whether to keep the data when the thread is stopped (idx_run<=num_run)
     )
@@ -350,6 +433,8 @@ class Job(metaclass=Singleton):
     idx_run = 0  # indicating which iteration we are at, 1-based
 
     _filename_backup = BACKUP_FN
+    # job -> completion callbacks, kept off the instance so backups do not pickle them
+    _done_callbacks = dict()
 
     def __init__(self, name="default"):
         self._name = self.__class__.__name__ + "-" + name
@@ -403,10 +488,26 @@ class Job(metaclass=Singleton):
     # methods for handling the run thread====================================
     def start(self):
         self._thread = StoppableThread(
-            target=self._run, name=self.__class__.__name__ + str(time.time())
+            target=self._run_thread, name=self.__class__.__name__ + str(time.time())
         )
         self._thread.start()
 
+    def add_done_callback(self, callback):
+        """Registers callback(job), called from the job's thread whenever a run ends."""
+        callbacks = Job._done_callbacks.setdefault(self, [])
+        if callback not in callbacks:
+            callbacks.append(callback)
+
+    def _run_thread(self):
+        try:
+            self._run()
+        finally:
+            for callback in list(Job._done_callbacks.get(self, ())):
+                try:
+                    callback(self)
+                except Exception:
+                    logger.exception("Error in the done callback of " + str(self))
+
     def pause(self, timeout=None):
         """Stop the process loop."""
         self._set_state("wait")
@@ -421,33 +522,46 @@ class Job(metaclass=Singleton):
         self._thread.stop(timeout=timeout)
 
     # methods for handling the temperary backup for the class instance====================================
+    def _checkpoint_dirname(self):
+        # one checkpoint per job, repeated backups only rewrite the arrays that changed
+        return os.path.join(BACKUP_DIR, self.get_name() + CHECKPOINT_EXT)
+
     def _backup(self):
-        self._filename_backup = timestamp() + "_" + self.get_name() + ".pkl"
-        self._filename_backup = os.path.join(BACKUP_DIR, self._filename_backup)
-        save_instance(self, self._filename_backup)
+        self._filename_backup = self._checkpoint_dirname()
+        # an autosave still being written goes to the same directory
+        checkpoint_writer.wait(self._filename_backup)
+        return save_checkpoint(self, self._filename_backup)
 
     def save(self, filename: str = None):
         """
-        Save the current instance to a file.
+        Save the current instance to a checkpoint directory, or to a dill file
+        if the filename ends with '.pkl'.
         """
         if filename is None:
             self._backup()
         else:
             self._filename_backup = filename
-            save_instance(self, self._filename_backup)
+            if filename.endswith(".pkl"):
+                save_instance(self, self._filename_backup)
+            else:
+                save_checkpoint(self, self._filename_backup)
 
     def load(self, filename=None):
         """
-        Reload the instance's state from a file, skipping certain attributes.
+        Reload the instance's state from a checkpoint or a dill file, skipping certain attributes.
+        The arrays of a checkpoint are mapped from the disk and read when they are used.
         """
         if filename is None:
             filename = self._filename_backup
         if not filename:
             raise ValueError("Filename must be provided.")
-        loaded_instance = load_instance(filename)
+        if is_checkpoint(filename):
+            _, state = read_checkpoint(filename)
+        else:
+            state = load_instance(filename).__dict__
 
         # Update the current instance's attributes, skipping protected ones
-        for key, value in loaded_instance.__dict__.items():
+        for key, value in state.items():
             if not key.startswith("_"):  # Skip attributes starting with '_'
                 self.__dict__[key] = value
 
@@ -530,6 +644,8 @@ class Measurement(Job):
     # !!< has to be specific by users>
     __dataset = dict()  # store all signals from measurements
     # ==--------------------------------------------------------------------------
+    autosave_interval = AUTOSAVE_INTERVAL  # [s] between autosaves, None for none
+    autosave_every = None  # runs between autosaves, None for none
 
     def __init__(
         self,
@@ -558,6 +674,17 @@ class Measurement(Job):
         super().set_stoptime(time)
         self.stateset["time_stop"] = self.time_stop
 
+    def set_autosave(self, interval: float = AUTOSAVE_INTERVAL, every: int = None):
+        """
+        Sets how often a running measurement is checkpointed in the background.
+
+        Parameters:
+            interval (float | None): seconds between autosaves, None to not save by time.
+            every (int | None): runs between autosaves, None to not save by runs.
+        """
+        self.autosave_interval = interval
+        self.autosave_every = every
+
     def reset_paraaset(self):
         # initialize the dataset structure
         self.paraset = copy.deepcopy(self.__paraset)
@@ -654,6 +781,40 @@ class Measurement(Job):
             idx_run=self.idx_run,
             num_run=self.num_run,
         )
+        self.stateset.update(self._telemetry())
+        self.stateset.update(checkpoint_writer.as_dict(self._checkpoint_dirname()))
+
+    def _autosave(self):
+        """
+        Hands a snapshot to the background checkpoint writer when an autosave is due.
+        The loop never waits for the disk: while the previous autosave is still
+        being written, the autosave is retried after the next run.
+        """
+        due_time = (
+            self.autosave_interval is not None
+            and time.time() - self._time_autosave >= self.autosave_interval
+        )
+        due_run = self.autosave_every and self.idx_run % self.autosave_every == 0
+        if not (due_time or due_run):
+            return
+        dirname = self._checkpoint_dirname()
+        if checkpoint_writer.busy(dirname):
+            logger.debug(f"Previous autosave of {self._name} still pending.")
+            return
+        checkpoint_writer.submit(take_snapshot(self, copy=True), dirname)
+        self._time_autosave = time.time()
+
+    def _telemetry(self):
+        """
+        Health counters of the hardware, e.g. digitizer overruns, to be put into the stateset.
+
+        Overwrite this method to report them, it is called by _organize_data().
+
+        Returns
+        -------
+        dict
+        """
+        return dict()
 
     def _handle_exp_error(self):
         """
@@ -719,6 +880,7 @@ class Measurement(Job):
                 self.reset_dataset()
             self._set_state("run")
             time_start = time.time() - self.time_run
+            self._time_autosave = time.time()
             logger.info(f"Task {self._name} is running...")
             for _ in range(self.num_run):
                 self._thread.stop_request.wait(self._refresh_interval)
@@ -739,6 +901,7 @@ class Measurement(Job):
                 self.time_run = time_now - time_start
 
                 self._organize_data()  # !! <defined by users>
+                self._autosave()
 
             logger.info(f"Task {self._name} is stopping...")
             logger.debug("Back up the task")
@@ -773,6 +936,8 @@ class Measurement(Job):
 
 
 class DummyMeasurement(Measurement):
+    resources = ()  # no hardware
+
     def __init__(self, name="dumdefault"):
         # ==some dictionaries stored with some default values--------------------------
         # __stateset = super().__stateset.copy()
@@ -898,4 +1063,29 @@ if __name__ == "__main__":
     print([q.index(job) if job in q else None for job in jobs])
 
     time.sleep(10)
+    for job in [dmmm1] + jobs:
+        jobmanager.remove(job)
+
+    """
+    Test back-to-back jobs that claim the same hardware
+    """
+
+    job_a = DummyMeasurement(name="claim_a")
+    job_b = DummyMeasurement(name="claim_b")
+    for job in (job_a, job_b):
+        job.resources = None  # claims all the hardware
+        job.set_runnum(3)
+    jobmanager.submit(job_a)
+    time.sleep(0.05)
+    # a slow callback after the one of the manager keeps the thread of job_a
+    # alive after it reported its end
+    job_a.add_done_callback(lambda job: time.sleep(0.05))
+    jobmanager.submit(job_b)
+    time_limit = time.time() + 10.0
+    while job_b.state != "done" and time.time() < time_limit:
+        time.sleep(0.05)
+    print("Back-to-back conflicting jobs,")
+    print(f"   states: {job_a.state}, {job_b.state}")
+    print(f"   running: {jobmanager.running_jobs}, queue: {jobmanager.queue}")
+    assert job_b.state == "done", "the second job never started"
     jobmanager.stop(1)
@@ -7,39 +7,49 @@ from hardware import config as hcf
 from hardware.hardwaremanager import HardwareManager
 from hardware.pulser.pulser import (
     REPEAT_INFINITELY,
+    AnalogPattern,
     OutputState,
     TriggerRearm,
     TriggerStart,
 )
+from measurement.accumulator import RunningStats, SegmentAccumulator
+from measurement.acquisition import (
+    AcquisitionWorker,
+    iter_raw_blocks,
+    stream_telemetry,
+)
+from measurement.integration import IntegrationKernel, MatchedFilterEstimator
 from measurement.task_base import Measurement
 
 logger = logging.getLogger(__name__)
 hw = HardwareManager()
 
 
-def average_repeated_data(seg_store, seg_count, start, stop, bgextend_size=256):
-    # average over repetitions -------------------------------------
-    averaged_norm = np.mean(seg_store[:, start:stop], axis=1) / seg_count
-    # get the apd bias background --------------------
-    averaged_bg = (
-        np.mean(seg_store[:, bgextend_size - 156 : bgextend_size - 56], axis=1)
-        / seg_count
-    )  # TODO: use parameters instead of fixed number to select background
+def average_repeated_data(seg_store, seg_count, kernel, volt_per_code=1.0):
+    # average over repetitions, seg_store may hold summed raw ADC codes ----------
+    # slots without segments yet (e.g. a part of a split sweep) stay zero
+    averaged = np.divide(
+        seg_store * volt_per_code,
+        seg_count[:, None],
+        out=np.zeros(seg_store.shape),
+        where=seg_count[:, None] > 0,
+    )
+    # weighted integration with the apd bias background subtracted --------------
+    integrated = kernel.reduce(averaged)
 
-    # offset the apd reading by the electronic background --------------------
     idx_tsbegin = 2
-    dark = averaged_norm[0] - averaged_bg[0]
-    bright = averaged_norm[1] - averaged_bg[1]
-    weight = np.abs(bright - dark)
-    weight = weight / np.sum(weight)  # normalize the weight
-    sig_p = averaged_norm[idx_tsbegin::2] - averaged_bg[idx_tsbegin::2]
-    sig_n = averaged_norm[idx_tsbegin + 1 :: 2] - averaged_bg[idx_tsbegin + 1 :: 2]
-    # perform weighted integration---------------------------------------------
-    sig_p_int = sig_p * weight
-    sig_n_int = sig_n * weight
-    dark_int = dark * weight
-    bright_int = bright * weight
-    return dark_int, bright_int, sig_p_int, sig_n_int
+    dark = integrated[0]
+    bright = integrated[1]
+    sig_p = integrated[idx_tsbegin::2]
+    sig_n = integrated[idx_tsbegin + 1 :: 2]
+    return dark, bright, sig_p, sig_n
+
+
+def repeated_data_error(sem, volt_per_code=1.0):
+    # standard errors of the integrated slots, in the order of average_repeated_data
+    err = sem * volt_per_code
+    idx_tsbegin = 2
+    return err[0], err[1], err[idx_tsbegin::2], err[idx_tsbegin + 1 :: 2]
 
 
 def seq_init(init_nslaser: int, init_isc: int, init_wait: int, init_repeat: int):
@@ -51,6 +61,8 @@ def seq_read(read_wait: int, read_laser: int):
 
 
 class TimeSweep(Measurement):
+    resources = ("pg", "dig", "laser", "vdi", "mwsyn", "mwmod")
+
     _para_seq = dict()  # can be overridden in subclasses
 
     def __init__(self, name="default"):
@@ -62,6 +74,10 @@ class TimeSweep(Measurement):
             mw_powervolt=5.0,  # voltage 0.0 to 5.0
             mw_phasevolt=7.72,  # voltage 0.0 to 5.0
             amp_input=1000,  # input amplitude for digitizer
+            acq_thread=False,  # read the digitizer in a background thread
+            matched_filter=True,  # refine the integration weights from the references
+            error_bars=False,  # standard errors of the box window, not with matched_filter
+            chunk_dwell=2.0,  # [s] time on each part of a sweep too long for the pulse streamer
             bgextend_size=256,  # TODO: why 256? is it a fixed number?
             # -------------------
             init_nslaser=50,  # [ns]
@@ -91,6 +107,10 @@ class TimeSweep(Measurement):
             sig_n=np.zeros(10),
             bright=0.0,
             dark=0.0,
+            sig_p_err=np.zeros(10),
+            sig_n_err=np.zeros(10),
+            bright_err=0.0,
+            dark_err=0.0,
         )
 
         super().__init__(name, __paraset, __dataset)
@@ -99,8 +119,8 @@ class TimeSweep(Measurement):
         tau_ext = 0.0
         return [([], tau)], tau_ext
 
-    def _sequence(self):
-        # dark ref + dark ref + tau sweep sequence
+    def _sequence(self, tau_slice=slice(None)):
+        # dark ref + dark ref + tau sweep sequence, tau_slice selects part of the sweep
         sq_init = seq_init(
             self.paraset["init_nslaser"],
             self.paraset["init_isc"],
@@ -120,8 +140,8 @@ class TimeSweep(Measurement):
         tau_begin = self.paraset["tau_begin"]
         tau_end = self.paraset["tau_end"]
         tau_step = self.paraset["tau_step"]
-        tauarray = np.arange(tau_begin, tau_end + tau_step, tau_step)
-        tauaprime = np.arange(tau_begin, tau_end + tau_step, tau_step)
+        tauarray = np.arange(tau_begin, tau_end + tau_step, tau_step)[tau_slice]
+        tauaprime = np.arange(tau_begin, tau_end + tau_step, tau_step)[tau_slice]
 
         for ii, tau in enumerate(tauarray):
             sq_ts, tau_ext = self._sequence_ts(tau)
@@ -149,12 +169,33 @@ class TimeSweep(Measurement):
         # # -----------------------------------------------------------------------
 
         # set the pulse sequence-------------------------------------------
-        start = time.time()
-        seq_exp, tau_arr = self._sequence()
-        end = time.time()
-        logger.info(f"Time taken for generating sequence: {end - start:.4f} seconds")
+        # reuse the sequence if only non-sequence parameters changed, e.g. on resume
+        seq_key = hw.pg.sequenceKey(self.__class__.__name__, self.paraset)
+        seq_info = hw.pg.restoreSequence(seq_key)
+        if seq_info is None:
+            start = time.time()
+            seq_exp, tau_arr = self._sequence()
+            end = time.time()
+            logger.info(
+                f"Time taken for generating sequence: {end - start:.4f} seconds"
+            )
 
-        tt_seq = hw.pg.setSequence(seq_exp, reset=True)
+            # a sweep too long for the pulse streamer is split into parts over tau,
+            # each with its own references, which are streamed in turn
+            def sequence_part(idx_start, idx_stop):
+                return self._sequence(slice(idx_start, idx_stop))[0]
+
+            chunks = hw.pg.planSequence(seq_exp, len(tau_arr), sequence_part)
+            hw.pg.setSequence(chunks[0][1], reset=True)
+            seq_info = hw.pg.cacheSequence(
+                seq_key,
+                tt_seq=max(seq_chunk.total_time for _, seq_chunk in chunks),
+                tau_arr=tau_arr,
+                chunks=chunks,
+            )
+        tt_seq = seq_info["tt_seq"]
+        tau_arr = seq_info["tau_arr"]
+        self.chunks = seq_info["chunks"]
         hw.pg.setTrigger(TriggerStart.SOFTWARE, rearm=TriggerRearm.AUTO)
         hw.pg.setClock10MHzExt()
         hw.pg.stream(n_runs=REPEAT_INFINITELY)
@@ -164,7 +205,11 @@ class TimeSweep(Measurement):
         read_wait = self.paraset["read_wait"]
         read_laser = self.paraset["read_laser"]
         self.tau_arr_num = len(tau_arr)
-        self.databufferlen = 2 * self.tau_arr_num + 2
+        # segments of each part of the sweep, the digitizer buffers for the largest
+        num_slots = [
+            2 * (idx_stop - idx_start) + 2 for (idx_start, idx_stop), _ in self.chunks
+        ]
+        self.databufferlen = max(num_slots)
 
         rate_refresh = self.paraset[
             "rate_refresh"
@@ -203,6 +248,7 @@ class TimeSweep(Measurement):
                 pretrig_size=pretrig_size + self.bgextend_size,  # TODO: why 256?
                 posttrig_size=posttrig_size - self.bgextend_size,
                 segment_size=segment_size,
+                zero_copy=True,
             )
         )
         logger.debug(
@@ -213,99 +259,176 @@ class TimeSweep(Measurement):
         # -----------------------------------------------------------------------
 
         # put some necessary variables in self-------------------------------------
+        self.acquisition = None
         self.tau_arr = tau_arr
+        self.volt_per_code = hw.dig.volt_per_code
         if not self.tokeep:
-            self.idx_pointer = 0
             self.dataset["tau"] = self.tau_arr
             # self.dataset["bright"] = 0.0
             # self.dataset["dark"] = 0.0
             self.dataset["sig_p"] = np.zeros(self.tau_arr_num)
             self.dataset["sig_n"] = np.zeros(self.tau_arr_num)
-            self.seg_count = np.zeros(
-                self.databufferlen,
-                dtype=np.float64,
-                order="C",
-            )
-            self.seg_store = np.zeros(
-                (self.databufferlen, segment_size),
-                dtype=np.float64,
-                order="C",
-            )
+            self._setup_store(segment_size, num_slots)
+        self._select_chunk(0)
         # -----------------------------------------------------------------------
         # start the laser and digitizer then wait for trigger from the  pulse streamer--------------
         hw.laser.laser_on()  # turn on laser
         hw.dig.start_buffer()
+        if self.paraset["acq_thread"]:
+            self.acquisition = AcquisitionWorker(hw.dig).start()
         # logger.debug("Start the trigger from the pulse streamer")
         hw.pg.startNow()
-
-    def _run_exp(self):
-        self.rawraw = hw.dig.stream()
-        if self.rawraw is not None:
-            num_segs = self.rawraw.shape[0]
-            idx_ptr_overflow = self.idx_pointer + num_segs
-            count_fill, idx_pointer_new = divmod(idx_ptr_overflow, self.databufferlen)
-            if count_fill < 1:
-                # underfill================================
-                # if the segment number is small to the remaining slot numbers in the buffer
-                idx_i = self.idx_pointer
-                idx_f = self.idx_pointer + num_segs
-                self.seg_store[idx_i:idx_f, :] += np.reshape(
-                    self.rawraw[:num_segs], (num_segs, -1)
-                )
-                self.seg_count[idx_i:idx_f] += 1
-            else:
-                # exactly fill or overfill===============================
-
-                # fill the tail of the data_store buffer ----------------
-                num_tailslot = self.databufferlen - self.idx_pointer
-                idx_i = self.idx_pointer
-                idx_f = self.databufferlen
-                self.seg_store[idx_i:idx_f, :] += np.reshape(
-                    self.rawraw[:num_tailslot], (num_tailslot, -1)
+        self._stage_next_chunk()
+
+    def _setup_store(self, segment_size, num_slots=None):
+        # sum raw ADC codes exactly, convert to voltage in _organize_data
+        # one accumulator per part of a split sweep, see _switch_chunk
+        num_slots = [self.databufferlen] if num_slots is None else num_slots
+        # box window until the matched filter has seen enough references
+        self.kernel = IntegrationKernel(
+            signal_range=(self.bgextend_size + 160, self.bgextend_size + 400),
+            background_range=(self.bgextend_size - 156, self.bgextend_size - 56),
+        )  # TODO: use parameters instead of fixed number to select background
+        # per-segment values can not follow the changing matched-filter weights,
+        # error bars of another window would not belong to the plotted values
+        stats = self.paraset["error_bars"]
+        if stats and self.paraset["matched_filter"]:
+            logger.warning("Error bars are not available with the matched filter.")
+            stats = False
+        self.accumulators = [
+            SegmentAccumulator(
+                num_slot,
+                segment_size,
+                dtype=np.int64,
+                stats=stats,
+                stats_reducer=self.kernel,
+            )
+            for num_slot in num_slots
+        ]
+        self._select_chunk(0)
+        if self.paraset["matched_filter"]:
+            self.matched_filter = MatchedFilterEstimator(
+                self.databufferlen,
+                segment_size,
+                dark_slot=0,
+                bright_slot=1,
+                search_range=(self.bgextend_size, segment_size),
+            )
+        else:
+            self.matched_filter = None
+
+    def _select_chunk(self, idx_chunk):
+        self.idx_chunk = idx_chunk
+        self.t_chunk = time.time()
+        self.accumulator = self.accumulators[idx_chunk]
+        self.accumulator.pointer = 0  # the sequence restarts from its first segment
+        self.seg_count = self.accumulator.count
+        self.seg_store = self.accumulator.store
+
+    def _fold_blocks(self):
+        # fold the raw ADC codes straight from the DMA buffer or acquisition ring
+        for data_block in iter_raw_blocks(hw.dig, self.acquisition, self.accumulator):
+            if self.matched_filter is not None:
+                self.matched_filter.add(
+                    data_block, self.accumulator.pointer, self.accumulator.num_slot
                 )
+            self.accumulator.add(data_block)
 
-                self.seg_count[idx_i:idx_f] += 1
-
-                # fill the entire data_store buffer multiple times ----------------
-                if count_fill > 1:
-                    to_add_unstructured = np.reshape(
-                        self.rawraw[
-                            num_tailslot : num_tailslot
-                            + (count_fill - 1) * self.databufferlen
-                        ],
-                        (count_fill - 1, self.databufferlen, -1),
-                    )
-                    self.seg_store += np.sum(to_add_unstructured, axis=0)
-                    self.seg_count += count_fill - 1
-
-                # fill the head of the data_store buffer for the remaining segments --------------
-                self.seg_store[:idx_pointer_new, :] += (
-                    np.reshape(self.rawraw[-idx_pointer_new:], (idx_pointer_new, -1))
-                    if idx_pointer_new
-                    else self.seg_store[:idx_pointer_new, :]
-                )  # the if condition is needed to handle the case that the idx_pointer_new is 0
-                self.seg_count[:idx_pointer_new] += 1
-            self.idx_pointer = idx_pointer_new
-
-        self.idx_run = self.seg_count[-1]
+    def _switch_chunk(self, idx_chunk):
+        # stop the sequence and the card, so no segment of the old part is read
+        # into the new one, then stream the next part from its first segment
+        hw.pg.forceFinal()
+        hw.pg.constant(OutputState.ZERO())
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self._fold_blocks()
+        hw.dig.stop_card()
+        # the part was staged in the background, only upload and start remain
+        hw.pg.swapSequence(self.chunks[idx_chunk][1], n_runs=REPEAT_INFINITELY)
+        hw.dig.set_config()
+        hw.dig.start_buffer(reset_stats=False)  # the telemetry covers the whole run
+        if self.paraset["acq_thread"]:
+            self.acquisition = AcquisitionWorker(hw.dig).start()
+        self._select_chunk(idx_chunk)
+        hw.pg.startNow()
+        logger.debug(f"Switched to part {idx_chunk + 1} of {len(self.chunks)}")
+        self._stage_next_chunk()
+
+    def _stage_next_chunk(self):
+        if len(self.accumulators) > 1:
+            idx_next = (self.idx_chunk + 1) % len(self.accumulators)
+            hw.pg.stageSequence(self.chunks[idx_next][1])
+
+    def _run_exp(self):
+        self._fold_blocks()
+        if (
+            len(self.accumulators) > 1
+            and time.time() - self.t_chunk > self.paraset["chunk_dwell"]
+        ):
+            self._switch_chunk((self.idx_chunk + 1) % len(self.accumulators))
+
+        # every tau is measured once per repetition of its part
+        self.idx_run = min(acc.num_repeat for acc in self.accumulators)
         # -----------------------------------------------------------------------
         return None
 
-    # TODO: Generalize the start stop, maybe add the SNR opt
+    def _merged_store(self):
+        # the references of all parts add up, the tau slots follow part by part
+        if len(self.accumulators) == 1:
+            return self.seg_store, self.seg_count
+        seg_store = np.concatenate(
+            [sum(acc.store[:2] for acc in self.accumulators)]
+            + [acc.store[2:] for acc in self.accumulators]
+        )
+        seg_count = np.concatenate(
+            [sum(acc.count[:2] for acc in self.accumulators)]
+            + [acc.count[2:] for acc in self.accumulators]
+        )
+        return seg_store, seg_count
+
+    def _merged_sem(self):
+        # same order as _merged_store, the reference statistics of all parts are merged
+        if self.accumulator.stats is None:
+            return np.zeros(2 + sum(acc.num_slot - 2 for acc in self.accumulators))
+        if len(self.accumulators) == 1:
+            return self.accumulator.stats.sem
+        refs = RunningStats(2)
+        for acc in self.accumulators:
+            refs.merge(acc.stats.count[:2], acc.stats.mean[:2], acc.stats.m2[:2])
+        return np.concatenate(
+            [refs.sem] + [acc.stats.sem[2:] for acc in self.accumulators]
+        )
+
+    def _telemetry(self):
+        telemetry = stream_telemetry(hw.dig, self.acquisition)
+        telemetry["pg_dead_time"] = hw.pg.dead_time
+        if self.matched_filter is not None:
+            telemetry.update(self.matched_filter.as_dict())
+        return telemetry
+
     def _organize_data(self):
+        if self.matched_filter is not None:
+            self.matched_filter.publish(self.kernel)
+        seg_store, seg_count = self._merged_store()
         dark, bright, sig_p, sig_n = average_repeated_data(
-            self.seg_store,
-            self.seg_count,
-            self.bgextend_size + 160,
-            self.bgextend_size + 400,
-            bgextend_size=self.paraset["bgextend_size"],
-        )  # TODO: use parameters instead of fixed number to select integration window
+            seg_store,
+            seg_count,
+            self.kernel,
+            volt_per_code=self.volt_per_code,
+        )
+        dark_err, bright_err, sig_p_err, sig_n_err = repeated_data_error(
+            self._merged_sem(), volt_per_code=self.volt_per_code
+        )
 
         self.dataset["tau"] = self.tau_arr
         self.dataset["dark"] = dark
         self.dataset["bright"] = bright
         self.dataset["sig_p"] = sig_p
         self.dataset["sig_n"] = sig_n
+        self.dataset["dark_err"] = dark_err
+        self.dataset["bright_err"] = bright_err
+        self.dataset["sig_p_err"] = sig_p_err
+        self.dataset["sig_n_err"] = sig_n_err
         self.dataset["num_repeat"] = self.idx_run
         return super()._organize_data()
 
@@ -324,10 +447,19 @@ class TimeSweep(Measurement):
 
         # dump remaining data & stop digitizer
         # _ = hw.dig.stream()
+        if self.acquisition is not None:
+            self.acquisition.stop()
         hw.dig.stop_card()
         # hw.dig.reset()
 
     def _handle_exp_error(self):
+        try:
+            if getattr(self, "acquisition", None) is not None:
+                self.acquisition.stop()
+        except Exception as ee:
+            print("I tried to stop the acquisition thread but failed")
+            print(ee)
+
         try:
             hw.laser.laser_off()  # turn off laser
             hw.laser.set_diode_current(0.00, save_memory=False)
@@ -1016,15 +1148,11 @@ class CorrSpec(TimeSweep):
 
         ac_samplerate = self.paraset["ac_freq"] / 1e3 * 20.0  # 20 pt per period
 
-        # Generate time steps and sine values
+        # Generate the sampled wave as an analog pattern
         dt = int(1 / ac_samplerate)
-        ttt = np.arange(0.0, ac_duration, int(1 / ac_samplerate))  # ns
-        # cos_wave = np.sin(2 * np.pi * ac_freq * ttt / 1e3)  # for hahn echo
-        cos_wave = np.cos(2 * np.pi * ac_freq * ttt / 1e3)  # for XY8
-
-        # Convert to pulse pattern [(duration, value)]
-        pulse_pattern = [(dt, float(val)) for val in cos_wave]
-        analog_pio2o2_wait = [((int(t_pio2_mwa)), 0.0)]
+        # pulse_pattern = AnalogPattern.sine(ac_duration, dt, ac_freq / 1e3)  # for hahn echo
+        pulse_pattern = AnalogPattern.cosine(ac_duration, dt, ac_freq / 1e3)  # for XY8
+        analog_pio2o2_wait = AnalogPattern.constant(int(t_pio2_mwa), 0.0)
         sq_dd = []
         sq_dd += [(["mwA"], t_pio2_mwa)]
 
@@ -1057,8 +1185,8 @@ class CorrSpec(TimeSweep):
         seq_analog = analog_pio2o2_wait + pulse_pattern + analog_pio2o2_wait
         tau_ext = 0
         len_dig = get_sequence_duration(seq_ts)
-        len_analogue = get_analog_duration(seq_analog)
-        seq_analog += [(len_dig - len_analogue, 0.0)]
+        len_analogue = seq_analog.duration
+        seq_analog += AnalogPattern.constant(len_dig - len_analogue, 0.0)
 
         return seq_ts, tau_ext, seq_analog
 
@@ -1070,17 +1198,18 @@ class CorrSpec(TimeSweep):
             self.paraset["init_wait"],
             self.paraset["init_repeat"],
         )
-        sq_init_analog = [(get_sequence_duration(sq_init), 0.0)]
+        sq_init_analog = [AnalogPattern.constant(get_sequence_duration(sq_init), 0.0)]
         sq_read = seq_read(self.paraset["read_wait"], self.paraset["read_laser"])
-        sq_read_analog = [(get_sequence_duration(sq_read), 0.0)]
+        sq_read_analog = [AnalogPattern.constant(get_sequence_duration(sq_read), 0.0)]
         sq_exp = []
         seq_analog_exp = []
         # start with a bright and dark reference
         sq_dark = sq_init + [(["mwA"], self.paraset["t_pi_mwa"])] + sq_read
         sq_bright = sq_init + [([], self.paraset["t_pi_mwa"])] + sq_read
         sq_exp += sq_dark + sq_bright
-        seq_analog_exp += [(get_sequence_duration(sq_dark), 0.0)] + [
-            (get_sequence_duration(sq_bright), 0.0)
+        seq_analog_exp += [
+            AnalogPattern.constant(get_sequence_duration(sq_dark), 0.0),
+            AnalogPattern.constant(get_sequence_duration(sq_bright), 0.0),
         ]
 
         # add tau sweep sequence
@@ -1097,19 +1226,17 @@ class CorrSpec(TimeSweep):
             sq_exp += sq_init + sq_ts + [([], self.paraset["t_pi_mwa"])] + sq_read
             seq_analog_exp += (
                 sq_init_analog
-                + seq_analog
-                + [(self.paraset["t_pi_mwa"], 0.0)]
+                + [seq_analog, AnalogPattern.constant(self.paraset["t_pi_mwa"], 0.0)]
                 + sq_read_analog
             )
 
             sq_exp += sq_init + sq_ts + [(["mwA"], self.paraset["t_pi_mwa"])] + sq_read
             seq_analog_exp += (
                 sq_init_analog
-                + seq_analog
-                + [(self.paraset["t_pi_mwa"], 0.0)]
+                + [seq_analog, AnalogPattern.constant(self.paraset["t_pi_mwa"], 0.0)]
                 + sq_read_analog
             )
-        return sq_exp, tauaprime, seq_analog_exp
+        return sq_exp, tauaprime, AnalogPattern.concatenate(seq_analog_exp)
 
     def _setup_exp(self):
         # set the mw frequency, power and phase --------------------------------------------------
@@ -1130,13 +1257,22 @@ class CorrSpec(TimeSweep):
         # # -----------------------------------------------------------------------
 
         # set the pulse sequence-------------------------------------------
-        start = time.time()
-        seq_exp, tau_arr, seq_analog_all = self._sequence()
-        end = time.time()
-        logger.info(f"Time taken for generating sequence: {end - start:.4f} seconds")
+        # reuse the sequence if only non-sequence parameters changed, e.g. on resume
+        seq_key = hw.pg.sequenceKey(self.__class__.__name__, self.paraset)
+        seq_info = hw.pg.restoreSequence(seq_key)
+        if seq_info is None:
+            start = time.time()
+            seq_exp, tau_arr, seq_analog_all = self._sequence()
+            end = time.time()
+            logger.info(
+                f"Time taken for generating sequence: {end - start:.4f} seconds"
+            )
 
-        tt_seq = hw.pg.setSequence(seq_exp, reset=True)
-        hw.pg.setAnalog("Bz", seq_analog_all)
+            tt_seq = hw.pg.setSequence(seq_exp, reset=True)
+            hw.pg.setAnalog("Bz", seq_analog_all)
+            seq_info = hw.pg.cacheSequence(seq_key, tt_seq=tt_seq, tau_arr=tau_arr)
+        tt_seq = seq_info["tt_seq"]
+        tau_arr = seq_info["tau_arr"]
 
         hw.pg.setTrigger(TriggerStart.SOFTWARE, rearm=TriggerRearm.AUTO)
         hw.pg.setClock10MHzExt()
@@ -1186,6 +1322,7 @@ class CorrSpec(TimeSweep):
                 pretrig_size=pretrig_size + self.bgextend_size,  # TODO: why 256?
                 posttrig_size=posttrig_size - self.bgextend_size,
                 segment_size=segment_size,
+                zero_copy=True,
             )
         )
         logger.debug(
@@ -1196,80 +1333,21 @@ class CorrSpec(TimeSweep):
         # -----------------------------------------------------------------------
 
         # put some necessary variables in self-------------------------------------
+        self.acquisition = None
         self.tau_arr = tau_arr
+        self.volt_per_code = hw.dig.volt_per_code
         if not self.tokeep:
-            self.idx_pointer = 0
             self.dataset["tau"] = self.tau_arr
             # self.dataset["bright"] = 0.0
             # self.dataset["dark"] = 0.0
             self.dataset["sig_p"] = np.zeros(self.tau_arr_num)
             self.dataset["sig_n"] = np.zeros(self.tau_arr_num)
-            self.seg_count = np.zeros(
-                self.databufferlen,
-                dtype=np.float64,
-                order="C",
-            )
-            self.seg_store = np.zeros(
-                (self.databufferlen, segment_size),
-                dtype=np.float64,
-                order="C",
-            )
+            self._setup_store(segment_size)
         # -----------------------------------------------------------------------
         # start the laser and digitizer then wait for trigger from the  pulse streamer--------------
         hw.laser.laser_on()  # turn on laser
         hw.dig.start_buffer()
+        if self.paraset["acq_thread"]:
+            self.acquisition = AcquisitionWorker(hw.dig).start()
         # logger.debug("Start the trigger from the pulse streamer")
         hw.pg.startNow()
-
-    def _run_exp(self):
-        self.rawraw = hw.dig.stream()
-        if self.rawraw is not None:
-            num_segs = self.rawraw.shape[0]
-            idx_ptr_overflow = self.idx_pointer + num_segs
-            count_fill, idx_pointer_new = divmod(idx_ptr_overflow, self.databufferlen)
-            if count_fill < 1:
-                # underfill================================
-                # if the segment number is small to the remaining slot numbers in the buffer
-                idx_i = self.idx_pointer
-                idx_f = self.idx_pointer + num_segs
-                self.seg_store[idx_i:idx_f, :] += np.reshape(
-                    self.rawraw[:num_segs], (num_segs, -1)
-                )
-                self.seg_count[idx_i:idx_f] += 1
-            else:
-                # exactly fill or overfill===============================
-
-                # fill the tail of the data_store buffer ----------------
-                num_tailslot = self.databufferlen - self.idx_pointer
-                idx_i = self.idx_pointer
-                idx_f = self.databufferlen
-                self.seg_store[idx_i:idx_f, :] += np.reshape(
-                    self.rawraw[:num_tailslot], (num_tailslot, -1)
-                )
-
-                self.seg_count[idx_i:idx_f] += 1
-
-                # fill the entire data_store buffer multiple times ----------------
-                if count_fill > 1:
-                    to_add_unstructured = np.reshape(
-                        self.rawraw[
-                            num_tailslot : num_tailslot
-                            + (count_fill - 1) * self.databufferlen
-                        ],
-                        (count_fill - 1, self.databufferlen, -1),
-                    )
-                    self.seg_store += np.sum(to_add_unstructured, axis=0)
-                    self.seg_count += count_fill - 1
-
-                # fill the head of the data_store buffer for the remaining segments --------------
-                self.seg_store[:idx_pointer_new, :] += (
-                    np.reshape(self.rawraw[-idx_pointer_new:], (idx_pointer_new, -1))
-                    if idx_pointer_new
-                    else self.seg_store[:idx_pointer_new, :]
-                )  # the if condition is needed to handle the case that the idx_pointer_new is 0
-                self.seg_count[:idx_pointer_new] += 1
-            self.idx_pointer = idx_pointer_new
-
-        self.idx_run = self.seg_count[-1]
-        # -----------------------------------------------------------------------
-        return None